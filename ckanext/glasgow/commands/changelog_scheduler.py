@@ -0,0 +1,267 @@
+import sys
+import time
+import datetime
+
+from pylons import config
+
+from ckan import model
+from ckan.lib.cli import CkanCommand
+from ckan.plugins import toolkit
+
+from ckanext.harvest.model import HarvestJob, HarvestObject
+
+from ckanext.glasgow.model import HarvestLastAudit
+from ckanext.glasgow.harvesters.changelog import (
+    changelog_page_size,
+    changelog_object_types,
+    get_changelog_sources,
+)
+
+
+# Jobs are scheduled so they get around this many audits at the current
+# arrival rate
+target_job_audits = changelog_page_size / 10
+
+
+def get_next_interval(interval, audit_count, rate, min_interval,
+                      max_interval):
+    '''
+    Returns the seconds to wait before starting the next changelog job
+
+    If the last job got a full page of audits there are more waiting on the
+    platform, so the next job is started straight away. If it got none the
+    interval is doubled, otherwise it is set so jobs get around
+    `target_job_audits` at the current arrival rate (audits per second).
+    The interval is always kept between `min_interval` and `max_interval`.
+    '''
+    # The audit the job started from is part of the page
+    if audit_count >= changelog_page_size - 1:
+        return 0
+
+    if not audit_count or not rate:
+        interval = interval * 2
+    else:
+        interval = target_job_audits / rate
+
+    return max(min_interval, min(max_interval, interval))
+
+
+def get_arrival_rate(window=3600, object_type=None):
+    '''
+    Returns the audits per second gathered by the jobs of a lane in the last
+    `window` seconds, or None if there are not enough jobs to tell
+    '''
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=window)
+    rows = model.Session.query(HarvestLastAudit.created,
+                               HarvestLastAudit.audit_count) \
+        .filter(HarvestLastAudit.object_type == object_type) \
+        .filter(HarvestLastAudit.created >= since) \
+        .filter(HarvestLastAudit.audit_count != None) \
+        .order_by(HarvestLastAudit.created) \
+        .all()
+
+    if len(rows) < 2:
+        return None
+
+    # Audits gathered by a job arrived since the previous one
+    elapsed = (rows[-1].created - rows[0].created).total_seconds()
+    if elapsed <= 0:
+        return None
+    return sum(row.audit_count for row in rows[1:]) / elapsed
+
+
+def get_job_audit_count(job_id):
+    '''
+    Returns the number of new audits gathered by a job
+
+    Returns None if the job did not record its audits (eg it did not run a
+    changelog gather), so it is not mistaken for a job that got none.
+    '''
+    last_audit = model.Session.query(HarvestLastAudit) \
+        .filter(HarvestLastAudit.harvest_job_id == job_id) \
+        .first()
+    return (last_audit.audit_count or 0) if last_audit else None
+
+
+class ChangelogScheduler(CkanCommand):
+    '''Starts changelog harvest jobs at an interval adapted to the load
+
+    Usage:
+
+      changelog_scheduler run [object_type]
+        - Keep starting jobs for the changelog harvest source. A new job is
+          started as soon as the previous one finishes if it got a full
+          page of audits, otherwise after an interval that is shortened or
+          lengthened based on the audit arrival rate, between
+          `ckanext.glasgow.changelog_scheduler.min_interval` (default 60)
+          and `ckanext.glasgow.changelog_scheduler.max_interval` (default
+          1800) seconds. Only the jobs started by the scheduler are used
+          to adapt the interval, jobs started by someone else are waited
+          for and then ignored. A job is given up on after
+          `ckanext.glasgow.changelog_scheduler.max_wait` seconds (default
+          3600).
+
+      changelog_scheduler status [object_type]
+        - Print the arrival rate, the last job results and the pending
+          objects of the changelog harvest source
+
+    If an object type (Dataset, File or Organisation) is given, the source of
+    that changelog lane is used instead of the default one, so each lane can
+    be run by a scheduler of its own.
+
+    This replaces the cron job that runs the harvester for this source,
+    only one scheduler should be run at a time for each lane.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def command(self):
+
+        self._load_config()
+        if len(self.args) == 0:
+            self.parser.print_usage()
+            sys.exit(1)
+
+        self.min_interval = int(config.get(
+            'ckanext.glasgow.changelog_scheduler.min_interval', 60))
+        self.max_interval = int(config.get(
+            'ckanext.glasgow.changelog_scheduler.max_interval', 1800))
+        self.poll_interval = int(config.get(
+            'ckanext.glasgow.changelog_scheduler.poll_interval', 10))
+        self.max_wait = int(config.get(
+            'ckanext.glasgow.changelog_scheduler.max_wait', 3600))
+
+        self.object_type = self.args[1] if len(self.args) > 1 else None
+        if (self.object_type
+                and self.object_type not in changelog_object_types):
+            print 'Unknown object type: {0}'.format(self.object_type)
+            sys.exit(1)
+
+        source = get_changelog_sources().get(self.object_type)
+        if not source:
+            print 'No active changelog harvest source for lane {0}'.format(
+                self.object_type or 'default')
+            sys.exit(1)
+        self.source_id = source.id
+
+        cmd = self.args[0]
+        if cmd == 'run':
+            self._run()
+        elif cmd == 'status':
+            self._status()
+        else:
+            print 'Unknown command: {0}'.format(cmd)
+            sys.exit(1)
+
+    def _get_context(self):
+        site_user = toolkit.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})
+        return {
+            'model': model,
+            'session': model.Session,
+            'user': site_user['name'],
+            'ignore_auth': True,
+        }
+
+    def _get_current_job(self):
+        return model.Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == self.source_id) \
+            .filter(HarvestJob.status.in_([u'New', u'Running'])) \
+            .first()
+
+    def _get_pending_objects(self):
+        return model.Session.query(HarvestObject) \
+            .join(HarvestJob) \
+            .filter(HarvestJob.source_id == self.source_id) \
+            .filter(~HarvestObject.state.in_([u'COMPLETE', u'ERROR'])) \
+            .count()
+
+    def _run_jobs(self):
+        # Sends new jobs to the gather queue and marks the finished ones
+        toolkit.get_action('harvest_jobs_run')(
+            self._get_context(), {'source_id': self.source_id})
+        model.Session.remove()
+
+    def _wait_for_job(self, job_id):
+        '''
+        Waits until a job is finished, returns False if it is still not
+        finished after `max_wait` seconds
+        '''
+        started = time.time()
+        while True:
+            self._run_jobs()
+            job = model.Session.query(HarvestJob).get(job_id)
+            if job.status == u'Finished':
+                return True
+            if time.time() - started >= self.max_wait:
+                return False
+            time.sleep(self.poll_interval)
+
+    def _run_job(self, interval):
+        '''
+        Runs a changelog job and returns the interval before the next one
+
+        If there is already a job not started by the scheduler (eg by the
+        harvester cron job or a changelog notification) it is waited for
+        instead, and the interval is left as it is.
+        '''
+        job = self._get_current_job()
+        if job:
+            print 'Waiting for current job {0}'.format(job.id)
+            own_job = False
+        else:
+            job = toolkit.get_action('harvest_job_create')(
+                self._get_context(), {'source_id': self.source_id})
+            job = model.Session.query(HarvestJob).get(job['id'])
+            print 'Started job {0}'.format(job.id)
+            own_job = True
+        job_id = job.id
+
+        if not self._wait_for_job(job_id):
+            print 'Job {0} not finished after {1}s, {2} pending ' \
+                'objects'.format(job_id, self.max_wait,
+                                 self._get_pending_objects())
+            return interval
+
+        audit_count = get_job_audit_count(job_id) if own_job else None
+        if audit_count is None:
+            print 'Job {0} finished, next job in {1:.0f}s'.format(
+                job_id, interval)
+            return interval
+
+        rate = get_arrival_rate(object_type=self.object_type)
+        interval = get_next_interval(interval, audit_count, rate,
+                                     self.min_interval, self.max_interval)
+        print 'Job {0} got {1} audits, next job in {2:.0f}s'.format(
+            job_id, audit_count, interval)
+        return interval
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            interval = self._run_job(interval)
+            model.Session.remove()
+
+            time.sleep(interval)
+
+    def _status(self):
+        rate = get_arrival_rate(object_type=self.object_type)
+        print 'Arrival rate: {0}'.format(
+            '{0:.3f} audits/s'.format(rate) if rate is not None else '-')
+
+        last_audit = model.Session.query(HarvestLastAudit) \
+            .filter(HarvestLastAudit.object_type == self.object_type) \
+            .order_by(HarvestLastAudit.created.desc()) \
+            .first()
+        if last_audit:
+            print 'Last audit: {0} ({1} new audits, {2})'.format(
+                last_audit.audit_id,
+                last_audit.audit_count if last_audit.audit_count is not None
+                else '-',
+                last_audit.created)
+
+        job = self._get_current_job()
+        print 'Current job: {0}'.format(
+            '{0} ({1})'.format(job.id, job.status) if job else '-')
+        print 'Pending objects: {0}'.format(self._get_pending_objects())
@@ -1,14 +1,33 @@
 import sys
+import json
+import time
 
+from pylons import config
 from sqlalchemy import or_
 
 from ckan import model
 from ckan.lib.cli import CkanCommand
 from ckan.plugins import toolkit
 
-from ckanext.glasgow.model import harvest_last_audit_table
-from ckanext.glasgow.logic.action import ECAPIError
-from ckanext.glasgow.harvesters.changelog import save_last_audit_id
+from ckanext.glasgow.model import (
+    harvest_last_audit_table,
+    extension_task_types,
+)
+from ckanext.glasgow.locks import AdvisoryLocks
+from ckanext.glasgow.logic.action import (
+    ECAPIError,
+    _task_status_final_states,
+)
+from ckanext.glasgow.harvesters.changelog import (
+    save_last_audit_id,
+    get_gather_lock_name,
+    get_changelog_sources,
+    changelog_object_types,
+)
+
+
+def get_task_lock_name(task_id):
+    return 'ckanext.glasgow.task_status.{0}'.format(task_id)
 
 
 class UpdateFromEcApiChangeLog(CkanCommand):
@@ -17,19 +36,69 @@ class UpdateFromEcApiChangeLog(CkanCommand):
 
     def command(self):
         self._load_config()
+
+        batch_size = int(config.get(
+            'ckanext.glasgow.changelog_update.batch_size', 100))
+
+        task_ids = [row.id for row in
+                    model.Session.query(model.TaskStatus.id)
+                    .filter(self._pending_filter())]
+
+        # Tasks being updated by another run of the command are left to it,
+        # so concurrent runs split the pending tasks between them. Tasks are
+        # locked one batch at a time, so only a batch of locks is held at
+        # once.
+        for start in range(0, len(task_ids), batch_size):
+            with AdvisoryLocks() as locks:
+                self._update_tasks(locks,
+                                   task_ids[start:start + batch_size])
+
+    def _pending_filter(self):
+        return or_(model.TaskStatus.state == 'in_progress',
+                   model.TaskStatus.state == 'sent')
+
+    def _update_tasks(self, locks, task_ids):
         pending_tasks = model.Session.query(model.TaskStatus) \
-            .filter(or_(model.TaskStatus.state == 'in_progress',
-                    model.TaskStatus.state == 'sent'))
+            .filter(model.TaskStatus.id.in_(task_ids)) \
+            .filter(self._pending_filter())
+
+        pending_tasks = [task for task in pending_tasks.all()
+                         if locks.acquire(get_task_lock_name(task.id))]
+        if not pending_tasks:
+            return
+
+        request_ids = {}
+        for task in pending_tasks:
+            try:
+                request_ids[task.id] = json.loads(task.value)['request_id']
+            except (ValueError, TypeError, KeyError):
+                pass
+
+        # Get the status of all requests at once
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+        }
+        try:
+            statuses = toolkit.get_action('request_status_batch')(
+                context, {'request_ids': request_ids.values()})
+        except ECAPIError, e:
+            print 'failed to get request statuses: {0}'.format(e.extra_msg)
+            statuses = {}
 
         check_for_update = toolkit.get_action('check_for_task_status_update')
-        for task in pending_tasks.all():
+        for task in pending_tasks:
             context = {
                 'model': model,
                 'session': model.Session,
                 'ignore_auth': True,
             }
+            data_dict = {'task_id': task.id}
+            if statuses.get(request_ids.get(task.id)):
+                data_dict['request_status'] = statuses[request_ids[task.id]]
             try:
-                check_for_update(context, {'task_id': task.id})
+                check_for_update(context, data_dict)
                 print 'updated task {0}'.format(task.id)
             except ECAPIError, e:
                 print 'failed to update task {0}: {1}'.format(task.id,
@@ -48,6 +117,8 @@ class ChangelogAudit(CkanCommand):
         - Sets the next audit to start from. If audit_id is omitted the most
           recent one on the platform will be used.
 
+    Both apply to all the changelog lanes.
+
 
     '''
 
@@ -68,9 +139,17 @@ class ChangelogAudit(CkanCommand):
             audit_id = self.args[1] if len(self.args) > 1 else None
             self._set(audit_id)
 
+    def _lock_lanes(self, locks):
+        # Wait for any job gathering audits, or it would save its cursor
+        # after this one
+        locks.acquire_all(get_gather_lock_name(object_type) for object_type
+                          in (None,) + changelog_object_types)
+
     def _clear(self):
-        model.Session.execute(harvest_last_audit_table.delete())
-        model.Session.commit()
+        with AdvisoryLocks() as locks:
+            self._lock_lanes(locks)
+            model.Session.execute(harvest_last_audit_table.delete())
+            model.Session.commit()
         print 'Last audits table emptied'
 
     def _set(self, audit_id=None):
@@ -86,7 +165,10 @@ class ChangelogAudit(CkanCommand):
 
             audit_id = audits[0]['AuditId']
 
-        save_last_audit_id(audit_id, None)
+        with AdvisoryLocks() as locks:
+            self._lock_lanes(locks)
+            for object_type in set(get_changelog_sources()) | set([None]):
+                save_last_audit_id(audit_id, None, object_type=object_type)
 
         print 'Set last audit id to', audit_id
 
@@ -94,11 +176,38 @@ class ChangelogAudit(CkanCommand):
 class Cleanup(CkanCommand):
     '''Cleans up DB tables
 
+    Rows are deleted in chunks of `ckanext.glasgow.db_clean.chunk_size`
+    rows (default 1000), each one in its own transaction, so tables are not
+    locked for long.
+
     Usage:
 
       db_clean harvest
-        - Clean up harvest tables (jobs, objects, extras and errors)
-
+        - Clean up harvest tables (jobs, objects, extras and errors) older
+          than `ckanext.glasgow.db_clean.harvest_retention` (default
+          48 hours)
+
+      db_clean tasks
+        - Clean up finished or failed task statuses created by the
+          extension not updated in
+          `ckanext.glasgow.db_clean.task_retention` (default 30 days), and
+          archived tasks older than
+          `ckanext.glasgow.db_clean.task_archive_retention` (default 90
+          days)
+
+      db_clean audits
+        - Clean up changelog audits older than
+          `ckanext.glasgow.db_clean.audit_retention` (default 7 days). The
+          most recent audit of each lane is always kept. The record of
+          imported audits is kept for
+          `ckanext.glasgow.db_clean.processed_audit_retention` (default 30
+          days), audits older than that would be imported again if the
+          audit cursor is reset.
+
+      db_clean all
+        - All of the above
+
+    Retention periods are PostgreSQL intervals, eg "12 hours" or "2 weeks".
     '''
 
     summary = __doc__.split('\n')[0]
@@ -111,22 +220,151 @@ class Cleanup(CkanCommand):
             self.parser.print_usage()
             sys.exit(1)
 
+        self.chunk_size = int(config.get('ckanext.glasgow.db_clean.chunk_size',
+                                         1000))
+
         cmd = self.args[0]
-        if cmd == 'harvest':
+        if cmd in ('harvest', 'all'):
             self._clear_harvest()
+        if cmd in ('tasks', 'all'):
+            self._clear_tasks()
+        if cmd in ('audits', 'all'):
+            self._clear_audits()
+        if cmd not in ('harvest', 'tasks', 'audits', 'all'):
+            print 'Unknown command: {0}'.format(cmd)
+            sys.exit(1)
+
+    def _delete_in_chunks(self, label, select_sql, delete_sqls, params):
+        '''Deletes rows in chunks until there is nothing left to delete
+
+        `select_sql` must return the ids of up to :limit rows to delete, and
+        each of `delete_sqls` deletes the rows related to the :ids selected.
+        '''
+        params = dict(params, limit=self.chunk_size)
+        total = 0
+        start = time.time()
+
+        while True:
+            ids = [row[0] for row in
+                   model.Session.execute(select_sql, params)]
+            if not ids:
+                break
+
+            for delete_sql in delete_sqls:
+                model.Session.execute(delete_sql, {'ids': tuple(ids)})
+            model.Session.commit()
+
+            total += len(ids)
+            elapsed = time.time() - start
+            print '{0}: deleted {1} rows ({2:.0f} rows/s)'.format(
+                label, total, total / elapsed if elapsed else total)
+
+            if len(ids) < self.chunk_size:
+                break
+
+        model.Session.commit()
+        print '{0}: done, {1} rows deleted in {2:.1f}s'.format(
+            label, total, time.time() - start)
+
+        return total
 
     def _clear_harvest(self):
 
-        interval = '48 hours'
+        params = {
+            'retention': config.get(
+                'ckanext.glasgow.db_clean.harvest_retention', '48 hours'),
+        }
 
-        sql = '''
-        BEGIN;
-        DELETE FROM harvest_object_error WHERE harvest_object_id IN (SELECT o.id FROM harvest_object o JOIN harvest_job j on j.id = o.harvest_job_id where j.created < NOW() - INTERVAL '{0}');
-        DELETE FROM harvest_object_extra WHERE harvest_object_id IN (SELECT o.id FROM harvest_object o JOIN harvest_job j on j.id = o.harvest_job_id where j.created < NOW() - INTERVAL '{0}');
-        DELETE FROM harvest_object o USING harvest_job j WHERE j.id = o.harvest_job_id AND j.created < NOW() - INTERVAL '{0}';
-        DELETE FROM harvest_gather_error WHERE harvest_job_id IN (SELECT id FROM harvest_job WHERE created < NOW() - INTERVAL '{0}');
-        DELETE FROM harvest_job WHERE created < NOW() - INTERVAL '{0}';
-        COMMIT;
-        '''
+        self._delete_in_chunks(
+            'harvest objects',
+            '''SELECT o.id FROM harvest_object o
+               JOIN harvest_job j ON j.id = o.harvest_job_id
+               WHERE j.created < NOW() - CAST(:retention AS INTERVAL)
+               LIMIT :limit''',
+            [
+                'DELETE FROM harvest_object_error WHERE harvest_object_id IN :ids',
+                'DELETE FROM harvest_object_extra WHERE harvest_object_id IN :ids',
+                'DELETE FROM harvest_object WHERE id IN :ids',
+            ],
+            params)
+
+        self._delete_in_chunks(
+            'harvest jobs',
+            '''SELECT j.id FROM harvest_job j
+               WHERE j.created < NOW() - CAST(:retention AS INTERVAL)
+               AND NOT EXISTS (
+                   SELECT 1 FROM harvest_object o
+                   WHERE o.harvest_job_id = j.id)
+               LIMIT :limit''',
+            [
+                'DELETE FROM harvest_gather_error WHERE harvest_job_id IN :ids',
+                'DELETE FROM harvest_job WHERE id IN :ids',
+            ],
+            params)
+
+    def _clear_tasks(self):
+
+        params = {
+            'retention': config.get(
+                'ckanext.glasgow.db_clean.task_retention', '30 days'),
+            'states': tuple(_task_status_final_states),
+            'task_types': extension_task_types,
+        }
+
+        # task_status is shared with core and other extensions, only the
+        # extension tasks are deleted
+        self._delete_in_chunks(
+            'task statuses',
+            '''SELECT id FROM task_status
+               WHERE task_type IN :task_types
+               AND state IN :states
+               AND last_updated < NOW() - CAST(:retention AS INTERVAL)
+               LIMIT :limit''',
+            ['DELETE FROM glasgow_task_request WHERE task_id IN :ids',
+             'DELETE FROM task_status WHERE id IN :ids'],
+            params)
+
+        params = {
+            'retention': config.get(
+                'ckanext.glasgow.db_clean.task_archive_retention', '90 days'),
+        }
+
+        self._delete_in_chunks(
+            'archived tasks',
+            '''SELECT id FROM glasgow_task_status_archive
+               WHERE archived < NOW() - CAST(:retention AS INTERVAL)
+               LIMIT :limit''',
+            ['DELETE FROM glasgow_task_status_archive WHERE id IN :ids'],
+            params)
+
+    def _clear_audits(self):
+
+        params = {
+            'retention': config.get(
+                'ckanext.glasgow.db_clean.audit_retention', '7 days'),
+        }
+
+        self._delete_in_chunks(
+            'changelog audits',
+            '''SELECT id FROM harvest_last_audit
+               WHERE created < NOW() - CAST(:retention AS INTERVAL)
+               AND id NOT IN (SELECT DISTINCT ON (object_type) id
+                              FROM harvest_last_audit
+                              ORDER BY object_type, created DESC)
+               LIMIT :limit''',
+            ['DELETE FROM harvest_last_audit WHERE id IN :ids'],
+            params)
+
+        params = {
+            'retention': config.get(
+                'ckanext.glasgow.db_clean.processed_audit_retention',
+                '30 days'),
+        }
 
-        model.Session.execute(sql.format(interval))
+        self._delete_in_chunks(
+            'processed audits',
+            '''SELECT audit_id FROM glasgow_processed_audit
+               WHERE processed < NOW() - CAST(:retention AS INTERVAL)
+               LIMIT :limit''',
+            ['DELETE FROM glasgow_processed_audit WHERE audit_id IN :ids'],
+            params)
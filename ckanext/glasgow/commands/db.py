@@ -0,0 +1,146 @@
+import sys
+import time
+
+from pylons import config
+
+from ckan.lib.cli import CkanCommand
+
+from ckanext.glasgow.model import (
+    get_index_status,
+    create_index,
+    drop_index,
+    archive_task_statuses,
+    refresh_user_counts,
+)
+
+
+class GlasgowDB(CkanCommand):
+    '''Manages the DB objects used by the extension
+
+    Usage:
+
+      glasgow_db indexes [list]
+        - List the indexes used by the extension queries and their status
+
+      glasgow_db indexes create
+        - Create the missing indexes (invalid ones are rebuilt). Indexes are
+          built concurrently, so tables are not locked for writes while
+          they are created. An interrupted build leaves an invalid index
+          behind, run the command again to rebuild it.
+
+      glasgow_db indexes verify
+        - Exit with an error if any index is missing or invalid
+
+      glasgow_db tasks archive
+        - Move finished tasks not updated in
+          `ckanext.glasgow.task_archive_after` (default 1 day) and pending
+          tasks not updated in `ckanext.glasgow.task_expire_after` (default
+          30 days) to the task archive table, in batches of
+          `ckanext.glasgow.task_archive_batch_size` (default 1000). Meant to
+          be run periodically.
+
+      glasgow_db users counts
+        - Refresh the number of edits and administered datasets of each user
+          shown on the user list. Meant to be run periodically.
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def command(self):
+
+        self._load_config()
+        if len(self.args) == 0:
+            self.parser.print_usage()
+            sys.exit(1)
+
+        cmd = self.args[0]
+        if cmd == 'indexes':
+            sub_cmd = self.args[1] if len(self.args) > 1 else 'list'
+            if sub_cmd == 'list':
+                self._list_indexes()
+            elif sub_cmd == 'create':
+                self._create_indexes()
+            elif sub_cmd == 'verify':
+                self._verify_indexes()
+            else:
+                print 'Unknown command: indexes {0}'.format(sub_cmd)
+                sys.exit(1)
+        elif cmd == 'tasks':
+            sub_cmd = self.args[1] if len(self.args) > 1 else None
+            if sub_cmd == 'archive':
+                self._archive_tasks()
+            else:
+                print 'Unknown command: tasks {0}'.format(sub_cmd)
+                sys.exit(1)
+        elif cmd == 'users':
+            sub_cmd = self.args[1] if len(self.args) > 1 else None
+            if sub_cmd == 'counts':
+                self._refresh_user_counts()
+            else:
+                print 'Unknown command: users {0}'.format(sub_cmd)
+                sys.exit(1)
+        else:
+            print 'Unknown command: {0}'.format(cmd)
+            sys.exit(1)
+
+    def _list_indexes(self):
+        for name, table, definition, status in get_index_status():
+            print '{0:<45} {1:<10} {2} {3}'.format(name, status, table,
+                                                  definition)
+
+    def _create_indexes(self):
+        for name, table, definition, status in get_index_status():
+            if status == 'invalid':
+                print 'Dropping invalid index {0}'.format(name)
+                drop_index(name)
+            if status in ('missing', 'invalid'):
+                print 'Creating index {0} on {1}'.format(name, table)
+                create_index(name, table, definition)
+            elif status == 'no table':
+                print 'Skipping index {0}, table {1} does not exist'.format(
+                    name, table)
+
+        print 'Done'
+
+    def _verify_indexes(self):
+        problems = [(name, status) for name, table, definition, status
+                    in get_index_status() if status in ('missing', 'invalid')]
+
+        for name, status in problems:
+            print '{0}: {1}'.format(name, status)
+
+        if problems:
+            sys.exit(1)
+
+        print 'All indexes present'
+
+    def _archive_tasks(self):
+        completed_age = config.get('ckanext.glasgow.task_archive_after',
+                                   '1 day')
+        expired_age = config.get('ckanext.glasgow.task_expire_after',
+                                 '30 days')
+        batch_size = int(config.get('ckanext.glasgow.task_archive_batch_size',
+                                    1000))
+
+        total = 0
+        start = time.time()
+        while True:
+            archived = archive_task_statuses(completed_age, expired_age,
+                                             batch_size)
+            total += archived
+            if archived:
+                print 'Archived {0} tasks'.format(total)
+            if archived < batch_size:
+                break
+
+        print 'Done, {0} tasks archived in {1:.1f}s'.format(
+            total, time.time() - start)
+
+    def _refresh_user_counts(self):
+        start = time.time()
+        updated = refresh_user_counts()
+
+        print 'Done, counts for {0} users refreshed in {1:.1f}s'.format(
+            updated, time.time() - start)
@@ -1,12 +1,17 @@
+import sys
+import time
 import logging
 import uuid
 import urllib
+from multiprocessing.pool import ThreadPool
 
+import pylons
 from pylons import config
+import paste.registry
 import requests
 
 from ckan import model
-from ckan.lib.cli import CkanCommand
+from ckan.lib.cli import CkanCommand, MockTranslator
 from ckan.plugins import toolkit
 
 from ckanext.glasgow.logic.schema import (
@@ -16,12 +21,30 @@ from ckanext.glasgow.logic.schema import (
 )
 
 from ckanext.glasgow.harvesters import get_org_name
+from ckanext.glasgow.logic.action import _get_organization_id
 from ckanext.glasgow.harvesters.ec_harvester import _fetch_from_ec
 
 
 log = logging.getLogger(__name__)
 
-def create_user(ec_dict):
+
+def _get_site_user_name():
+    context = {
+        'ignore_auth': True,
+        'model': model,
+        'session': model.Session
+    }
+    return toolkit.get_action('get_site_user')(context, {})['name']
+
+
+def create_user(ec_dict, site_user=None, create_missing_org=True):
+    '''Creates a CKAN user from a platform user
+
+    The user is made a member of its organization, which is created if it
+    does not exist yet (unless `create_missing_org` is False). `site_user`
+    is the name of the user used to create them, the site user if not
+    provided.
+    '''
     data_dict = convert_ec_user_to_ckan_user(ec_dict)
     data_dict['password'] = str(uuid.uuid4())
     if not data_dict.get('email'):
@@ -31,17 +54,13 @@ def create_user(ec_dict):
     if data_dict.get('name'):
         data_dict['name'] = data_dict['name'].lower()
 
-    context = {
-        'ignore_auth': True,
-        'model': model,
-        'session': model.Session
-    }
-    site_user = toolkit.get_action('get_site_user')(context, {})
+    if not site_user:
+        site_user = _get_site_user_name()
 
     context = {
         'ignore_auth': True,
         'model': model,
-        'user': site_user['name'],
+        'user': site_user,
         'session': model.Session,
         'schema': user_schema(),
     }
@@ -60,15 +79,14 @@ def create_user(ec_dict):
                 context = {
                     'ignore_auth': True,
                     'model': model,
-                    'user': site_user['name'],
+                    'user': site_user,
                     'session': model.Session,
                     'local_action': True,
                 }
                 member_dict = convert_ec_member_to_ckan_member(ec_dict)
-                try:
-                    org = toolkit.get_action('organization_show')(context, {'id': member_dict['id']})
-                except toolkit.ObjectNotFound, e:
-                    org = create_orgs(member_dict['id'], site_user['name'])
+                org = _get_organization_id(member_dict['id'])
+                if not org and create_missing_org:
+                    org = create_orgs(member_dict['id'], site_user)
                 if org:
                     toolkit.get_action('organization_member_create')(context, member_dict)
 
@@ -110,50 +128,160 @@ def create_orgs(organization_id, site_user):
     }
 
     try:
-        toolkit.get_action('organization_create')(context, data_dict)
-        context.pop('local_action', None)
-        return toolkit.get_action('organization_show')(context, {id: 'organization_id'})
+        org_dict = toolkit.get_action('organization_create')(context, data_dict)
+        return org_dict['id']
     except toolkit.ValidationError:
         print 'failed to create org {}'.format(organization_id)
 
 
-def _create_users(ec_user_list):
-    for ec_user in ec_user_list:
-        user = create_user(ec_user)
-        if user:
-            print 'created user {0}'.format(user['id'])
+def _init_worker():
+    '''Sets up a worker thread to run actions
+
+    Registers the pylons translator for the thread like CkanCommand does
+    for the main one, otherwise the validators' error messages fail.
+    '''
+    registry = paste.registry.Registry()
+    registry.prepare()
+    registry.register(pylons.translator, MockTranslator())
+
+
+def _create_user_isolated(args):
+    '''Creates a user in a worker thread
+
+    Errors are logged and returned instead of raised, so one bad user does
+    not stop the import, and each call uses its own DB session.
+
+    :returns: a tuple with the platform user dict, the result (one of
+        `created`, `skipped` or `failed`) and the error message if failed
+    '''
+    ec_dict, site_user = args
+    try:
+        user = create_user(ec_dict, site_user, create_missing_org=False)
+        return ec_dict, 'created' if user else 'skipped', None
+    except Exception, e:
+        log.exception('Could not create user {0}'.format(
+            ec_dict.get('UserName')))
+        model.Session.rollback()
+        return ec_dict, 'failed', str(e)
+    finally:
+        model.Session.remove()
 
 
 class GetInitialUsers(CkanCommand):
-    summary = "--NO SUMMARY--"
-    usage = "--NO USAGE--"
+    '''Creates the users from the CTPEC identity platform
+
+    Users are requested one page at a time and each page is created before
+    requesting the next one, using a pool of worker threads. Users that
+    already exist are skipped, so the command can be run again after a
+    failure. Missing organizations are created (once each) before the users
+    of a page are.
+
+    Usage:
+
+      get_initial_users [-w WORKERS] [-s SKIP]
+
+    -w sets the number of worker threads (default
+    `ckanext.glasgow.get_users_workers` or 4) and -s the number of platform
+    users to skip, to resume an import from the last page reported.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def __init__(self, name):
+        super(GetInitialUsers, self).__init__(name)
+        self.parser.add_option('-w', '--workers', dest='workers', type='int',
+                               default=None, help='Number of worker threads')
+        self.parser.add_option('-s', '--skip', dest='skip', type='int',
+                               default=0, help='Platform users to skip')
 
     def command(self):
         self._load_config()
-        context = {
-            'ignore_auth': True,
-            'model': model,
-            'session': model.Session
-        }
-        site_user = toolkit.get_action('get_site_user')(context, {})
 
-        context = {
+        self.site_user = _get_site_user_name()
+        self.context = {
             'ignore_auth': True,
             'model': model,
-            'user': site_user['name'],
+            'user': self.site_user,
             'session': model.Session
         }
-        top = 100
-        skip = 0
-        ec_user_list = []
-        while True:
-            print skip
-            result = toolkit.get_action('ec_user_list')(context, {'skip': skip})
-
-            if not len(result) or (len(ec_user_list) and result[-1] == ec_user_list[-1]):
-                break
-            else:
-                ec_user_list.extend(result)
-
-                skip += top
-        _create_users(ec_user_list)
+
+        workers = self.options.workers or int(
+            config.get('ckanext.glasgow.get_users_workers', 4))
+        skip = self.options.skip
+
+        self.counts = dict((result, 0) for result in
+                           ('created', 'existing', 'skipped', 'failed'))
+        self.failed_orgs = set()
+        seen_ids = set()
+        start = time.time()
+
+        pool = ThreadPool(max(1, workers), initializer=_init_worker)
+        try:
+            while True:
+                page = toolkit.get_action('ec_user_list')(self.context,
+                                                          {'skip': skip})
+                # The platform returns the last page again once the end of
+                # the list is reached
+                if not page or page[-1].get('UserId') in seen_ids:
+                    break
+                seen_ids.update(ec_user.get('UserId') for ec_user in page)
+
+                self._import_page(pool, page)
+                skip += len(page)
+
+                elapsed = time.time() - start
+                print 'Processed {0} users ({1:.1f} users/s), resume with ' \
+                    '-s {2}'.format(sum(self.counts.values()),
+                                    sum(self.counts.values()) / elapsed
+                                    if elapsed else 0, skip)
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - start
+        total = sum(self.counts.values())
+        print 'Done in {0:.1f}s ({1:.1f} users/s): {2} created, {3} already ' \
+            'existed, {4} skipped, {5} failed'.format(
+                elapsed, total / elapsed if elapsed else 0,
+                self.counts['created'], self.counts['existing'],
+                self.counts['skipped'], self.counts['failed'])
+
+        if self.counts['failed']:
+            sys.exit(1)
+
+    def _import_page(self, pool, page):
+        user_ids = [ec_user.get('UserId') for ec_user in page
+                    if ec_user.get('UserId')]
+        existing = set(row.id for row in model.Session.query(model.User.id)
+                       .filter(model.User.id.in_(user_ids)))
+
+        new_users = [ec_user for ec_user in page
+                     if ec_user.get('UserId') not in existing]
+        self.counts['existing'] += len(page) - len(new_users)
+
+        self._create_missing_orgs(new_users)
+        model.Session.remove()
+
+        args = [(ec_user, self.site_user) for ec_user in new_users]
+        for ec_user, result, error in pool.imap_unordered(
+                _create_user_isolated, args):
+            self.counts[result] += 1
+            if result == 'created':
+                print 'created user {0}'.format(ec_user.get('UserId'))
+            elif result == 'failed':
+                print 'failed to create user {0}: {1}'.format(
+                    ec_user.get('UserName'), error)
+
+    def _create_missing_orgs(self, ec_users):
+        '''Creates the organizations of a page of users that do not exist
+
+        This is done before creating the users so concurrent workers do not
+        try to create the same organization.
+        '''
+        org_ids = set(ec_user['OrganisationId'] for ec_user in ec_users
+                      if ec_user.get('OrganisationId'))
+        for org_id in org_ids - self.failed_orgs:
+            if not _get_organization_id(org_id):
+                if not create_orgs(org_id, self.site_user):
+                    self.failed_orgs.add(org_id)
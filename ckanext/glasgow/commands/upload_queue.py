@@ -0,0 +1,133 @@
+import sys
+import json
+import time
+import logging
+import datetime
+
+from pylons import config
+
+from ckan import model
+from ckan.lib.cli import CkanCommand
+
+from ckanext.glasgow.logic.action import (send_queued_upload,
+                                          queued_upload_error)
+
+
+log = logging.getLogger(__name__)
+
+
+class UploadQueue(CkanCommand):
+    '''Sends the file uploads queued for the CTPEC platform
+
+    Large uploads (see `ckanext.glasgow.upload_queue_threshold`) are stored
+    in a staging dir and sent in the background by this command.
+
+    Usage:
+
+      upload_queue run
+        - Keep sending queued uploads, checking for new ones every
+          `ckanext.glasgow.upload_queue_poll_interval` seconds (default 10)
+
+      upload_queue process
+        - Send all queued uploads that are due and exit
+
+      upload_queue list
+        - List the queued uploads
+
+    Uploads are sent with the auth token of the user that made them, so
+    the ones still queued when it expires will fail and need to be made
+    again.
+
+    Only one worker should be run at a time.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def command(self):
+
+        self._load_config()
+        if len(self.args) == 0:
+            self.parser.print_usage()
+            sys.exit(1)
+
+        cmd = self.args[0]
+        if cmd == 'run':
+            self._run()
+        elif cmd == 'process':
+            self._process()
+        elif cmd == 'list':
+            self._list()
+        else:
+            print 'Unknown command: {0}'.format(cmd)
+            sys.exit(1)
+
+    def _get_queued_tasks(self):
+        return model.Session.query(model.TaskStatus) \
+            .filter(model.TaskStatus.state == 'uploading') \
+            .order_by(model.TaskStatus.last_updated) \
+            .all()
+
+    def _get_upload(self, task):
+        try:
+            return json.loads(task.value)['upload']
+        except (ValueError, TypeError, KeyError):
+            return None
+
+    def _run(self):
+        interval = int(config.get('ckanext.glasgow.upload_queue_poll_interval',
+                                  10))
+        while True:
+            self._process()
+            time.sleep(interval)
+
+    def _process(self):
+        now = datetime.datetime.now().isoformat()
+        for task in self._get_queued_tasks():
+            upload = self._get_upload(task)
+            if not upload:
+                print 'Task {0} has no upload details'.format(task.id)
+                continue
+            if upload.get('next_attempt') and upload['next_attempt'] > now:
+                continue
+
+            context = {
+                'model': model,
+                'session': model.Session,
+                'ignore_auth': True,
+            }
+            # An unexpected error on one upload should not stop the rest
+            try:
+                task_dict = send_queued_upload(context, task.id)
+            except Exception, e:
+                log.exception('Error sending upload for task {0}'.format(
+                    task.id))
+                print 'Error sending upload for task {0}: {1}'.format(
+                    task.id, e)
+                model.Session.rollback()
+                # Count it as a failed attempt so it is not retried straight
+                # away on every run
+                try:
+                    task_dict = queued_upload_error(
+                        context, task.id, 'Unexpected error: {0}'.format(e))
+                except Exception:
+                    log.exception('Error recording the failed upload for '
+                                  'task {0}'.format(task.id))
+                    model.Session.rollback()
+                    continue
+
+            if task_dict['state'] == 'sent':
+                print 'Sent upload for task {0}'.format(task.id)
+            elif task_dict['state'] == 'error':
+                print 'Upload for task {0} failed'.format(task.id)
+            else:
+                print 'Upload for task {0} will be retried'.format(task.id)
+
+        model.Session.remove()
+
+    def _list(self):
+        for task in self._get_queued_tasks():
+            upload = self._get_upload(task) or {}
+            print '{0} {1} attempts: {2} next attempt: {3}'.format(
+                task.id, upload.get('filename'), upload.get('attempts'),
+                upload.get('next_attempt') or '-')
@@ -0,0 +1,76 @@
+import hmac
+import json
+import time
+import hashlib
+
+from pylons import config
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.glasgow.harvesters.changelog import queue_audits
+
+
+def get_signature(secret, timestamp, body):
+    '''
+    Returns the signature expected for a changelog notification body sent
+    at `timestamp`
+    '''
+    message = '{0}.{1}'.format(timestamp, body)
+    return 'sha256=' + hmac.new(str(secret), message,
+                                hashlib.sha256).hexdigest()
+
+
+class ChangelogController(toolkit.BaseController):
+
+    def notify(self):
+        '''
+        Receives audits pushed by the platform
+
+        The body is a JSON list of audits (or a single one) in the same
+        format returned by the Changelog API. Requests must be signed with
+        the secret set in `ckanext.glasgow.changelog_webhook_secret`, using
+        an HMAC-SHA256 of `<timestamp>.<body>` sent in the
+        `X-CTPEC-Signature` header as `sha256=<hex digest>`, where the
+        timestamp is the Unix time the request was sent, in the
+        `X-CTPEC-Timestamp` header. Requests older (or newer) than
+        `ckanext.glasgow.changelog_webhook_max_age` seconds (default 300)
+        are rejected, so a captured request can not be replayed later. The
+        endpoint is disabled if no secret is set.
+        '''
+        secret = config.get('ckanext.glasgow.changelog_webhook_secret')
+        if not secret:
+            toolkit.abort(404)
+        max_age = int(config.get('ckanext.glasgow.changelog_webhook_max_age',
+                                 300))
+
+        body = toolkit.request.body
+        timestamp = toolkit.request.headers.get('X-CTPEC-Timestamp', '')
+        signature = toolkit.request.headers.get('X-CTPEC-Signature', '')
+        try:
+            sent = int(timestamp)
+        except ValueError:
+            toolkit.abort(403, 'Invalid timestamp')
+        if not hmac.compare_digest(str(signature),
+                                   get_signature(secret, sent, body)):
+            toolkit.abort(403, 'Invalid signature')
+        if abs(time.time() - sent) > max_age:
+            toolkit.abort(403, 'Expired request')
+
+        try:
+            audits = json.loads(body)
+        except ValueError:
+            toolkit.abort(400, 'Invalid JSON')
+        if isinstance(audits, dict):
+            audits = [audits]
+        if (not isinstance(audits, list) or not all(
+                isinstance(audit, dict) and audit.get('AuditId')
+                and audit.get('Command') for audit in audits)):
+            toolkit.abort(400, 'Expected a list of audits')
+
+        result = queue_audits(audits)
+        if result is None:
+            toolkit.abort(503, 'No changelog harvest source')
+
+        toolkit.response.status_int = 202
+        toolkit.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({'queued': result[0], 'skipped': result[1]})
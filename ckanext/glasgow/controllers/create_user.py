@@ -8,6 +8,10 @@ import ckan.plugins.toolkit as toolkit
 import ckan.lib.helpers as helpers
 
 from ckanext.glasgow.logic.action import ECAPINotFound, ECAPINotAuthorized
+from ckanext.glasgow.controllers.request_status import (
+    get_request_statuses,
+    get_tasks_page,
+)
 
 
 Option = collections.namedtuple('Option', ['text', 'value'])
@@ -62,7 +66,8 @@ class CreateUsersController(toolkit.BaseController):
                 'session': model.Session,
                 'user': toolkit.c.user,
             }
-            orgs = toolkit.get_action('organization_list_for_user')(context, {})
+            orgs = toolkit.get_action('organization_list_for_user')(
+                context, {'lightweight': True})
             extra_vars['organisation_names'] = ([o['name'] for o in orgs])
 
         return toolkit.render('create_users/create_users.html', extra_vars=extra_vars)
@@ -117,10 +122,18 @@ class CreateUsersController(toolkit.BaseController):
         except toolkit.NotAuthorized:
             toolkit.abort(401, toolkit._('Need to be organization administrator to see pending users'))
 
-        user_requests = toolkit.get_action('pending_user_tasks')(context, {})
+        try:
+            user_requests, pager = get_tasks_page('pending_user_tasks',
+                                                  context, {})
+        except toolkit.ValidationError, e:
+            helpers.flash_error('{0}'.format(e.error_dict))
+            user_requests, pager = [], None
 
         extra_vars = {
-            'requests': user_requests
+            'requests': user_requests,
+            'request_statuses': get_request_statuses(context, user_requests),
+            'pager': pager,
+            'state': toolkit.request.params.get('state'),
         }
         return toolkit.render('create_users/pending.html', extra_vars=extra_vars)
 
@@ -133,13 +146,20 @@ class CreateUsersController(toolkit.BaseController):
         except toolkit.NotAuthorized:
             toolkit.abort(401, toolkit._('Not authorized to see user updates'))
 
-        requests = toolkit.get_action('pending_user_tasks')(context, {'id': id})
+        try:
+            requests, pager = get_tasks_page('pending_user_tasks', context,
+                                             {'id': id})
+        except toolkit.ValidationError, e:
+            helpers.flash_error('{0}'.format(e.error_dict))
+            requests, pager = [], None
         user = toolkit.get_action('user_show')(context, {'id': id})
 
         toolkit.c.user_dict = user
 
         extra_vars = {
             'requests': requests,
+            'request_statuses': get_request_statuses(context, requests),
             'user': user,
+            'pager': pager,
         }
         return toolkit.render('user/pending_update.html', extra_vars=extra_vars)
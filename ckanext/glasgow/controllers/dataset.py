@@ -1,7 +1,5 @@
 import json
 
-import paste
-
 import ckan.model as model
 import ckan.lib.helpers as helpers
 from ckan.controllers.package import PackageController
@@ -24,6 +22,19 @@ from ckanext.glasgow.logic.action import (
 import ckanext.glasgow.logic.schema as glasgow_schema
 
 
+# Headers from the platform response passed through on approval downloads
+_approval_download_headers = (
+    'Content-Type',
+    'Content-Encoding',
+    'Content-Length',
+    'Content-Disposition',
+    'Content-Range',
+    'Accept-Ranges',
+    'Last-Modified',
+    'ETag',
+)
+
+
 class DatasetController(PackageController):
 
     def read(self, id, format='html'):
@@ -276,11 +287,15 @@ class DatasetController(PackageController):
         except p.toolkit.NotAuthorized:
             return p.toolkit.abort(401, p.toolkit._('Not authorized to view change requests'))
 
+        archived_tasks = p.toolkit.get_action('task_status_archive_list')(
+            context, {'entity_type': 'dataset', 'id': pkg['id'],
+                      'name': pkg['name']})
 
         return p.toolkit.render('package/change_request_list.html',
                                 extra_vars={'pkg_dict': pkg,
                                             'change_request': request_status,
                                             'task': task,
+                                            'archived_tasks': archived_tasks,
                                             })
 
     def approvals(self):
@@ -316,9 +331,13 @@ class DatasetController(PackageController):
 
     def approval_download(self, id):
 
+        data_dict = {
+            'request_id': id,
+            'range': p.toolkit.request.headers.get('Range'),
+            'if_range': p.toolkit.request.headers.get('If-Range'),
+        }
         try:
-            download = p.toolkit.get_action('approval_download')({}, {
-                'request_id': id})
+            download = p.toolkit.get_action('approval_download')({}, data_dict)
         except p.toolkit.ValidationError, e:
             helpers.flash_error('The EC API returned and error: {0}'.format(str(e)))
 
@@ -328,15 +347,12 @@ class DatasetController(PackageController):
             return p.toolkit.abort(403, p.toolkit._('Not authorized to download this file'))
 
         else:
-            headers = []
-            for k, v in download['headers'].iteritems():
-                if k.lower() not in ('transfer-encoding', 'content-encoding'):
-                    headers.append((k, v))
-
-            app = paste.fileapp.DataApp(download['content'], headers=headers)
-
-            status, headers2, app_iter = p.toolkit.request.call_application(app)
-
-            p.toolkit.response.headers.update(headers2)
-
-            return app_iter
+            # The body is streamed to the client as it arrives from the
+            # platform
+            upstream_headers = download['headers']
+            p.toolkit.response.status_int = download['status']
+            for header in _approval_download_headers:
+                if upstream_headers.get(header):
+                    p.toolkit.response.headers[header] = upstream_headers[header]
+
+            return download['content']
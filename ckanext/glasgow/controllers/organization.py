@@ -11,6 +11,10 @@ from ckanext.glasgow.logic.action import (
     ECAPINotAuthorized,
     ECAPIError,
 )
+from ckanext.glasgow.controllers.request_status import (
+    get_request_statuses,
+    get_tasks_page,
+)
 
 
 class OrgController(OrganizationController):
@@ -82,10 +86,18 @@ class OrgController(OrganizationController):
 
         c.group_dict = org
 
+        try:
+            archived_tasks = p.toolkit.get_action('task_status_archive_list')(
+                context, {'entity_type': 'organization', 'id': org['id'],
+                          'name': org['name']})
+        except p.toolkit.NotAuthorized:
+            archived_tasks = []
+
         return p.toolkit.render('organization/change_request_list.html',
                                 extra_vars={'organization': org,
                                             'change_request': request_status,
                                             'task': task,
+                                            'archived_tasks': archived_tasks,
                                             })
 
     def pending_member_requests_list(self, organization_id):
@@ -96,11 +108,15 @@ class OrgController(OrganizationController):
         except p.toolkit.ObjectNotFound:
             return p.toolkit.abort(404, p.toolkit._('Organization not found'))
 
+        tasks = []
+        pager = None
         try:
-            tasks = p.toolkit.get_action('pending_tasks_for_membership')(context,
-                {'name': organization_id, 'organization_id': org['id']})
+            tasks, pager = get_tasks_page('pending_tasks_for_membership',
+                context, {'name': organization_id, 'organization_id': org['id']})
         except ECAPIError, e:
             helpers.flash_error('{0}'.format(e.error_dict['message']))
+        except p.toolkit.ValidationError, e:
+            helpers.flash_error('{0}'.format(e.error_dict))
         except p.toolkit.NotAuthorized:
             return p.toolkit.abort(401, p.toolkit._('Not authorized to view change requests'))
 
@@ -109,6 +125,8 @@ class OrgController(OrganizationController):
         return p.toolkit.render('organization/membership_requests.html',
                                 extra_vars={'organization': org,
                                             'tasks': tasks,
+                                            'request_statuses': get_request_statuses(context, tasks),
+                                            'pager': pager,
                                             })
 
     def member_delete(self, id):
@@ -1,6 +1,7 @@
 import datetime
 
 import sqlalchemy
+from pylons import config
 
 import ckan.model as model
 from ckan.plugins import toolkit
@@ -11,6 +12,65 @@ from ckanext.glasgow.logic.action import (
 )
 from ckanext.glasgow.harvesters import get_task_for_request_id
 
+
+def get_request_statuses(context, tasks):
+    '''Returns the platform status for all the provided tasks at once
+
+    `tasks` are task status dicts with their value already parsed. The
+    returned dict has request ids as keys and the latest change for each
+    request as value.
+    '''
+    request_ids = [task['value'].get('request_id') for task in tasks
+                   if isinstance(task.get('value'), dict)
+                   and task['value'].get('request_id')]
+    if not request_ids:
+        return {}
+
+    try:
+        statuses = toolkit.get_action('request_status_batch')(
+            context.copy(), {'request_ids': request_ids})
+    except ECAPIError, e:
+        helpers.flash_error('Error fetching request statuses from CTPEC Platform: {0}'.format(str(e)))
+        return {}
+    except toolkit.NotAuthorized:
+        return {}
+
+    return dict((request_id, changes[-1])
+                for request_id, changes in statuses.iteritems() if changes)
+
+
+def get_tasks_page(action_name, context, data_dict):
+    '''Returns a page of tasks from one of the pending tasks actions
+
+    The page number and state filter are read from the `page` and `state`
+    request params. One more task than the page size
+    (`ckanext.glasgow.pending_tasks_page_size`, default 20) is requested to
+    know if there is a next page, so no counts are needed.
+
+    :returns: a tuple with the list of tasks and a pager dict for the
+        `snippets/tasks_pager.html` snippet
+    '''
+    page_size = int(config.get('ckanext.glasgow.pending_tasks_page_size', 20))
+    try:
+        page = max(1, int(toolkit.request.params.get('page', 1)))
+    except ValueError:
+        page = 1
+
+    data_dict = dict(data_dict, limit=page_size + 1,
+                     offset=(page - 1) * page_size)
+    if toolkit.request.params.get('state'):
+        data_dict['state'] = toolkit.request.params['state']
+
+    tasks = toolkit.get_action(action_name)(context, data_dict)
+
+    pager = {
+        'page': page,
+        'has_previous': page > 1,
+        'has_next': len(tasks) > page_size,
+    }
+    return tasks[:page_size], pager
+
+
 class RequestStatusController(toolkit.BaseController):
     def get_status(self, request_id):
         context = {
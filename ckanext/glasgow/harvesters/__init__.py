@@ -1,11 +1,22 @@
+import copy
+from collections import OrderedDict
+
 import slugify
 
 from ckan import plugins as p
 from ckan import model
+from ckan.model import PACKAGE_NAME_MAX_LENGTH
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 
 from ckanext.glasgow.logic.action import _expire_task_status
+from ckanext.glasgow.model import get_archived_tasks, get_tasks_for_request_ids
+
+
+# Number of harvest jobs whose shared objects are kept at the same time, eg
+# when the audits of lane and notification jobs are imported by the same
+# consumer
+job_objects_cache_size = 10
 
 
 class EcHarvester(HarvesterBase):
@@ -38,6 +49,210 @@ class EcHarvester(HarvesterBase):
 
         return self._user_name
 
+    def _get_job_objects(self, job_id):
+        '''
+        Returns the objects shared by all the imports of a harvest job
+
+        They are created the first time they are needed for a job (or when
+        the job gathering starts). The objects of the last
+        `job_objects_cache_size` jobs used are kept, so imports of
+        interleaved jobs do not start them again.
+        '''
+        if getattr(self, '_job_objects', None) is None:
+            self._job_objects = OrderedDict()
+
+        job_objects = self._job_objects.pop(job_id, None)
+        if job_objects is None:
+            job_objects = {
+                'name_allocator': DatasetNameAllocator(),
+                'lookup_cache': JobLookupCache(self._get_user_name),
+            }
+            while len(self._job_objects) >= job_objects_cache_size:
+                self._job_objects.popitem(last=False)
+        # Most recently used last
+        self._job_objects[job_id] = job_objects
+        return job_objects
+
+    def _get_name_allocator(self, harvest_object):
+        '''
+        Returns the dataset name allocator for the harvest object job
+
+        A new allocator (and so a fresh list of existing names) is used for
+        each harvest job.
+        '''
+        return self._get_job_objects(
+            harvest_object.harvest_job_id)['name_allocator']
+
+    def _get_lookup_cache(self, harvest_object):
+        '''Returns the `JobLookupCache` for the harvest object job'''
+        return self._get_job_objects(
+            harvest_object.harvest_job_id)['lookup_cache']
+
+
+class DatasetNameAllocator(object):
+    '''
+    Allocates names for harvested datasets
+
+    The existing dataset names that could clash with a title are loaded
+    with a single query the first time the title comes up, and the names
+    allocated are reserved, so two datasets with the same title in the same
+    harvest job get different names without querying the database for each
+    one.
+    '''
+
+    # Characters of the name kept in front of the longest suffix expected
+    # ('-' and the organization id, or a counter)
+    _prefix_length = PACKAGE_NAME_MAX_LENGTH - 10
+
+    def __init__(self):
+        self._names = set()
+        self._names_by_id = {}
+        self._loaded_prefixes = set()
+
+    def _load(self, prefix):
+        if prefix in self._loaded_prefixes:
+            return
+        # Slugs have no LIKE wildcards
+        query = model.Session.query(model.Package.id, model.Package.name) \
+            .filter(model.Package.name.like(prefix + '%'))
+        for package_id, name in query:
+            self._names.add(name)
+            self._names_by_id[package_id] = name
+        self._loaded_prefixes.add(prefix)
+
+    def get_existing_name(self, package_id):
+        '''Returns the name of an existing dataset, or None'''
+        if package_id not in self._names_by_id:
+            package = model.Session.query(model.Package.name) \
+                .filter(model.Package.id == package_id) \
+                .first()
+            self._names_by_id[package_id] = package.name if package else None
+        return self._names_by_id[package_id]
+
+    def allocate(self, data_dict, field='title'):
+        '''
+        Returns an unused name for a new dataset and reserves it
+
+        The slugified title is used if free, otherwise the first characters
+        of the organization id are appended to it, and then a counter.
+        '''
+        base_name = slugify.slugify(data_dict[field])[:PACKAGE_NAME_MAX_LENGTH]
+        self._load(base_name[:self._prefix_length])
+        name = base_name
+
+        org_id = data_dict.get('owner_org')
+        if name in self._names and org_id:
+            base_name = '-'.join([base_name[:PACKAGE_NAME_MAX_LENGTH - 5],
+                                  str(org_id)[:4]])
+            name = base_name
+
+        counter = 1
+        while name in self._names:
+            counter += 1
+            suffix = '-{0}'.format(counter)
+            name = base_name[:PACKAGE_NAME_MAX_LENGTH - len(suffix)] + suffix
+
+        self._names.add(name)
+        if data_dict.get('id'):
+            self._names_by_id[data_dict['id']] = name
+
+        return name
+
+
+class JobLookupCache(object):
+    '''
+    Caches the users, organizations and datasets looked up during a job
+
+    The same objects come up in many of the audits of a changelog job, so
+    they are only requested once. Handlers that change a dataset or an
+    organization store the version returned by the action with the
+    `remember_*` methods, so the next audit of the job does not request it
+    again, or call the `forget_*` methods if they do not have it (eg after
+    changing the organization members). Platform users are cached as they
+    are returned by the platform, which always returns their current
+    details.
+    '''
+
+    def __init__(self, get_site_user_name=None):
+        self._get_site_user_name = get_site_user_name
+        self._site_user_name = None
+        self._user_names = {}
+        self._ec_users = {}
+        self._organizations = {}
+        self._datasets = {}
+
+    def _get_context(self):
+        return {
+            'model': model,
+            'ignore_auth': True,
+            'local_action': True,
+            # The search index is not updated until the changes are
+            # committed
+            'use_cache': False,
+        }
+
+    def get_site_user_name(self):
+        if self._site_user_name is None:
+            self._site_user_name = self._get_site_user_name()
+        return self._site_user_name
+
+    def get_user_name(self, name_or_id):
+        '''Returns the name of a CKAN user given its name or id, or None'''
+        if name_or_id not in self._user_names:
+            user = model.User.get(name_or_id)
+            self._user_names[name_or_id] = user.name if user else None
+        return self._user_names[name_or_id]
+
+    def forget_user(self, *names_or_ids):
+        for name_or_id in names_or_ids:
+            self._user_names.pop(name_or_id, None)
+
+    def get_ec_user(self, context, username):
+        if username not in self._ec_users:
+            self._ec_users[username] = p.toolkit.get_action('ec_user_show')(
+                context, {'ec_username': username})
+        return copy.deepcopy(self._ec_users[username])
+
+    def get_organization(self, org_id):
+        '''Returns the dict of an organization, as `organization_show` does
+
+        Raises ObjectNotFound if it does not exist
+        '''
+        if org_id not in self._organizations:
+            self._organizations[org_id] = p.toolkit.get_action(
+                'organization_show')(self._get_context(), {'id': org_id})
+        return copy.deepcopy(self._organizations[org_id])
+
+    def remember_organization(self, org_dict):
+        self._organizations[org_dict['id']] = copy.deepcopy(org_dict)
+
+    def forget_organization(self, *org_ids):
+        for org_id in org_ids:
+            self._organizations.pop(org_id, None)
+
+    def get_dataset(self, dataset_id):
+        '''Returns the dict of a dataset, as `package_show` does
+
+        Raises ObjectNotFound if it does not exist
+        '''
+        if dataset_id not in self._datasets:
+            self._datasets[dataset_id] = p.toolkit.get_action(
+                'package_show')(self._get_context(), {'id': dataset_id})
+        return copy.deepcopy(self._datasets[dataset_id])
+
+    def remember_dataset(self, dataset_dict):
+        self._datasets[dataset_dict['id']] = copy.deepcopy(dataset_dict)
+
+    def forget_dataset(self, dataset_id):
+        self._datasets.pop(dataset_id, None)
+
+    def clear(self):
+        '''Forgets all the cached objects'''
+        self._user_names = {}
+        self._ec_users = {}
+        self._organizations = {}
+        self._datasets = {}
+
 
 def get_initial_dataset_name(data_dict, field='title'):
 
@@ -94,15 +309,19 @@ def get_dataset_name_from_task(context, audit_dict):
 
         return name
 
+    # The task may have been archived already
+    archived_tasks = get_archived_tasks(request_ids=[request_id], limit=1)
+    if archived_tasks:
+        name = archived_tasks[0].key
+        if name and '@' in name:
+            name = name.split('@')[0]
+        return name
+
     return
 
 
 def get_task_for_request_id(context, request_id):
 
-    model = context['model']
-
-    task = model.Session.query(model.TaskStatus) \
-        .filter(model.TaskStatus.value.like('%{0}%'.format(request_id))) \
-        .first()
+    tasks = get_tasks_for_request_ids([request_id])
 
-    return task
+    return tasks[0][1] if tasks else None
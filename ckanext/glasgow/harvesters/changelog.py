@@ -3,19 +3,41 @@ import json
 import hashlib
 import datetime
 import uuid
+import itertools
+from collections import OrderedDict
 
 from pylons import config
 import requests
+from sqlalchemy import or_
 
 from ckan import plugins as p
 from ckan import model
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import (
+    HarvestSource,
+    HarvestJob,
+    HarvestObject,
+    HarvestObjectExtra,
+    HarvestObjectError,
+)
+from ckanext.harvest.queue import get_fetch_publisher
 
-from ckanext.glasgow.logic.action import _get_api_endpoint, _expire_task_status
+from ckanext.glasgow.logic.action import (
+    _get_api_endpoint,
+    _iter_changelog,
+    _expire_task_status,
+    _get_organization_id,
+)
 
 import ckanext.glasgow.logic.schema as custom_schema
-from ckanext.glasgow.model import HarvestLastAudit
+from ckanext.glasgow.locks import AdvisoryLocks, advisory_lock
+from ckanext.glasgow.model import (
+    HarvestLastAudit,
+    mark_audit_processed,
+    get_processed_audit_ids,
+    defer_audit,
+    pop_deferred_audits,
+)
 from ckanext.glasgow.harvesters import (
     EcHarvester,
     get_dataset_name_from_task,
@@ -23,21 +45,388 @@ from ckanext.glasgow.harvesters import (
     get_dataset_name_from_id,
     get_task_for_request_id,
     get_org_name,
+    JobLookupCache,
 )
 
 
 log = logging.getLogger(__name__)
 
 
-def save_last_audit_id(audit_id, harvest_job_id=None):
+# Maximum number of audits requested to the platform by each job
+changelog_page_size = 1000
+
+
+# Audits that can be imported in batches (see
+# `ckanext.glasgow.changelog_batch_size`). Their handlers only call actions
+# that honour `defer_commit`. Organization and user audits are always
+# imported on their own, as the core member actions commit the Session.
+batchable_commands = (
+    'CreateDataSet',
+    'UpdateDataSet',
+    'CreateFile',
+    'UpdateFile',
+    'DeleteFileVersion',
+)
+
+
+# Object types that can be harvested in a lane of their own, ie by a
+# changelog source with an `object_type` config option. Each lane has its
+# own audit cursor, and the default lane (sources without `object_type`)
+# harvests the audits of the rest of types.
+changelog_object_types = ('Dataset', 'File', 'Organisation')
+
+# Audits that need an object harvested by another lane, see
+# `get_missing_dependency`
+file_commands = ('CreateFile', 'UpdateFile', 'DeleteFileVersion')
+dataset_commands = ('CreateDataSet', 'UpdateDataSet')
+
+# Held while reading and moving the audit cursor, so only one job gathers
+# audits at a time (per lane)
+changelog_gather_lock = 'ckanext.glasgow.changelog_gather'
+
+
+def get_gather_lock_name(object_type=None):
+    if object_type is None:
+        return changelog_gather_lock
+    return '{0}.{1}'.format(changelog_gather_lock, object_type)
+
+
+def get_source_object_type(source):
+    '''Returns the object type of a changelog source lane, or None'''
+    try:
+        source_config = json.loads(source.config or '{}')
+    except ValueError:
+        return None
+    if not isinstance(source_config, dict):
+        return None
+    return source_config.get('object_type') or None
+
+
+def get_changelog_sources():
+    '''
+    Returns the active changelog sources, keyed by their lane object type
+    (None for the default lane)
+    '''
+    query = model.Session.query(HarvestSource) \
+        .filter(HarvestSource.type == 'ec_changelog_harvester') \
+        .filter(HarvestSource.active == True) \
+        .order_by(HarvestSource.created)
+
+    sources = {}
+    for source in query:
+        sources.setdefault(get_source_object_type(source), source)
+    return sources
+
+
+def get_missing_dependency(audit):
+    '''
+    Returns a message if the object an audit belongs to has not been
+    harvested yet, or None
+
+    Files need their dataset and datasets their organization. When lanes
+    are used they can arrive after the audits that need them.
+    '''
+    properties = audit.get('CustomProperties')
+    if not isinstance(properties, dict):
+        return None
+
+    command = audit.get('Command')
+    if command in file_commands:
+        dataset_id = properties.get('DataSetId')
+        if dataset_id and not model.Session.query(model.Package.id) \
+                .filter(model.Package.id == dataset_id) \
+                .filter(model.Package.state == 'active') \
+                .first():
+            return 'Dataset {0} not harvested yet'.format(dataset_id)
+    elif command in dataset_commands:
+        org_id = properties.get('OrganisationId')
+        if org_id and not _get_organization_id(org_id):
+            return 'Organization {0} not harvested yet'.format(org_id)
+    return None
+
+
+def get_audit_lock_name(audit):
+    '''
+    Returns the name of the lock held while importing an audit
+
+    Audits changing the same object (file audits change their dataset) use
+    the same lock, so they are never imported at the same time by two
+    workers. Audits of different objects can be imported in parallel.
+    '''
+    properties = audit.get('CustomProperties')
+    if not isinstance(properties, dict):
+        properties = {}
+    for key, object_type in (('DataSetId', 'dataset'),
+                             ('UserName', 'user'),
+                             ('UserId', 'user'),
+                             ('OrganisationId', 'organization')):
+        if properties.get(key):
+            return 'ckanext.glasgow.changelog_object.{0}.{1}'.format(
+                object_type, unicode(properties[key]).lower())
+    return 'ckanext.glasgow.changelog_object.audit.{0}'.format(
+        audit.get('AuditId'))
+
+
+def _get_lookup_cache(context):
+    '''Returns the job lookup cache, or a new one if not running in a job'''
+    return context.get('lookup_cache') or JobLookupCache()
+
+
+def _commit(context):
+    '''
+    Commits the Session, or only flushes it if commits are deferred
+
+    Commits are deferred when importing a batch of audits, flushing makes
+    sure errors are still raised while importing the audit that caused
+    them.
+    '''
+    if context.get('defer_commit'):
+        model.Session.flush()
+    else:
+        model.Session.commit()
+
+
+def _discard_rolled_back_objects():
+    '''
+    Removes the objects of a rolled back savepoint from the objects CKAN
+    notifies (eg to the search index) when the Session is committed
+    '''
+    session = model.Session()
+    object_cache = getattr(session, '_object_cache', None)
+    if not object_cache:
+        return
+    for objects in object_cache.values():
+        for obj in list(objects):
+            if obj not in session:
+                objects.discard(obj)
+
+
+def _reset_revision():
+    '''
+    Forgets the vdm revision of a rolled back savepoint
+
+    The revision created by the rolled back audit is no longer in the
+    Session, so it must not be used for the changes of the next ones.
+    '''
+    session = model.Session()
+    for attr in ('revision', 'revision_id'):
+        if hasattr(session, attr):
+            delattr(session, attr)
+
+
+class HarvestObjectWriter(object):
+    '''
+    Saves the harvest objects for the audits of a changelog job
+
+    Objects are flushed as they are written, so the Session does not keep
+    them in memory, and committed all at once by `close`. If writing fails
+    half way (eg the changelog response is cut short) rolling back the
+    Session leaves no objects behind. If `batch_size` is bigger than 1, the
+    batchable audits queued are grouped in batch objects, whose content is
+    the list of the audit object ids. All the audits of a batch are
+    imported in a single transaction.
+    '''
+
+    def __init__(self, harvest_job, batch_size=1):
+        self.harvest_job = harvest_job
+        self.batch_size = batch_size
+        self._ids = []
+        self._batch = []
+
+    def write(self, audit, extras=None):
+        '''Saves a harvest object for an audit and returns its id'''
+        obj = HarvestObject(guid=audit['AuditId'], job=self.harvest_job,
+                            content=json.dumps(audit))
+        obj.extras.append(HarvestObjectExtra(
+            key='audit_id', value=unicode(audit['AuditId'])))
+        for key, value in (extras or {}).iteritems():
+            obj.extras.append(HarvestObjectExtra(key=key,
+                                                 value=unicode(value)))
+        model.Session.add(obj)
+        model.Session.flush()
+        return obj.id
+
+    def replace(self, object_id, audit):
+        '''Replaces the audit of an object already written'''
+        model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id == object_id) \
+            .update({'guid': audit['AuditId'],
+                     'content': json.dumps(audit)},
+                    synchronize_session=False)
+        model.Session.query(HarvestObjectExtra) \
+            .filter(HarvestObjectExtra.harvest_object_id == object_id) \
+            .filter(HarvestObjectExtra.key == 'audit_id') \
+            .update({'value': unicode(audit['AuditId'])},
+                    synchronize_session=False)
+
+    def queue(self, object_id, command):
+        '''Adds an object to the ones returned by `close`'''
+        if self.batch_size > 1 and command in batchable_commands:
+            self._batch.append(object_id)
+            if len(self._batch) == self.batch_size:
+                self._write_batch()
+        else:
+            self._ids.append(object_id)
+
+    def _write_batch(self):
+        obj = HarvestObject(guid='batch-{0}'.format(self._batch[0]),
+                            job=self.harvest_job,
+                            content=json.dumps(self._batch))
+        model.Session.add(obj)
+        model.Session.flush()
+        self._ids.append(obj.id)
+        self._batch = []
+
+    def close(self):
+        '''Commits the objects written and returns the ids to import'''
+        if self._batch:
+            self._write_batch()
+        model.Session.commit()
+        return self._ids
+
+
+def _get_batch_size():
+    return int(config.get('ckanext.glasgow.changelog_batch_size', 1))
+
+
+def is_webhook_enabled():
+    return bool(config.get('ckanext.glasgow.changelog_webhook_secret'))
+
+
+def get_queued_audit_ids(audit_ids):
+    '''
+    Returns the ids of the audits that already have a harvest object
+    waiting to be imported or imported successfully
+
+    Audits whose object failed are not returned, so they are harvested
+    again. Neither are the ones whose object has not been imported after
+    `ckanext.glasgow.changelog_queued_audit_timeout` seconds (default
+    3600), as it was probably lost on the way.
+
+    Audit ids are returned as strings.
+    '''
+    audit_ids = [unicode(audit_id) for audit_id in audit_ids]
+    if not audit_ids:
+        return set()
+
+    timeout = int(config.get('ckanext.glasgow.changelog_queued_audit_timeout',
+                             3600))
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+
+    query = model.Session.query(HarvestObjectExtra.value) \
+        .join(HarvestObject,
+              HarvestObject.id == HarvestObjectExtra.harvest_object_id) \
+        .filter(HarvestObjectExtra.key == 'audit_id') \
+        .filter(HarvestObjectExtra.value.in_(audit_ids)) \
+        .filter(HarvestObject.state != u'ERROR') \
+        .filter(or_(HarvestObject.state == u'COMPLETE',
+                    HarvestObject.gathered >= since))
+
+    return set(row[0] for row in query)
+
+
+def _iter_new_audits(audits, chunk_size, skip_queued=False):
+    '''
+    Yields (audit, skip) tuples, where skip is True for audits already
+    imported (or already queued, if `skip_queued` is True)
+
+    Audits are checked in chunks of `chunk_size`.
+    '''
+    def check(chunk):
+        audit_ids = [audit['AuditId'] for audit in chunk]
+        skip_ids = get_processed_audit_ids(audit_ids)
+        if skip_queued:
+            skip_ids |= get_queued_audit_ids(audit_ids)
+        return [(audit, unicode(audit['AuditId']) in skip_ids)
+                for audit in chunk]
+
+    chunk = []
+    for audit in audits:
+        chunk.append(audit)
+        if len(chunk) == chunk_size:
+            for item in check(chunk):
+                yield item
+            chunk = []
+    if chunk:
+        for item in check(chunk):
+            yield item
+
+
+def queue_audits(audits):
+    '''
+    Queues audits pushed by the platform for import
+
+    A new job is created for the changelog harvest source and the audits
+    that were not already imported or queued (by a previous notification
+    or by the changelog harvest job) are sent straight to the fetch queue,
+    so they are imported by the harvester like any other audit. If lanes
+    are used, audits are queued on the source of their lane.
+
+    :param audits: list of audits, as returned by `changelog_show`
+    :returns: a tuple with the number of audits queued and skipped, or
+        None if there is no active changelog harvest source for the
+        default lane
+    '''
+    sources = get_changelog_sources()
+    if None not in sources:
+        return None
+
+    # Also drop duplicates within the notification
+    audit_ids = [audit['AuditId'] for audit in audits]
+    queued = (get_queued_audit_ids(audit_ids) |
+              get_processed_audit_ids(audit_ids))
+    new_audits = []
+    for audit in audits:
+        audit_id = unicode(audit['AuditId'])
+        if audit_id not in queued:
+            queued.add(audit_id)
+            new_audits.append(audit)
+
+    if new_audits:
+        lane_audits = OrderedDict()
+        for audit in new_audits:
+            source = sources.get(audit.get('ObjectType')) or sources[None]
+            lane_audits.setdefault(source, []).append(audit)
+
+        ids = []
+        now = datetime.datetime.utcnow()
+        for source, source_audits in lane_audits.iteritems():
+            job = HarvestJob(source=source, status=u'Running',
+                             gather_started=now, gather_finished=now)
+            model.Session.add(job)
+
+            writer = HarvestObjectWriter(job, batch_size=_get_batch_size())
+            for audit in source_audits:
+                writer.queue(writer.write(audit), audit['Command'])
+            ids.extend(writer.close())
+
+        publisher = get_fetch_publisher()
+        for object_id in ids:
+            publisher.send({'harvest_object_id': object_id})
+        publisher.close()
+
+        log.debug('Queued {0} audits pushed by the platform'.format(
+            len(new_audits)))
+
+    return len(new_audits), len(audits) - len(new_audits)
+
+
+def save_last_audit_id(audit_id, harvest_job_id=None, audit_count=None,
+                       object_type=None):
 
     new_last_audit = HarvestLastAudit(
         audit_id=audit_id,
         harvest_job_id=harvest_job_id,
+        audit_count=audit_count,
+        object_type=object_type,
     )
     new_last_audit.save()
 
 
+def _get_max_deferrals():
+    return int(config.get('ckanext.glasgow.changelog_lane_max_deferrals', 10))
+
+
 class EcChangelogHarvester(EcHarvester):
 
     force_import = False
@@ -51,87 +440,298 @@ class EcChangelogHarvester(EcHarvester):
 
         }
 
-    def get_username_from_audit(self, audit):
+    def get_username_from_audit(self, audit, lookup_cache=None):
+        lookup_cache = lookup_cache or JobLookupCache(self._get_user_name)
         username = audit.get('Owner', None)
         if username:
             username = username.lower()
-            try:
-                context = {
-                    'model': model,
-                    'ignore_auth': True,
-                    'local_action': True,
-                }
-                p.toolkit.get_action('user_show')(context, {'id': username})
-            except p.toolkit.ObjectNotFound:
-                username = self._get_user_name()
+            if not lookup_cache.get_user_name(username):
+                username = lookup_cache.get_site_user_name()
         else:
-            username = self._get_user_name()
+            username = lookup_cache.get_site_user_name()
         return username
 
+    def validate_config(self, config):
+        if not config:
+            return config
+
+        try:
+            source_config = json.loads(config)
+        except ValueError:
+            raise ValueError('Configuration must be a JSON object')
+        if not isinstance(source_config, dict):
+            raise ValueError('Configuration must be a JSON object')
+
+        object_type = source_config.get('object_type')
+        if object_type and object_type not in changelog_object_types:
+            raise ValueError('object_type must be one of: {0}'.format(
+                ', '.join(changelog_object_types)))
+
+        return config
+
+    def _get_job_lanes(self, harvest_job_id):
+        '''
+        Returns the object type of the lane of a job (None for the default
+        lane) and the object types with a lane of their own
+        '''
+        job_objects = self._get_job_objects(harvest_job_id)
+        if 'lanes' not in job_objects:
+            job = model.Session.query(HarvestJob).get(harvest_job_id)
+            object_type = get_source_object_type(job.source) if job else None
+            lane_types = set(object_type for object_type
+                             in get_changelog_sources() if object_type)
+            job_objects['lanes'] = (object_type, lane_types)
+        return job_objects['lanes']
+
     def gather_stage(self, harvest_job):
         log.debug('In ChangelogHarvester gather_stage')
 
-        # Get the last harvested AuditId
+        # Start with fresh caches for the new job
+        self._get_job_objects(harvest_job.id)
+        object_type, lane_types = self._get_job_lanes(harvest_job.id)
+
+        # Another job of the lane (or the changelog_audit command) is
+        # already using the audit cursor, and would gather the same audits
+        with advisory_lock(get_gather_lock_name(object_type)) as acquired:
+            if not acquired:
+                log.info('Changelog audits are being gathered by another '
+                         'job, skipping')
+                return []
+            try:
+                return self._gather_audits(harvest_job, object_type,
+                                           lane_types)
+            except Exception:
+                # Nothing is committed until all the audits have been read,
+                # so the job is left without objects and the cursor where it
+                # was
+                model.Session.rollback()
+                raise
+
+    def _gather_audits(self, harvest_job, object_type, lane_types):
+
+        # Get the last harvested AuditId of the lane
         last_audit = model.Session.query(HarvestLastAudit) \
+            .filter(HarvestLastAudit.object_type == object_type) \
             .order_by(HarvestLastAudit.created.desc()) \
             .first()
 
+        # A new lane starts where the default lane was when the lane source
+        # was added, as the default lane skips its audits from then on
+        if not last_audit and object_type:
+            last_audit = model.Session.query(HarvestLastAudit) \
+                .filter(HarvestLastAudit.object_type == None) \
+                .filter(HarvestLastAudit.created <=
+                        harvest_job.source.created) \
+                .order_by(HarvestLastAudit.created.desc()) \
+                .first()
+            if last_audit:
+                log.info('Starting {0} lane from audit {1}'.format(
+                    object_type, last_audit.audit_id))
+
         if last_audit:
             audit_id = last_audit.audit_id
         else:
             audit_id = '0'
 
-        # Get all Audits
-        audits = p.toolkit.get_action('changelog_show')(
-            {'ignore_auth': True},
-            {'audit_id': audit_id, 'top': 1000})
-
-        # Check if there are any new audits to process
-        if not len(audits) or (
-           len(audits) == 1 and
-           audits[0]['AuditId'] == audit_id):
-            log.debug(
-                'No new audits to process since last run ' +
-                '(Last audit id {0})'.format(audit_id))
-            return []
-
-        # Ignore the first audit if an audit id was defined as start,
-        # as this one will be included in the results
-        audits = audits[1:] if audit_id != '0' and len(audits) > 1 else audits
-
-        ids = []
-        update_audits = {}
-        for audit in audits:
+        # Audits are parsed and flushed as they are read, so only the ids of
+        # the objects created are kept in memory
+        data_dict = {'audit_id': audit_id, 'top': changelog_page_size}
+        if object_type:
+            data_dict['object_type'] = object_type
+        audits = _iter_changelog({'model': model, 'ignore_auth': True},
+                                 data_dict)
+
+        chunk_size = int(config.get(
+            'ckanext.glasgow.changelog_gather_chunk_size', 100))
+        writer = HarvestObjectWriter(harvest_job,
+                                     batch_size=_get_batch_size())
+
+        # Ignore the first audit if an audit id was defined as start, as
+        # this one will be included in the results (unless it belongs to
+        # another lane)
+        if audit_id != '0':
+            first_audit = next(audits, None)
+            if (first_audit is not None
+                    and unicode(first_audit['AuditId']) != unicode(audit_id)):
+                audits = itertools.chain([first_audit], audits)
+
+        # Audits deferred by the previous jobs of the lane are retried first
+        retried = 0
+        for audit, attempts in pop_deferred_audits(object_type):
+            writer.queue(writer.write(audit, {'deferred_attempts': attempts}),
+                         audit['Command'])
+            retried += 1
+
+        # Audits pushed by the platform might already be queued
+        skip_queued = is_webhook_enabled()
+
+        # The default lane leaves the types with a lane of their own
+        if object_type is None:
+            skip_types = lane_types
+        else:
+            skip_types = set()
+
+        last_audit_id = None
+        audit_count = 0
+        update_objects = OrderedDict()
+        for audit, skip in _iter_new_audits(audits, chunk_size, skip_queued):
+            last_audit_id = audit['AuditId']
+            audit_count += 1
+            if skip or audit.get('ObjectType') in skip_types:
+                continue
             # We only want to use the most recent update per object per run
             # Store the most recent audit against a hash of the id fields
             if 'update' in audit['Command'].lower():
                 m = hashlib.md5()
                 m.update(json.dumps(audit['CustomProperties']))
                 ids_hash = m.hexdigest()
-                update_audits[ids_hash] = audit
+                if ids_hash in update_objects:
+                    writer.replace(update_objects[ids_hash][0], audit)
+                else:
+                    update_objects[ids_hash] = (writer.write(audit),
+                                                audit['Command'])
             else:
-                obj = HarvestObject(guid=audit['AuditId'], job=harvest_job,
-                                    content=json.dumps(audit))
-                obj.save()
-                ids.append(obj.id)
+                writer.queue(writer.write(audit), audit['Command'])
+
+        # Check if there are any new audits to process
+        if last_audit_id is None and not retried:
+            log.debug(
+                'No new audits to process since last run ' +
+                '(Last audit id {0})'.format(audit_id))
 
-        # Save the last AuditId to know where to start in the next run
-        save_last_audit_id(audit['AuditId'], harvest_job.id)
+        # Updates are imported after the rest of audits
+        for object_id, command in update_objects.itervalues():
+            writer.queue(object_id, command)
 
-        for key, audit in update_audits.iteritems():
-            obj = HarvestObject(guid=audit['AuditId'], job=harvest_job,
-                                content=json.dumps(audit))
-            obj.save()
-            ids.append(obj.id)
+        # Save the last AuditId to know where to start in the next run,
+        # committed along with the objects. Jobs without new audits keep
+        # the previous one, but still record that they got none so the
+        # scheduler can back off.
+        model.Session.add(HarvestLastAudit(
+            audit_id=last_audit_id if last_audit_id is not None
+            else audit_id,
+            harvest_job_id=harvest_job.id,
+            audit_count=audit_count,
+            object_type=object_type,
+        ))
 
-        return ids
+        return writer.close()
 
     def fetch_stage(self, harvest_object):
         return True
 
     def import_stage(self, harvest_object):
 
-        audit = json.loads(harvest_object.content)
+        content = json.loads(harvest_object.content)
+
+        # The object locks are held until the audits are committed, and
+        # audits imported by another worker in the meantime are skipped
+        with AdvisoryLocks() as locks:
+            if isinstance(content, list):
+                return self._import_batch(harvest_object, content, locks)
+
+            locks.acquire(get_audit_lock_name(content), wait=True)
+            if get_processed_audit_ids([content['AuditId']]):
+                log.debug('Audit "{0}" already imported, skipping'.format(
+                    content['AuditId']))
+                return True
+
+            if self._defer_audit(harvest_object, content):
+                model.Session.commit()
+                return True
+
+            return self._import_audit(harvest_object, content)
+
+    def _defer_audit(self, harvest_object, audit):
+        '''
+        Defers an audit if lanes are used and it needs an object that has
+        not been harvested yet by another lane
+
+        The audit is queued again by the next job of its lane, up to
+        `ckanext.glasgow.changelog_lane_max_deferrals` times (default 10),
+        then it is imported anyway. Changes are not committed.
+
+        :returns: True if the audit was deferred
+        '''
+        object_type, lane_types = self._get_job_lanes(
+            harvest_object.harvest_job_id)
+        if not lane_types:
+            return False
+
+        reason = get_missing_dependency(audit)
+        if not reason:
+            return False
+
+        attempts = int(self._get_object_extra(harvest_object,
+                                              'deferred_attempts') or 0)
+        if attempts >= _get_max_deferrals():
+            return False
+
+        log.info('Deferring audit "{0}": {1}'.format(audit['AuditId'],
+                                                     reason))
+        defer_audit(audit, object_type, reason, attempts + 1)
+        return True
+
+    def _import_batch(self, batch_object, object_ids, locks):
+        '''
+        Imports the audits of a batch object in a single transaction
+
+        Each audit is imported inside a savepoint, so an audit that fails
+        is rolled back and recorded as an error on its own harvest object
+        without affecting the rest of the batch, which is committed once
+        at the end.
+        '''
+        log.debug('Import stage for batch of {0} audits'.format(
+            len(object_ids)))
+
+        objects = dict(
+            (obj.id, obj) for obj in model.Session.query(HarvestObject)
+            .filter(HarvestObject.id.in_(object_ids)))
+        audits = dict((object_id, json.loads(obj.content))
+                      for object_id, obj in objects.iteritems())
+
+        locks.acquire_all(get_audit_lock_name(audit)
+                          for audit in audits.itervalues())
+        processed = get_processed_audit_ids(
+            [audit['AuditId'] for audit in audits.itervalues()])
+
+        errors = 0
+        for object_id in object_ids:
+            harvest_object = objects.get(object_id)
+            if not harvest_object:
+                continue
+            harvest_object.import_started = datetime.datetime.utcnow()
+            audit = audits[object_id]
+            if unicode(audit['AuditId']) in processed:
+                log.debug('Audit "{0}" already imported, skipping'.format(
+                    audit['AuditId']))
+                harvest_object.state = 'COMPLETE'
+            elif self._defer_audit(harvest_object, audit):
+                harvest_object.state = 'COMPLETE'
+            elif self._import_audit(harvest_object, audit, batched=True):
+                harvest_object.state = 'COMPLETE'
+            else:
+                harvest_object.state = 'ERROR'
+                errors += 1
+            harvest_object.import_finished = datetime.datetime.utcnow()
+
+        try:
+            model.Session.commit()
+        except Exception:
+            # Do not leave the audit objects waiting, or the job would never
+            # be finished
+            model.Session.rollback()
+            for harvest_object in objects.values():
+                harvest_object.state = 'ERROR'
+            model.Session.commit()
+            raise
+
+        log.debug('Imported batch of {0} audits, {1} errors'.format(
+            len(object_ids), errors))
+
+        return True
+
+    def _import_audit(self, harvest_object, audit, batched=False):
 
         log.debug('Import stage for audit "{0}"'.format(audit.get('AuditId')))
 
@@ -143,30 +743,63 @@ class EcChangelogHarvester(EcHarvester):
                 'No handler for command {0}, skipping ...'.format(command))
             return False
 
+        lookup_cache = self._get_lookup_cache(harvest_object)
         context = {
             'model': model,
             'ignore_auth': True,
-            'user': self.get_username_from_audit(audit),
+            'user': self.get_username_from_audit(audit, lookup_cache),
             'local_action': True,
+            'name_allocator': self._get_name_allocator(harvest_object),
+            'lookup_cache': lookup_cache,
         }
+        if batched:
+            context['defer_commit'] = True
+            savepoint = model.Session.begin_nested()
 
         log.debug('Calling handler for command "{0}"'.format(command))
         try:
 
             request_id = audit.get('RequestId')
 
-            # Mark relevant task as in progress
-            self._mark_task_as_processing(context, request_id)
+            # Mark relevant task as in progress. In a batch nobody else
+            # would see it until the batch is committed.
+            if not batched:
+                self._mark_task_as_processing(context, request_id)
 
             handler(context, audit, harvest_object)
 
-            self._mark_task_as_finished(context, request_id)
+            # Committed with the task update
+            mark_audit_processed(audit['AuditId'])
+
+            if not self._mark_task_as_finished(context, request_id):
+                _commit(context)
+
+            if batched:
+                savepoint.commit()
 
             return True
         except p.toolkit.ValidationError, e:
-            self._save_object_error(str(e), harvest_object, 'Import')
+            msg = str(e)
         except p.toolkit.ObjectNotFound, e:
             msg = e.message or str(e) or 'Object not found'
+        except Exception, e:
+            if not batched:
+                lookup_cache.clear()
+                raise
+            log.exception('Error importing audit "{0}"'.format(
+                audit.get('AuditId')))
+            msg = 'Error importing audit: {0}'.format(e)
+
+        # Cached objects might have been changed by the failed audit
+        lookup_cache.clear()
+
+        if batched:
+            savepoint.rollback()
+            _discard_rolled_back_objects()
+            _reset_revision()
+            model.Session.add(HarvestObjectError(
+                message=msg, object=harvest_object, stage='Import'))
+        else:
             self._save_object_error(msg, harvest_object, 'Import')
 
         return False
@@ -185,7 +818,8 @@ class EcChangelogHarvester(EcHarvester):
             task.state = state
             task.last_updated = datetime.datetime.now()
 
-            task.save()
+            model.Session.add(task)
+            _commit(context)
 
             _expire_task_status(context, task.id)
 
@@ -303,6 +937,55 @@ def _get_file_version(audit):
     return resource_dict
 
 
+def _save_resource(context, action, resource_dict, dataset_id):
+    '''
+    Calls one of the resource actions, unless commits are deferred
+
+    The core resource actions always commit the Session, which would release
+    the savepoint of an audit imported in a batch, so in that case the same
+    change is made on the dataset resources with a `package_update` call.
+
+    The dataset is looked up in the job lookup cache, which is updated with
+    the changed dataset.
+
+    Returns the resource dict, or None for `resource_delete`.
+    '''
+    lookup_cache = _get_lookup_cache(context)
+    if not context.get('defer_commit'):
+        lookup_cache.forget_dataset(dataset_id)
+        return p.toolkit.get_action(action)(context, resource_dict)
+
+    resource_dict = dict(resource_dict)
+    resource_dict.pop('package_id', None)
+
+    dataset_dict = lookup_cache.get_dataset(dataset_id)
+
+    resources = dataset_dict.get('resources', [])
+    for index, resource in enumerate(resources):
+        if resource['id'] == resource_dict['id']:
+            if action == 'resource_delete':
+                del resources[index]
+            else:
+                resources[index] = resource_dict
+            break
+    else:
+        if action != 'resource_create':
+            raise p.toolkit.ObjectNotFound(
+                'Resource not found: {0}'.format(resource_dict['id']))
+        resources.append(resource_dict)
+
+    dataset_dict['resources'] = resources
+    dataset_dict = p.toolkit.get_action('package_update')(
+        dict(context, use_cache=False), dataset_dict)
+    lookup_cache.remember_dataset(dataset_dict)
+
+    if action == 'resource_delete':
+        return None
+    for resource in dataset_dict['resources']:
+        if resource['id'] == resource_dict['id']:
+            return resource
+
+
 def handle_dataset_create(context, audit, harvest_object):
 
     dataset_dict = _get_latest_dataset_version(audit)
@@ -315,11 +998,16 @@ def handle_dataset_create(context, audit, harvest_object):
     if not dataset_dict.get('name'):
         name = get_dataset_name_from_task(context, audit)
         if not name:
-            name = get_initial_dataset_name(dataset_dict)
+            allocator = context.get('name_allocator')
+            if allocator:
+                name = allocator.allocate(dataset_dict)
+            else:
+                name = get_initial_dataset_name(dataset_dict)
         dataset_dict['name'] = name
 
     new_dataset = p.toolkit.get_action('package_create')(context,
                                                          dataset_dict)
+    _get_lookup_cache(context).remember_dataset(new_dataset)
 
     log.debug('Created new dataset "{0}"'.format(new_dataset['id']))
 
@@ -329,7 +1017,7 @@ def handle_dataset_create(context, audit, harvest_object):
 
     harvest_object.add()
 
-    model.Session.commit()
+    _commit(context)
 
     return True
 
@@ -343,9 +1031,9 @@ def handle_dataset_update(context, audit, harvest_object):
             json.dumps(audit['CustomProperties']))]
         raise p.toolkit.ObjectNotFound(msg)
 
+    lookup_cache = _get_lookup_cache(context)
     try:
-        existing_dataset = p.toolkit.get_action('package_show')(context,
-                                              {'id': dataset_dict['id']})
+        existing_dataset = lookup_cache.get_dataset(dataset_dict['id'])
 
         # Any CKAN-specific properties need to be added back here otherwise
         # they will get lost on the update
@@ -358,6 +1046,7 @@ def handle_dataset_update(context, audit, harvest_object):
 
     updated_dataset = p.toolkit.get_action('package_update')(context,
                                                              dataset_dict)
+    lookup_cache.remember_dataset(updated_dataset)
 
     log.debug('Updated dataset "{0}"'.format(updated_dataset['id']))
 
@@ -375,7 +1064,7 @@ def handle_dataset_update(context, audit, harvest_object):
     for obj in previous_objects:
         obj.delete()
 
-    model.Session.commit()
+    _commit(context)
 
     return True
 
@@ -401,14 +1090,14 @@ def handle_file_create(context, audit, harvest_object):
         log.debug('Resource "{0}" does not exist, creating it ...'.format(resource_dict['id']))
 
     if is_version:
-        resource_dict = p.toolkit.get_action('resource_update')(context,
-                                                                resource_dict)
+        resource_dict = _save_resource(context, 'resource_update',
+                                       resource_dict, dataset_id)
         log.debug('Updated existing resource "{0}" on dataset {1}'.format(
                   resource_dict['id'], dataset_id))
     else:
         try:
-            resource_dict = p.toolkit.get_action('resource_create')(context,
-                                                                    resource_dict)
+            resource_dict = _save_resource(context, 'resource_create',
+                                           resource_dict, dataset_id)
 
             log.debug('Created new resource "{0}" on dataset {1}'.format(
                       resource_dict['id'], dataset_id))
@@ -432,7 +1121,7 @@ def handle_file_create(context, audit, harvest_object):
     for obj in previous_objects:
         obj.delete()
 
-    model.Session.commit()
+    _commit(context)
 
     return True
 
@@ -459,8 +1148,8 @@ def handle_file_delete(context, audit, harvest_object):
 
 
     try:
-        p.toolkit.get_action('resource_delete')(context,
-                                                {'id': resource_id})
+        _save_resource(context, 'resource_delete', {'id': resource_id},
+                       dataset_id)
     except p.toolkit.ObjectNotFound:
         log.debug('Resource "{0}" does not exist, it can not be deleted'.format(resource_id))
 
@@ -480,7 +1169,7 @@ def handle_file_delete(context, audit, harvest_object):
     for obj in previous_objects:
         obj.delete()
 
-    model.Session.commit()
+    _commit(context)
 
     return True
 
@@ -504,8 +1193,8 @@ def handle_file_update(context, audit, harvest_object):
         e.extra_msg = ['Could not find resource {0}'.format(resource_dict['id'])]
         raise e
 
-    resource_dict = p.toolkit.get_action('resource_update')(context,
-                                                            resource_dict)
+    resource_dict = _save_resource(context, 'resource_update', resource_dict,
+                                   dataset_id)
     log.debug('Updated existing resource "{0}" on dataset {1}'.format(
               resource_dict['id'], dataset_id))
 
@@ -523,7 +1212,7 @@ def handle_file_update(context, audit, harvest_object):
     for obj in previous_objects:
         obj.delete()
 
-    model.Session.commit()
+    _commit(context)
 
     return True
 
@@ -543,12 +1232,11 @@ def handle_organization_create(context, audit, harvest_object):
             name = get_org_name(org_dict, 'title')
         org_dict['name'] = name
 
-    try:
-        # see if the org exists
-        current = p.toolkit.get_action('organization_show')(context,
-            {'id': org_dict['id']})
-        log.debug('organization "{0}" already exists skipping'.format(current['id']))
-    except p.toolkit.ObjectNotFound:
+    # see if the org exists
+    current_id = _get_organization_id(org_dict['id'])
+    if current_id:
+        log.debug('organization "{0}" already exists skipping'.format(current_id))
+    else:
         new_org = p.toolkit.get_action('organization_create')(context,
                                                               org_dict)
 
@@ -572,13 +1260,15 @@ def handle_organization_update(context, audit, harvest_object):
             name = get_org_name(org_dict, 'title')
         org_dict['name'] = name
 
+    lookup_cache = _get_lookup_cache(context)
     try:
-        current_org = p.toolkit.get_action('organization_show')(context,
-            {'id': org_dict['id']})
+        current_org = lookup_cache.get_organization(org_dict['id'])
         current_org.update(org_dict)
         org_dict['users'] = current_org['users']
         new_org = p.toolkit.get_action('organization_update')(context,
                                                               org_dict)
+        # The members are not changed
+        lookup_cache.remember_organization(current_org)
 
         log.debug('Updated organization "{0}"'.format(new_org['id']))
     except p.toolkit.ObjectNotFound, e:
@@ -590,8 +1280,8 @@ def handle_organization_update(context, audit, harvest_object):
 def handle_user_create(context, audit, harvest_object):
     username = audit['CustomProperties']['UserName']
 
-    user = p.toolkit.get_action('ec_user_show')(
-        context, {'ec_username': username})
+    lookup_cache = _get_lookup_cache(context)
+    user = lookup_cache.get_ec_user(context, username)
 
     if user.get('IsRegistered'):
         log.debug('Skipping creation of registered user: {}'.format(str(username)))
@@ -605,11 +1295,13 @@ def handle_user_create(context, audit, harvest_object):
 
     try:
         new_user = p.toolkit.get_action('user_create')(user_context, user_dict)
+        lookup_cache.forget_user(new_user['name'], new_user['id'])
 
         membership = custom_schema.convert_ec_member_to_ckan_member(user)
         if membership['id']:
             p.toolkit.get_action('organization_member_create')(
                 context, membership)
+            lookup_cache.forget_organization(membership['id'])
         log.debug('Created new user "{}" in org {}'.format(new_user['name'],
                                                            membership['id']))
     except p.toolkit.ValidationError, e:
@@ -623,8 +1315,8 @@ def handle_user_update(context, audit, harvest_object):
     user_context['schema'] = custom_schema.user_update_schema()
     username = audit['CustomProperties']['UserName']
 
-    user = p.toolkit.get_action('ec_user_show')(
-        context, {'ec_username': username})
+    lookup_cache = _get_lookup_cache(context)
+    user = lookup_cache.get_ec_user(context, username)
     user_dict = custom_schema.convert_ec_user_to_ckan_user(user)
     if not user_dict.get('email'):
         user_dict['email'] = 'noemail'
@@ -632,25 +1324,25 @@ def handle_user_update(context, audit, harvest_object):
         user_dict['fullname'] = user_dict.get('name')
 
     ckan_user = p.toolkit.get_action('user_update')(user_context, user_dict)
+    lookup_cache.forget_user(ckan_user['name'], ckan_user['id'])
     return True
 
 
 def handle_role_change(context, audit, harvest_object):
     # UserId is provided instead of UserName when ChangeUserRole
     # command is issued.
-    user_context = context.copy()
-    user_context['schema'] = custom_schema.user_update_schema()
     user_id = audit['CustomProperties']['UserId']
 
-    ckan_user = p.toolkit.get_action('user_show')(
-        user_context, {'id': user_id})
-    username = ckan_user['name']
+    lookup_cache = _get_lookup_cache(context)
+    username = lookup_cache.get_user_name(user_id)
+    if not username:
+        raise p.toolkit.ObjectNotFound('User not found: {0}'.format(user_id))
 
-    user = p.toolkit.get_action('ec_user_show')(
-        context, {'ec_username': username})
+    user = lookup_cache.get_ec_user(context, username)
 
     current_memberships = p.toolkit.get_action('organization_list_for_user')(
-        context, {'user': ckan_user['name'], 'permission': 'create_dataset'})
+        context, {'user': username, 'permission': 'create_dataset',
+                  'lightweight': True})
     try:
         new_membership = custom_schema.convert_ec_member_to_ckan_member(user)
 
@@ -658,13 +1350,15 @@ def handle_role_change(context, audit, harvest_object):
             # delete any orgs we're not in
             if membership['id'] != user['OrganisationId']:
                 p.toolkit.get_action('organization_member_delete')(context,
-                    {'id': membership['id'], 'username': ckan_user['name']})
+                    {'id': membership['id'], 'username': username})
+                lookup_cache.forget_organization(membership['id'])
 
         # update our existing membership
         p.toolkit.get_action('organization_member_create')(
             context, new_membership)
+        lookup_cache.forget_organization(new_membership['id'])
 
-        log.debug('Updated user "{}"'.format(ckan_user['name']))
+        log.debug('Updated user "{}"'.format(username))
     except (p.toolkit.ValidationError, TypeError), e:
         log.debug('failed to update user role for "{}": {}'.format(user_id, str(e)))
 
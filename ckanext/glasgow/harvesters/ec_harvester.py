@@ -11,9 +11,9 @@ import ckan.plugins.toolkit as toolkit
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectExtra
 
 import ckanext.glasgow.logic.schema as glasgow_schema
+from ckanext.glasgow.logic.action import _get_organization_id
 from ckanext.glasgow.harvesters import (
     EcHarvester,
-    get_initial_dataset_name,
     get_org_name,
 )
 
@@ -83,15 +83,13 @@ class EcInitialHarvester(EcHarvester):
             org_name = get_org_name(org, 'Title')
             data_dict['name'] = org_name
 
-            try:
-                if org['Title'] in done:
-                    duplicates.append(org['Title'])
+            if org['Title'] in done:
+                duplicates.append(org['Title'])
 
-                toolkit.get_action('organization_show')(context, {'id': org_name})
+            if _get_organization_id(org_name):
                 log.debug('Organization {0} ({1}) exists, skipping...'.format(org['Title'].encode('utf8'), org_name))
                 done.append(org['Title'])
-
-            except toolkit.ObjectNotFound:
+            else:
                 try:
                     context['local_action'] = True
                     toolkit.get_action('organization_create')(context, data_dict)
@@ -125,16 +123,11 @@ class EcInitialHarvester(EcHarvester):
 
             harvest_object_ids = []
             for org_name in orgs:
-                context = {
-                    'model': model,
-                    'session': model.Session,
-                    'user': self._get_site_user()['name']
-                }
-
-                organization_show = toolkit.get_action('organization_show')
-                org = organization_show(context, {'id': org_name})
-
-                ec_api_org_id = org['id']
+                ec_api_org_id = _get_organization_id(org_name)
+                if not ec_api_org_id:
+                    log.warn('Organization {0} not found, skipping'.format(
+                        org_name))
+                    continue
 
                 endpoint = api_endpoint.format(ec_api_org_id)
 
@@ -146,7 +139,7 @@ class EcInitialHarvester(EcHarvester):
                         job=harvest_job,
                         # Add reference to CKAN org to use on import stage
                         extras=[HarvestObjectExtra(
-                            key='owner_org', value=org['id'])]
+                            key='owner_org', value=ec_api_org_id)]
                     )
 
                     harvest_object.save()
@@ -196,10 +189,12 @@ class EcInitialHarvester(EcHarvester):
         if not result:
             return True
 
-        for file_metadata in result['MetadataResultSet']:
+        files = result['MetadataResultSet']
+        ckan_dicts = glasgow_schema.convert_ec_files_to_ckan_resources(
+            [file_metadata['FileMetadata'] for file_metadata in files])
+
+        for file_metadata, ckan_dict in zip(files, ckan_dicts):
             # create harvest object extra for each file
-            ckan_dict = glasgow_schema.convert_ec_file_to_ckan_resource(
-                file_metadata['FileMetadata'])
             ckan_dict['id'] = file_metadata['FileId']
 
             ckan_dict['ec_api_version_id'] = file_metadata['Version']
@@ -238,15 +233,19 @@ class EcInitialHarvester(EcHarvester):
 
         ckan_data_dict['__local_action'] = True
 
-        # double check name
-        if 'name' not in ckan_data_dict:
-            ckan_data_dict['name'] = get_initial_dataset_name(ckan_data_dict)
-
         try:
             owner_org = self._get_object_extra(harvest_object, 'owner_org')
 
             ckan_data_dict['owner_org'] = owner_org
 
+            # double check name
+            if 'name' not in ckan_data_dict:
+                allocator = self._get_name_allocator(harvest_object)
+                name = allocator.get_existing_name(ckan_data_dict['id'])
+                if not name:
+                    name = allocator.allocate(ckan_data_dict)
+                ckan_data_dict['name'] = name
+
 
             try:
                 pkg = toolkit.get_action('package_show')(context, {'id': ckan_data_dict['name']})
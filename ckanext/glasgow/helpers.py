@@ -1,15 +1,65 @@
 import datetime
+import functools
 import json
 from ckan import model
 import ckan.lib.helpers as helpers
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.glasgow.logic.schema import resource_schema as custom_resource_schema
+from ckanext.glasgow.logic.schema import resource_schema_keys
 from ckanext.glasgow.logic.action import _get_api_endpoint
+
+
+def _get_request_cache():
+    '''Returns a dict that lives for the current request, or None if there
+    is no request (eg when running commands)'''
+    try:
+        cache = getattr(toolkit.c, '_glasgow_helpers_cache', None)
+        if not isinstance(cache, dict):
+            cache = {}
+            toolkit.c._glasgow_helpers_cache = cache
+    except TypeError:
+        # No tmpl_context registered for this thread
+        return None
+    return cache
+
+
+def request_memoize(key=None):
+    '''Caches the result of a helper for the rest of the current request
+
+    Templates often call the same helper several times with the same
+    arguments while rendering a page (eg snippets included for each
+    resource). `key` is a function that gets the helper arguments and
+    returns a hashable cache key, by default the arguments themselves.
+    Cached values are shared, so callers should not modify them.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            cache = _get_request_cache()
+            if cache is None:
+                return func(*args)
+
+            cache_key = (func.__name__, key(*args) if key else args)
+            if cache_key not in cache:
+                cache[cache_key] = func(*args)
+            return cache[cache_key]
+        return wrapper
+    return decorator
+
+
+# The license register does not change while the process is running
+_license_options = None
+
+
 def get_licenses():
+    global _license_options
+    if _license_options is None:
+        _license_options = [('', '')] + model.Package.get_license_options()
 
-    return [('', '')] + model.Package.get_license_options()
+    return list(_license_options)
 
+
+@request_memoize()
 def get_resource_versions(dataset_id, resource_id):
     try:
         context = {
@@ -33,6 +83,7 @@ def get_resource_versions(dataset_id, resource_id):
         helpers.flash_error('{0}'.format(e.error_dict['message']))
         return []
 
+@request_memoize(key=lambda pkg_dict: (pkg_dict['id'], pkg_dict['name']))
 def get_pending_files_for_dataset(pkg_dict):
     try:
         pending_files = toolkit.get_action('pending_files_for_dataset')({
@@ -48,6 +99,7 @@ def get_pending_files_for_dataset(pkg_dict):
         return []
 
 
+@request_memoize()
 def get_pending_task_for_dataset(pkg_name):
     try:
         return toolkit.get_action('pending_task_for_dataset')({
@@ -71,20 +123,20 @@ def parse_metadata_string(metadata_str):
     return json.loads(metadata_str)
 
 
+_resource_non_extra_keys = resource_schema_keys | frozenset([
+    'ec_api_org_id', 'FileName', 'DataSetId', 'can_be_previewed',
+    'on_same_domain', 'clear_upload', 'dataset_id', 'external_url',
+])
+
+
 def get_resource_ec_extra_fields(resource_dict):
 
     if resource_dict.get('extras'):
         return resource_dict['extras']
 
-    resource_schema_keys = custom_resource_schema().keys()
-    resource_schema_keys.extend([
-        'ec_api_org_id', 'FileName', 'DataSetId', 'can_be_previewed',
-        'on_same_domain', 'clear_upload', 'dataset_id', 'external_url',
-    ])
-
     extra_ec_fields = []
     for key, value in resource_dict.iteritems():
-        if key not in resource_schema_keys:
+        if key not in _resource_non_extra_keys:
             extra_ec_fields.append({'key': key, 'value': value})
 
     return extra_ec_fields
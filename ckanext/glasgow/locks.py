@@ -0,0 +1,163 @@
+import struct
+import hashlib
+import logging
+import threading
+import contextlib
+
+from pylons import config
+import sqlalchemy
+
+from ckan import model
+
+
+log = logging.getLogger(__name__)
+
+
+def get_lock_key(name):
+    '''Returns the 64 bit integer used as PostgreSQL lock key for a name'''
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return struct.unpack('>q', hashlib.md5(name).digest()[:8])[0]
+
+
+class PostgresLockBackend(object):
+    '''
+    PostgreSQL session level advisory locks
+
+    Locks are held on a connection of their own, so they are kept when the
+    Session commits and returns its connection to the pool.
+    '''
+
+    def __init__(self):
+        self.connection = None
+
+    def _execute(self, sql, name=None):
+        if self.connection is None:
+            self.connection = model.meta.engine.connect()
+        # Commit straight away so the connection is not left idle in a
+        # transaction while the locks are held
+        statement = sqlalchemy.text(sql).execution_options(autocommit=True)
+        params = {'key': get_lock_key(name)} if name is not None else {}
+        return self.connection.execute(statement, **params).scalar()
+
+    def acquire(self, name, wait=False):
+        if wait:
+            self._execute('SELECT pg_advisory_lock(:key)', name)
+            return True
+        return bool(self._execute('SELECT pg_try_advisory_lock(:key)', name))
+
+    def release(self, name):
+        self._execute('SELECT pg_advisory_unlock(:key)', name)
+
+    def close(self):
+        if self.connection is not None:
+            # Do not leave locks behind on the pooled connection
+            self._execute('SELECT pg_advisory_unlock_all()')
+            self.connection.close()
+            self.connection = None
+
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+class LocalLockBackend(object):
+    '''
+    Locks shared by the threads of the current process
+
+    A stand-in for the PostgreSQL locks when the DB does not support them
+    (eg SQLite when running the tests). They do not keep separate processes
+    from running at the same time.
+    '''
+
+    def acquire(self, name, wait=False):
+        with _local_locks_guard:
+            lock = _local_locks.setdefault(name, threading.Lock())
+        return lock.acquire(wait)
+
+    def release(self, name):
+        _local_locks[name].release()
+
+    def close(self):
+        pass
+
+
+def _get_backend():
+    backend = config.get('ckanext.glasgow.lock_backend')
+    if not backend:
+        backend = ('postgres' if model.meta.engine.dialect.name == 'postgresql'
+                   else 'local')
+    if backend == 'local':
+        return LocalLockBackend()
+    return PostgresLockBackend()
+
+
+class AdvisoryLocks(object):
+    '''
+    Named locks used to keep concurrent jobs and commands from doing the
+    same work
+
+    Locks are advisory, they only exclude the code that asks for the same
+    name. Acquiring a lock already held by this object succeeds straight
+    away. All locks are released when leaving the `with` block, or when
+    calling `release_all`.
+
+    The backend is set with `ckanext.glasgow.lock_backend` ('postgres' or
+    'local'), by default PostgreSQL locks are used if the DB supports them.
+    '''
+
+    def __init__(self):
+        self.backend = _get_backend()
+        self.held = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release_all()
+
+    def acquire(self, name, wait=False):
+        '''
+        Acquires a lock, returns False if it is held by someone else
+
+        If `wait` is True it blocks until the lock is released instead.
+        '''
+        if name in self.held:
+            return True
+        if not self.backend.acquire(name, wait):
+            log.debug('Lock {0} is held by another worker'.format(name))
+            return False
+        self.held.add(name)
+        return True
+
+    def acquire_all(self, names):
+        '''
+        Waits until all the locks are acquired
+
+        Locks are acquired in the same order by everybody, so two workers
+        waiting on each other's locks do not block forever.
+        '''
+        for name in sorted(set(names)):
+            self.acquire(name, wait=True)
+
+    def release(self, name):
+        if name in self.held:
+            self.backend.release(name)
+            self.held.discard(name)
+
+    def release_all(self):
+        for name in list(self.held):
+            self.release(name)
+        self.backend.close()
+
+
+@contextlib.contextmanager
+def advisory_lock(name, wait=False):
+    '''
+    Context manager holding a single lock, yields True if it was acquired
+    '''
+    locks = AdvisoryLocks()
+    try:
+        yield locks.acquire(name, wait)
+    finally:
+        locks.release_all()
@@ -1,16 +1,23 @@
 import os
 import cgi
+import codecs
 import logging
 import json
 import datetime
 import uuid
 import re
+import time
 import urlparse
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import dateutil.parser
 import requests
-from sqlalchemy import or_, and_, desc, case, func
-from sqlalchemy.sql import select
+import sqlalchemy.event
+from sqlalchemy import or_, desc, case, func, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import get_history
 
 from pylons import config, session
 
@@ -19,6 +26,7 @@ from ckan import new_authz
 import ckan.plugins as p
 from ckan.lib.navl.dictization_functions import validate
 import ckan.lib.dictization.model_dictize as model_dictize
+from ckan.lib.dictization import table_dictize
 from ckan.lib import helpers
 import ckan.logic.action as core_actions
 from ckan.logic import ActionError
@@ -28,6 +36,18 @@ import ckanext.oauth2waad.plugin as oauth2
 
 
 import ckanext.glasgow.logic.schema as custom_schema
+from ckanext.glasgow.upload import (
+    MultipartStream,
+    get_file_length,
+    stage_file,
+    get_staged_file_extras,
+    remove_staged_file,
+)
+from ckanext.glasgow.model import (
+    get_archived_tasks,
+    get_tasks_for_request_ids,
+    user_counts_table,
+)
 
 
 log = logging.getLogger(__name__)
@@ -243,16 +263,205 @@ def _get_api_endpoint(operation):
         return None, None
 
 
+# Organization name or id -> (cached timestamp, organization id)
+_organization_id_cache = {}
+
+
+def _get_organization_id(name_or_id):
+    '''Returns the id of an organization given its name or id
+
+    This is a lot cheaper than `organization_show`, which dictizes all the
+    organization datasets and members. Ids are cached by name and id for
+    `ckanext.glasgow.organization_id_cache_ttl` seconds (default 300). The
+    cache is cleared when organizations are created or updated in this
+    process, eg by the changelog harvester.
+
+    :returns: the organization id or None if not found
+    '''
+    if not name_or_id:
+        return None
+
+    ttl = int(config.get('ckanext.glasgow.organization_id_cache_ttl', 300))
+    now = time.time()
+
+    cached = _organization_id_cache.get(name_or_id)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+
+    org = model.Session.query(model.Group.id, model.Group.name) \
+        .filter(model.Group.is_organization == True) \
+        .filter(or_(model.Group.id == name_or_id,
+                    model.Group.name == name_or_id)) \
+        .first()
+
+    if not org:
+        return None
+
+    _organization_id_cache[org.id] = (now, org.id)
+    _organization_id_cache[org.name] = (now, org.id)
+
+    return org.id
+
+
+def _clear_organization_id_cache():
+    _organization_id_cache.clear()
+
+
+# (user, permission) -> (cached timestamp, list of organizations), least
+# recently used first
+_organization_list_cache = OrderedDict()
+_organization_list_cache_lock = threading.Lock()
+
+
+def _get_organizations_for_user(user, permission='edit_group'):
+    '''Returns the active organizations where a user has a permission
+
+    Only the id, name, title and capacity of each organization are returned
+    (sysadmins get all organizations with an `admin` capacity). Results are
+    cached for `ckanext.glasgow.organization_list_cache_ttl` seconds
+    (default 60), for up to `ckanext.glasgow.organization_list_cache_size`
+    users and permissions (default 1000). The cache is cleared when
+    organizations, members or sysadmins are changed in this process, by
+    any action.
+
+    :returns: a list of dicts, sorted by organization name
+    '''
+    ttl = int(config.get('ckanext.glasgow.organization_list_cache_ttl', 60))
+    max_size = int(config.get('ckanext.glasgow.organization_list_cache_size',
+                              1000))
+    now = time.time()
+
+    with _organization_list_cache_lock:
+        cached = _organization_list_cache.pop((user, permission), None)
+        if cached and now - cached[0] < ttl:
+            _organization_list_cache[(user, permission)] = cached
+            return [dict(org) for org in cached[1]]
+
+    query = model.Session.query(model.Group.id, model.Group.name,
+                                model.Group.title) \
+        .filter(model.Group.is_organization == True) \
+        .filter(model.Group.state == 'active') \
+        .order_by(model.Group.name)
+
+    roles = new_authz.get_roles_with_permission(permission)
+
+    if new_authz.is_sysadmin(user):
+        orgs = [{'id': row.id, 'name': row.name, 'title': row.title,
+                 'capacity': 'admin'} for row in query]
+    elif not roles or not user:
+        orgs = []
+    else:
+        query = query.add_column(model.Member.capacity) \
+            .join(model.Member, model.Member.group_id == model.Group.id) \
+            .join(model.User, model.User.id == model.Member.table_id) \
+            .filter(model.Member.table_name == 'user') \
+            .filter(model.Member.state == 'active') \
+            .filter(model.Member.capacity.in_(roles)) \
+            .filter(or_(model.User.name == user, model.User.id == user))
+
+        orgs = []
+        for row in query:
+            # Users can have more than one role in the same organization
+            if orgs and orgs[-1]['id'] == row.id:
+                continue
+            orgs.append({'id': row.id, 'name': row.name, 'title': row.title,
+                         'capacity': row.capacity})
+
+    with _organization_list_cache_lock:
+        _organization_list_cache.pop((user, permission), None)
+        _organization_list_cache[(user, permission)] = (now, orgs)
+        while len(_organization_list_cache) > max_size:
+            _organization_list_cache.popitem(last=False)
+
+    return [dict(org) for org in orgs]
+
+
+def _clear_organization_list_cache(*args):
+    with _organization_list_cache_lock:
+        _organization_list_cache.clear()
+
+
+def _clear_organization_list_cache_for_user(mapper, connection, user):
+    if get_history(user, 'sysadmin').has_changes():
+        _clear_organization_list_cache()
+
+
+# Memberships are also changed by the core actions and other extensions
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    sqlalchemy.event.listen(model.Member, _event,
+                            _clear_organization_list_cache)
+    sqlalchemy.event.listen(model.Group, _event,
+                            _clear_organization_list_cache)
+sqlalchemy.event.listen(model.User, 'after_update',
+                        _clear_organization_list_cache_for_user)
+
+
 def _get_ec_api_org_id(ckan_org_id):
     # Get EC API id from parent organization
 
+    return _get_organization_id(ckan_org_id) or False
+
+
+def _filter_pending_tasks(query, data_dict, states):
+    '''Applies the common filters and paging of the pending tasks actions
+
+    Supported keys in `data_dict` are `state` (one or more of `states`, as a
+    list or comma separated string), `since` and `until` (ISO dates, compared
+    with the last update of the task), `limit` and `offset`. Tasks are
+    returned most recent first.
+    '''
+    state = data_dict.get('state')
+    if state:
+        if isinstance(state, basestring):
+            state = state.split(',')
+        state = [s.strip() for s in state if s.strip()]
+        invalid = [s for s in state if s not in states]
+        if invalid:
+            raise p.toolkit.ValidationError(
+                {'state': ['Invalid state: {0}'.format(', '.join(invalid))]})
+        states = state
+    query = query.filter(model.TaskStatus.state.in_(states))
+
+    since = _get_date_param(data_dict, 'since')
+    if since:
+        query = query.filter(model.TaskStatus.last_updated >= since)
+    until = _get_date_param(data_dict, 'until')
+    if until:
+        query = query.filter(model.TaskStatus.last_updated < until)
+
+    query = query.order_by(model.TaskStatus.last_updated.desc(),
+                           model.TaskStatus.id)
+
+    limit = _get_int_param(data_dict, 'limit')
+    if limit is not None:
+        query = query.limit(limit)
+    offset = _get_int_param(data_dict, 'offset')
+    if offset:
+        query = query.offset(offset)
+
+    return query
+
+
+def _get_date_param(data_dict, key):
+    if not data_dict.get(key):
+        return None
     try:
-        org_dict = p.toolkit.get_action('organization_show')({}, {
-            'id': ckan_org_id})
+        return dateutil.parser.parse(data_dict[key])
+    except (ValueError, TypeError, AttributeError):
+        raise p.toolkit.ValidationError(
+            {key: ['Invalid date: {0}'.format(data_dict[key])]})
 
-        return org_dict['id']
-    except p.toolkit.ObjectNotFound:
-        return False
+
+def _get_int_param(data_dict, key):
+    if data_dict.get(key) in (None, ''):
+        return None
+    try:
+        value = int(data_dict[key])
+    except (ValueError, TypeError):
+        value = -1
+    if value < 0:
+        raise p.toolkit.ValidationError({key: ['Must be a positive integer']})
+    return value
 
 
 @p.toolkit.side_effect_free
@@ -298,14 +507,24 @@ def pending_files_for_dataset(context, data_dict):
     '''
     Returns list of pending file tasks for a dataset
 
-    Returns the most recent TaskStatus with a state of 'new' or 'sent'.
+    Returns the TaskStatus with a state of 'new', 'sent' or 'uploading'.
     Datasets can be identified by id or name.
 
     :param id: Dataset id (optional if name provided)
     :type operation: string
-
-    :returns: a task status dict if found, None otherwise.
-    :rtype: dict
+    :param state: Only return tasks in these states (optional)
+    :type state: list or comma separated string
+    :param since: Only return tasks updated after this date (optional)
+    :type since: ISO date string
+    :param until: Only return tasks updated before this date (optional)
+    :type until: ISO date string
+    :param limit: Maximum number of tasks to return (optional)
+    :type limit: int
+    :param offset: Number of tasks to skip (optional)
+    :type offset: int
+
+    :returns: a list of task status dicts, most recent first
+    :rtype: list
     '''
 
     p.toolkit.check_access('pending_task_for_dataset', context, data_dict)
@@ -321,11 +540,10 @@ def pending_files_for_dataset(context, data_dict):
     model = context.get('model')
     tasks = model.Session.query(model.TaskStatus) \
         .filter(model.TaskStatus.entity_type == 'file') \
-        .filter(or_(model.TaskStatus.state == 'new',
-                model.TaskStatus.state == 'sent')) \
         .filter(or_(model.TaskStatus.key.like('{0}%'.format(dataset_dict['id'])),
-                model.TaskStatus.key.like('{0}%'.format(dataset_dict['name'])))) \
-        .order_by(model.TaskStatus.last_updated.desc())
+                model.TaskStatus.key.like('{0}%'.format(dataset_dict['name']))))
+    tasks = _filter_pending_tasks(tasks, data_dict,
+                                  ['new', 'sent', 'uploading'])
 
     results = []
     for task in tasks:
@@ -358,6 +576,15 @@ def pending_task_for_organization(context, data_dict):
 
 
 def pending_tasks_for_membership(context, data_dict):
+    '''
+    Returns the pending membership requests for an organization
+
+    Returns the TaskStatus with a state of 'new' or 'sent', most recent
+    first.
+
+    Tasks can be filtered and paged with `state`, `since`, `until`, `limit`
+    and `offset`, as in `pending_files_for_dataset`.
+    '''
     p.toolkit.check_access('pending_task_for_organization', context, data_dict)
 
     organization_id = data_dict.get('organization_id')
@@ -367,16 +594,13 @@ def pending_tasks_for_membership(context, data_dict):
     model = context.get('model')
     tasks = model.Session.query(model.TaskStatus) \
         .filter(model.TaskStatus.entity_type == 'member') \
-        .filter(or_(model.TaskStatus.state == 'new',
-                model.TaskStatus.state == 'sent')) \
         .filter(or_(model.TaskStatus.entity_id == organization_id,
                 model.TaskStatus.entity_id == name)) \
-        .filter(model.TaskStatus.task_type == 'member_update') \
-        .order_by(model.TaskStatus.last_updated.desc()) \
+        .filter(model.TaskStatus.task_type == 'member_update')
+    tasks = _filter_pending_tasks(tasks, data_dict, ['new', 'sent'])
 
     task_dicts = []
     for task in tasks:
-        context = {'model': model, 'session': model.Session}
         task_dict = model_dictize.task_status_dictize(task, context)
         task_dict['value'] = json.loads(task_dict['value'])
         task_dicts.append(task_dict)
@@ -385,23 +609,28 @@ def pending_tasks_for_membership(context, data_dict):
 
 @p.toolkit.side_effect_free
 def pending_user_tasks(context, data_dict):
+    '''
+    Returns the pending user requests, optionally for a single user
+
+    Returns the TaskStatus with a state of 'new', 'sent' or 'error', most
+    recent first.
+
+    Tasks can be filtered and paged with `state`, `since`, `until`, `limit`
+    and `offset`, as in `pending_files_for_dataset`.
+    '''
     p.toolkit.check_access('pending_user_tasks', context, data_dict)
 
     user_id = data_dict.get('id') or data_dict.get('name')
 
     model = context.get('model')
     tasks = model.Session.query(model.TaskStatus) \
-        .filter(model.TaskStatus.entity_type == 'user') \
-        .filter(or_(model.TaskStatus.state == 'new',
-                model.TaskStatus.state == 'sent',
-                model.TaskStatus.state == 'error')
-                )
+        .filter(model.TaskStatus.entity_type == 'user')
     if user_id:
         tasks = tasks.filter(or_(
                 #model.TaskStatus.key == user_id,
                 model.TaskStatus.entity_id == user_id,
                 ))
-    tasks = tasks.order_by(model.TaskStatus.last_updated.desc())
+    tasks = _filter_pending_tasks(tasks, data_dict, ['new', 'sent', 'error'])
 
     results = []
     for task in tasks:
@@ -411,6 +640,53 @@ def pending_user_tasks(context, data_dict):
     return results
 
 
+@p.toolkit.side_effect_free
+def task_status_archive_list(context, data_dict):
+    '''
+    Returns the archived tasks for an object, most recent first
+
+    Finished and expired tasks are moved out of the task_status table by the
+    `glasgow_db tasks archive` command.
+
+    :param entity_type: Type of object (eg `dataset` or `organization`)
+    :type entity_type: string
+    :param id: Object id (optional if name provided)
+    :type id: string
+    :param name: Object name (optional if id provided)
+    :type name: string
+    :param limit: Maximum number of tasks to return (defaults to 20)
+    :type limit: int
+
+    :returns: a list of task status dicts, with their value parsed and an
+              `expired` key set to True for tasks that never finished
+    :rtype: list
+    '''
+    p.toolkit.check_access('task_status_archive_list', context, data_dict)
+
+    entity_type = data_dict.get('entity_type')
+    ids = [value for value in (data_dict.get('id'), data_dict.get('name'))
+           if value]
+    if not entity_type or not ids:
+        raise p.toolkit.ValidationError(
+            ['entity_type and either id or name are required'])
+
+    try:
+        limit = int(data_dict.get('limit', 20))
+    except ValueError:
+        raise p.toolkit.ValidationError(['limit must be an integer'])
+
+    results = []
+    for task in get_archived_tasks(entity_type=entity_type, ids=ids,
+                                   limit=limit):
+        task_dict = task.as_dict()
+        try:
+            task_dict['value'] = json.loads(task_dict['value'])
+        except (ValueError, TypeError):
+            pass
+        results.append(task_dict)
+    return results
+
+
 def package_create(context, data_dict):
 
     if data_dict.get('__local_action', False):
@@ -648,14 +924,21 @@ def file_request_create(context, data_dict):
         'Authorization': _get_api_auth_token(),
     }
 
-    if isinstance(uploaded_file, cgi.FieldStorage):
-        files = {
-            'file': (uploaded_file.filename,
-                     uploaded_file.file)
-        }
-        data = {
-            'metadata': json.dumps(ec_dict)
+    if (isinstance(uploaded_file, cgi.FieldStorage) and
+            _upload_should_be_queued(uploaded_file)):
+        task_dict = _queue_file_upload(context, task_dict, uploaded_file,
+                                       ec_dict, method, url, headers)
+        return {
+            'task_id': task_dict['id'],
+            'request_id': None,
+            'name': None,
         }
+
+    if isinstance(uploaded_file, cgi.FieldStorage):
+        files = None
+        data = _get_file_upload_body(uploaded_file.filename,
+                                     uploaded_file.file, ec_dict, task_dict)
+        headers['Content-Type'] = data.content_type
     else:
         headers['Content-Type'] = 'application/json'
         files = None
@@ -854,14 +1137,21 @@ def file_request_update(context, data_dict):
         'Authorization': _get_api_auth_token(),
     }
 
-    if isinstance(uploaded_file, cgi.FieldStorage):
-        files = {
-            'file': (uploaded_file.filename,
-                     uploaded_file.file)
-        }
-        data = {
-            'metadata': json.dumps(ec_dict)
+    if (isinstance(uploaded_file, cgi.FieldStorage) and
+            _upload_should_be_queued(uploaded_file)):
+        task_dict = _queue_file_upload(context, task_dict, uploaded_file,
+                                       ec_dict, method, url, headers)
+        return {
+            'task_id': task_dict['id'],
+            'request_id': None,
+            'name': None,
         }
+
+    if isinstance(uploaded_file, cgi.FieldStorage):
+        files = None
+        data = _get_file_upload_body(uploaded_file.filename,
+                                     uploaded_file.file, ec_dict, task_dict)
+        headers['Content-Type'] = data.content_type
     else:
         headers['Content-Type'] = 'application/json'
         files = None
@@ -924,6 +1214,242 @@ def _update_task_status_error(context, task_dict, value):
     return task_dict
 
 
+def _get_upload_progress_callback(task_dict):
+    '''Returns a function that stores the upload progress on a task status
+
+    The progress is stored as `upload_progress` on the task value, at most
+    once every `ckanext.glasgow.upload_progress_interval` seconds (default 5)
+
+    It is written on a connection of its own, so the Session of the action
+    sending the body (which may be deferring its commit) is left alone. If
+    the task row is locked by that Session the update is skipped rather
+    than waiting on it.
+    '''
+    interval = float(config.get('ckanext.glasgow.upload_progress_interval', 5))
+    last_update = {'time': 0}
+
+    def callback(bytes_sent, total):
+        now = time.time()
+        if bytes_sent != total and now - last_update['time'] < interval:
+            return
+        last_update['time'] = now
+
+        select_sql = 'SELECT value FROM task_status WHERE id = :id'
+        if model.meta.engine.dialect.name == 'postgresql':
+            select_sql += ' FOR UPDATE NOWAIT'
+
+        connection = model.meta.engine.connect()
+        try:
+            with connection.begin():
+                row = connection.execute(text(select_sql),
+                                         id=task_dict['id']).first()
+                if not row:
+                    return
+                try:
+                    value = json.loads(row[0] or '{}')
+                except ValueError:
+                    value = {}
+                value['upload_progress'] = {'sent': bytes_sent,
+                                            'total': total}
+                connection.execute(
+                    text('UPDATE task_status SET value = :value '
+                         'WHERE id = :id'),
+                    value=json.dumps(value), id=task_dict['id'])
+        except OperationalError:
+            log.debug('Task {0} is locked, skipping upload progress'.format(
+                task_dict['id']))
+        finally:
+            connection.close()
+
+    return callback
+
+
+def _get_file_upload_body(filename, file_obj, ec_dict, task_dict=None):
+    '''Returns a streamed multipart body for a file upload to the platform
+
+    The file is read from the spooled upload in chunks of
+    `ckanext.glasgow.upload_chunk_size` bytes (default 64Kb) while it is sent.
+    Set `ckanext.glasgow.upload_chunked` to true to always use chunked
+    transfer encoding.
+    '''
+    chunk_size = int(config.get('ckanext.glasgow.upload_chunk_size',
+                                64 * 1024))
+    chunked = p.toolkit.asbool(config.get('ckanext.glasgow.upload_chunked',
+                                          False))
+    callback = _get_upload_progress_callback(task_dict) if task_dict else None
+
+    return MultipartStream(
+        fields=[('metadata', json.dumps(ec_dict))],
+        files=[('file', filename, file_obj)],
+        chunk_size=chunk_size,
+        chunked=chunked,
+        callback=callback,
+    )
+
+
+def _upload_should_be_queued(uploaded_file):
+    '''Checks if an upload is big enough to be sent by the upload worker
+
+    Uploads of `ckanext.glasgow.upload_queue_threshold` bytes or more are
+    queued. If the option is not set (the default) nothing is queued.
+    '''
+    threshold = int(config.get('ckanext.glasgow.upload_queue_threshold', 0))
+    if not threshold:
+        return False
+
+    length = get_file_length(uploaded_file.file)
+
+    return length is not None and length >= threshold
+
+
+def _queue_file_upload(context, task_dict, uploaded_file, ec_dict, method,
+                       url, headers):
+    '''Stages an upload to be sent to the platform by the upload worker
+
+    The file is copied to the staging dir and the task is moved to the
+    'uploading' state. The `upload_queue` command will pick it up and call
+    `send_queued_upload`.
+
+    The request headers (ie the user's auth token) are kept in the staging
+    dir, not on the task status.
+    '''
+
+    path = stage_file(uploaded_file.file, task_dict['id'],
+                      extras={'headers': headers})
+
+    value = json.loads(task_dict['value'])
+    value['upload'] = {
+        'path': path,
+        'filename': uploaded_file.filename,
+        'method': method,
+        'url': url,
+        'metadata': ec_dict,
+        'attempts': 0,
+        'next_attempt': None,
+    }
+
+    context.update({'ignore_auth': True})
+
+    task_dict['state'] = 'uploading'
+    task_dict['value'] = json.dumps(value)
+    task_dict['last_updated'] = datetime.datetime.now()
+
+    task_dict = get_action('task_status_update')(context, task_dict)
+
+    _expire_task_status(context, task_dict['id'])
+
+    return task_dict
+
+
+def send_queued_upload(context, task_id):
+    '''Sends an upload queued by `_queue_file_upload` to the platform
+
+    On success the task is moved to the 'sent' state with the returned
+    RequestId and the staged file is removed.
+
+    If the platform can not be reached or returns an error the upload is
+    retried on a later run, waiting `ckanext.glasgow.upload_queue_retry_delay`
+    seconds (default 60), doubled after each failed attempt. After
+    `ckanext.glasgow.upload_queue_max_attempts` attempts (default 5), or if
+    the platform rejects the auth token or can not find the target object,
+    the task is moved to the 'error' state and the staged file removed.
+
+    The upload is sent with the auth token of the user that queued it, kept
+    in the staging dir. There is no way of refreshing it from the worker, so
+    uploads still queued once it has expired end up in the 'error' state and
+    need to be made again by the user.
+
+    :returns: the updated task status dict
+    '''
+    context.update({'ignore_auth': True})
+
+    task_dict = get_action('task_status_show')(context, {'id': task_id})
+    value = json.loads(task_dict['value'])
+    upload = value['upload']
+
+    headers = get_staged_file_extras(upload['path']).get('headers', {})
+    headers = dict((str(k), str(v)) for k, v in headers.iteritems())
+
+    error = None
+    retry = False
+    try:
+        with open(upload['path'], 'rb') as f:
+            data = _get_file_upload_body(upload['filename'], f,
+                                         upload['metadata'], task_dict)
+            headers['Content-Type'] = data.content_type
+            content = send_request_to_ec_platform(upload['method'],
+                                                  upload['url'],
+                                                  data=data,
+                                                  headers=headers)
+    except IOError, e:
+        error = 'Staged file could not be read: {0}'.format(e)
+    except ECAPINotAuthorized, e:
+        error = str(e)
+    except p.toolkit.ObjectNotFound, e:
+        # Eg the dataset was deleted on the platform, retrying will not help
+        error = str(e) or 'Not found on the platform'
+    except p.toolkit.ValidationError, e:
+        error = str(e)
+        retry = True
+
+    if error:
+        return _record_queued_upload_error(context, task_dict, value, error,
+                                           retry)
+
+    remove_staged_file(upload['path'])
+
+    return _update_task_status_success(context, task_dict, {
+        'data_dict': value['data_dict'],
+        'request_id': content.get('RequestId'),
+    })
+
+
+def queued_upload_error(context, task_id, error):
+    '''Records an unexpected error sending a queued upload
+
+    It is handled like a platform error: the upload is retried later, and
+    the task moved to the 'error' state after
+    `ckanext.glasgow.upload_queue_max_attempts` attempts.
+
+    :returns: the updated task status dict
+    '''
+    context.update({'ignore_auth': True})
+
+    task_dict = get_action('task_status_show')(context, {'id': task_id})
+    value = json.loads(task_dict['value'])
+
+    return _record_queued_upload_error(context, task_dict, value, error,
+                                       retry=True)
+
+
+def _record_queued_upload_error(context, task_dict, value, error, retry):
+    upload = value['upload']
+    upload['attempts'] = upload.get('attempts', 0) + 1
+    upload['error'] = error
+    max_attempts = int(config.get(
+        'ckanext.glasgow.upload_queue_max_attempts', 5))
+
+    if retry and upload['attempts'] < max_attempts:
+        delay = int(config.get('ckanext.glasgow.upload_queue_retry_delay',
+                               60))
+        next_attempt = datetime.datetime.now() + datetime.timedelta(
+            seconds=delay * 2 ** (upload['attempts'] - 1))
+        upload['next_attempt'] = next_attempt.isoformat()
+
+        task_dict['value'] = json.dumps(value)
+        task_dict['last_updated'] = datetime.datetime.now()
+        task_dict = get_action('task_status_update')(context, task_dict)
+        _expire_task_status(context, task_dict['id'])
+    else:
+        if upload.get('path'):
+            remove_staged_file(upload['path'])
+        task_dict = _update_task_status_error(context, task_dict, {
+            'data_dict': value.get('data_dict'),
+            'error': {'message': [error]},
+        })
+    return task_dict
+
+
 def _expire_task_status(context, task_id):
     '''Expires a TaskStatus object from the current Session
 
@@ -1096,36 +1622,41 @@ def resource_versions_show(context, data_dict):
     package_show = p.toolkit.get_action('package_show')
     dataset = package_show(context, {'name_or_id': package_id})
 
-    organisation = p.toolkit.get_action('organization_show')(
-        context, {'id': dataset['owner_org']})
-
     method, url = _get_api_endpoint('file_versions_show')
 
     url = url.format(
-        organization_id=organisation['id'],
+        organization_id=dataset['owner_org'],
         dataset_id=package_id,
         file_id=resource_id,
     )
 
     content = send_request_to_ec_platform(method, url, authorize=False)
 
-    res_ec_to_ckan = custom_schema.convert_ec_file_to_ckan_resource
     try:
         metadata = content['MetadataResultSet']
     except IndexError:
         return []
 
-    versions = []
-    if metadata:
-        for version in metadata:
-            ckan_resource = res_ec_to_ckan(version['FileMetadata'])
-            ckan_resource['version'] = version['Version']
-            versions.append(ckan_resource)
+    if not metadata:
+        return []
+
+    versions = custom_schema.convert_ec_files_to_ckan_resources(
+        [version['FileMetadata'] for version in metadata])
+    for ckan_resource, version in zip(versions, metadata):
+        ckan_resource['version'] = version['Version']
     return versions
 
 
 def check_for_task_status_update(context, data_dict):
-    '''Checks the EC Platform for updates and updates the TaskStatus'''
+    '''Checks the EC Platform for updates and updates the TaskStatus
+
+    :param task_id: the TaskStatus id
+    :type task_id: string
+    :param request_status: the changes for the request, as returned by
+        `get_change_request` or `request_status_batch` (optional). If
+        provided, the platform will not be queried again.
+    :type request_status: list
+    '''
     # TODO check access
     try:
         task_id = data_dict['task_id']
@@ -1145,64 +1676,71 @@ def check_for_task_status_update(context, data_dict):
     except KeyError:
         raise p.toolkit.ValidationError(['no request_id in task_status value'])
 
-    headers = {
-        'Authorization': _get_api_auth_token(),
-        'Content-Type': 'application/json',
-    }
+    request_status = data_dict.get('request_status')
+    if request_status:
+        change = request_status[-1]
+        latest = {
+            'Timestamp': change.get('timestamp'),
+            'OperationState': change.get('operation_state'),
+            'Message': change.get('message'),
+        }
+    else:
+        headers = {
+            'Authorization': _get_api_auth_token(),
+            'Content-Type': 'application/json',
+        }
 
-    verify_ssl = p.toolkit.asbool(
-        config.get('ckanext.glasgow.verify_ssl_certs', True)
-    )
-    response = requests.request(method, url, headers=headers,
-                                verify=verify_ssl)
-    if response.status_code == requests.codes.ok:
+        verify_ssl = p.toolkit.asbool(
+            config.get('ckanext.glasgow.verify_ssl_certs', True)
+        )
+        response = requests.request(method, url, headers=headers,
+                                    verify=verify_ssl)
+        if response.status_code != requests.codes.ok:
+            raise ECAPIError(['EC API returned an error: {0} - {1}'.format(
+                response.status_code, url)])
         try:
             result = response.json()
         except ValueError:
             raise ECAPIValidationError(['EC API Error: response not JSON'])
 
         latest = result['Operations'][-1]
-        latest_timestamp = dateutil.parser.parse(latest['Timestamp'],
-                                                 yearfirst=True)
 
-        task_status_timestamp = dateutil.parser.parse(
-            task_status['last_updated'])
+    latest_timestamp = dateutil.parser.parse(latest['Timestamp'],
+                                             yearfirst=True)
 
+    task_status_timestamp = dateutil.parser.parse(
+        task_status['last_updated'])
 
-        if latest_timestamp > task_status_timestamp:
-            if latest['OperationState'] == 'InProgress':
+    if latest_timestamp > task_status_timestamp:
+        if latest['OperationState'] == 'InProgress':
 
-               task_status['state'] = 'in_progress'
-               request_dict['ec_api_message'] = latest['Message']
+            task_status['state'] = 'in_progress'
+            request_dict['ec_api_message'] = latest['Message']
 
-            elif latest['OperationState'] == 'Failed':
+        elif latest['OperationState'] == 'Failed':
 
-               task_status['state'] = 'error'
-               task_status['error'] = latest['Message']
+            task_status['state'] = 'error'
+            task_status['error'] = latest['Message']
 
+        elif latest['OperationState'] == 'Succeeded':
+            task_status['state'] = 'succeeded'
+            request_dict['ec_api_message'] = latest['Message']
 
-            elif latest['OperationState'] == 'Succeeded':
-                task_status['state'] = 'succeeded'
-                request_dict['ec_api_message'] = latest['Message']
+            # call dataset_create/user_create/etc
+            try:
+                on_task_status_success(context, task_status)
+            except NoSuchTaskType, e:
+                task_status['state'] = 'error'
+                # todo: fix abuse of task_status.value
+                request_dict['ec_api_message'] = e.message
 
-                # call dataset_create/user_create/etc
-                try:
-                    on_task_status_success(context, task_status)
-                except NoSuchTaskType, e:
-                    task_status['state'] = 'error'
-                    # todo: fix abuse of task_status.value
-                    request_dict['ec_api_message'] = e.message
-
-            task_status.update({
-                'value': json.dumps(request_dict),
-                'last_updated': latest['Timestamp'],
-            })
+        task_status.update({
+            'value': json.dumps(request_dict),
+            'last_updated': latest['Timestamp'],
+        })
 
-            return  p.toolkit.get_action('task_status_update')(context,
-                                                               task_status)
-    else:
-        raise ECAPIError(['EC API returned an error: {0} - {1}'.format(
-            response.status_code, url)])
+        return  p.toolkit.get_action('task_status_update')(context,
+                                                           task_status)
 
 
 class NoSuchTaskType(Exception):
@@ -1242,33 +1780,37 @@ def on_task_status_success(context, task_status_dict):
         raise NoSuchTaskType('no such task type {0}'.format(task_type))
 
 
-@p.toolkit.side_effect_free
-def get_change_request(context, data_dict):
-    p.toolkit.check_access('get_change_request', context, data_dict)
-    try:
-        request_id = data_dict['id']
-    except KeyError:
-        raise p.toolkit.ValidationError(['id missing'])
-
-    method, url = _get_api_endpoint('request_status_show')
-    url = url.format(request_id=request_id)
+def _get_request_status_headers():
+    '''Returns the headers needed to query the request status endpoint
 
+    :raises: :py:exc:`ECAPIError` if the service to service auth token
+        could not be obtained
+    '''
     import ckanext.oauth2waad.plugin as oauth2waad_plugin
     try:
         access_token = oauth2waad_plugin.service_to_service_access_token('metadata')
         if not access_token.startswith('Bearer '):
             access_token = 'Bearer ' + access_token
-        headers = {
+        return {
             'Authorization': access_token,
             'Content-Type': 'application/json',
         }
     except oauth2waad_plugin.ServiceToServiceAccessTokenError, e:
         raise ECAPIError(['EC API Error: Failed to get service auth {0}'.format(e.message)])
 
+
+def _request_status_show(request_id, headers):
+    '''Requests the list of changes for a request id to the EC API
+
+    Keys on the returned dicts are changed from CamelCase to underscores.
+    '''
+    method, url = _get_api_endpoint('request_status_show')
+    url = url.format(request_id=request_id)
+
     verify_ssl = p.toolkit.asbool(
         config.get('ckanext.glasgow.verify_ssl_certs', True)
     )
-    response = requests.request(method, url, headers=headers, 
+    response = requests.request(method, url, headers=headers,
                                 verify=verify_ssl)
     if response.status_code == requests.codes.ok:
         try:
@@ -1290,26 +1832,255 @@ def get_change_request(context, data_dict):
 
 
 @p.toolkit.side_effect_free
-def changelog_show(context, data_dict):
+def get_change_request(context, data_dict):
+    p.toolkit.check_access('get_change_request', context, data_dict)
+    try:
+        request_id = data_dict['id']
+    except KeyError:
+        raise p.toolkit.ValidationError(['id missing'])
+
+    headers = _get_request_status_headers()
+
+    return _request_status_show(request_id, headers)
+
+
+# Changes for requests that already succeeded or failed on the platform will
+# not change anymore, so they are kept for the lifetime of the process. The
+# rest are kept for `ckanext.glasgow.request_status_cache_ttl` seconds.
+# request_id -> (fetched timestamp, is final, list of changes)
+# Request statuses by request id, least recently used first. Entries are
+# dropped once expired (see `request_status_batch`) or when there are more
+# than `ckanext.glasgow.request_status_cache_size` (default 1000).
+_request_status_cache = OrderedDict()
+_request_status_cache_lock = threading.Lock()
+
+_request_status_final_states = ('Succeeded', 'Failed')
+_task_status_final_states = ('finished', 'succeeded', 'error')
+
+
+def _get_cached_request_status(request_id, now, ttl, final_ttl):
+    '''Returns the cached changes for a request, or None if not cached
+
+    Expired entries are removed from the cache.
     '''
-    Requests audit entries to the EC API Changelog API
+    with _request_status_cache_lock:
+        for cached_id, (fetched, is_final, changes) in \
+                _request_status_cache.items():
+            age = (now - fetched).total_seconds()
+            if age >= (final_ttl if is_final else ttl):
+                del _request_status_cache[cached_id]
+
+        cached = _request_status_cache.pop(request_id, None)
+        if cached is None:
+            return None
+        _request_status_cache[request_id] = cached
+        return cached[2]
+
+
+def _cache_request_status(request_id, now, is_final, changes):
+    max_size = int(config.get('ckanext.glasgow.request_status_cache_size',
+                              1000))
+    with _request_status_cache_lock:
+        _request_status_cache.pop(request_id, None)
+        _request_status_cache[request_id] = (now, is_final, changes)
+        while len(_request_status_cache) > max_size:
+            _request_status_cache.popitem(last=False)
+
+
+def _get_local_request_status(request_id, task):
+    '''Returns the changes for a request whose local task is final
+
+    The platform is not asked again, a single change is built from the task
+    state.
+    '''
+    succeeded = task.state != 'error'
+    return [{
+        'request_id': request_id,
+        'operation_state': 'Succeeded' if succeeded else 'Failed',
+        'timestamp': (task.last_updated.isoformat() if task.last_updated
+                      else None),
+        'message': None if succeeded else task.error,
+    }]
 
-    :param audit_id: The starting audit_id to return a set of changelog
-                     records for. All records created since this audit_id
-                     are returned (up until `top`)
-                     If omitted then the single most recent changelog
-                     record is returned.
-    :type audit_id: string
-    :param top: Number of records to return (defaults to 20)
-    :type top: int
-    :param object_type: Limit records to this particular type (valid values
-                        are `Dataset`, `File` or `Organisation`)
-    :type object_type: string
 
-    :returns: a list with the returned audit objects
-    :rtype: list
+def _get_tasks_for_request_ids(request_ids):
+    '''Returns a dict with the TaskStatus objects for the provided request ids
+
+    All tasks are loaded with a single query on the indexed request ids.
+    Requests without a task in the task_status table are looked up in the
+    archive.
     '''
+    if not request_ids:
+        return {}
+
+    tasks_by_request_id = dict(get_tasks_for_request_ids(request_ids))
+
+    missing = [request_id for request_id in request_ids
+               if request_id not in tasks_by_request_id]
+    if missing:
+        for task in get_archived_tasks(request_ids=missing):
+            tasks_by_request_id.setdefault(task.request_id, task)
+
+    return tasks_by_request_id
 
+
+@p.toolkit.side_effect_free
+def request_status_batch(context, data_dict):
+    '''
+    Returns the changes for several requests on the EC platform
+
+    Requests whose local task is finished are not requested to the
+    platform, the status is built from the task. The rest are served from
+    a process cache when possible: for
+    `ckanext.glasgow.request_status_cache_ttl` seconds (default 60), or
+    `ckanext.glasgow.request_status_final_cache_ttl` (default 3600) for
+    requests that succeeded or failed on the platform. Requests not cached
+    are requested concurrently (up to
+    `ckanext.glasgow.request_status_workers` at the same time, default 5).
+
+    :param request_ids: Request ids to check, either a list or a comma
+                        separated string
+    :type request_ids: list
+
+    :returns: a dict with request ids as keys and lists of changes as values
+              (with the same format as `get_change_request`). Values are None
+              for requests that could not be retrieved.
+    :rtype: dict
+    '''
+    p.toolkit.check_access('get_change_request', context, data_dict)
+
+    request_ids = data_dict.get('request_ids') or []
+    if isinstance(request_ids, basestring):
+        request_ids = request_ids.split(',')
+
+    unique_ids = []
+    for request_id in request_ids:
+        request_id = request_id.strip() if request_id else None
+        if request_id and request_id not in unique_ids:
+            unique_ids.append(request_id)
+    request_ids = unique_ids
+
+    ttl = int(config.get('ckanext.glasgow.request_status_cache_ttl', 60))
+    final_ttl = int(config.get(
+        'ckanext.glasgow.request_status_final_cache_ttl', 3600))
+    now = datetime.datetime.utcnow()
+
+    tasks = _get_tasks_for_request_ids(request_ids)
+
+    results = {}
+    to_fetch = []
+    for request_id in request_ids:
+        task = tasks.get(request_id)
+        if task and task.state in _task_status_final_states:
+            results[request_id] = _get_local_request_status(request_id,
+                                                            task)
+            continue
+        changes = _get_cached_request_status(request_id, now, ttl,
+                                             final_ttl)
+        if changes is not None:
+            results[request_id] = changes
+            continue
+        to_fetch.append(request_id)
+
+    if to_fetch:
+        headers = _get_request_status_headers()
+
+        def fetch(request_id):
+            try:
+                return request_id, _request_status_show(request_id, headers)
+            except (ECAPIError, requests.exceptions.RequestException), e:
+                log.warning('Could not get status for request {0}: {1}'.format(
+                    request_id, str(e)))
+                return request_id, None
+
+        workers = int(config.get('ckanext.glasgow.request_status_workers', 5))
+        pool = ThreadPool(max(1, min(workers, len(to_fetch))))
+        try:
+            fetched = pool.map(fetch, to_fetch)
+        finally:
+            pool.close()
+            pool.join()
+
+        for request_id, changes in fetched:
+            results[request_id] = changes
+            if changes is None:
+                continue
+            is_final = bool(changes) and (changes[-1].get('operation_state')
+                                          in _request_status_final_states)
+            _cache_request_status(request_id, now, is_final, changes)
+
+    return results
+
+
+# Characters that change the parsing state when reading a JSON array
+_json_array_tokens = re.compile(r'[\[\]{}",\\]')
+
+
+def _iter_json_array(chunks):
+    '''Yields the items of a JSON array read from an iterable of byte chunks
+
+    Only the text of the item being read is kept in memory, so big
+    responses can be processed as they are received. Raises ValueError if
+    the content is not a JSON array.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = u''
+    pos = 0
+    # -1 until the opening bracket of the array is found
+    depth = -1
+    in_string = False
+    while True:
+        match = _json_array_tokens.search(buf, pos)
+        if not match:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                raise ValueError('Unexpected end of JSON array')
+            # pos can be past the end of buf if the last character was an
+            # escape, in which case the next one is skipped
+            pos = max(pos, len(buf))
+            buf += decoder.decode(chunk)
+            continue
+
+        char, pos = match.group(), match.end()
+        if in_string:
+            if char == '\\':
+                pos += 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif depth == -1:
+            if char != '[' or buf[:match.start()].strip():
+                raise ValueError('Expected a JSON array')
+            depth = 0
+            buf, pos = buf[pos:], 0
+        elif char in '[{':
+            depth += 1
+        elif depth > 0:
+            if char in ']}':
+                depth -= 1
+        elif char in ',]':
+            item = buf[:match.start()].strip()
+            if item:
+                yield json.loads(item)
+            elif char == ',':
+                raise ValueError('Empty item in JSON array')
+            if char == ']':
+                return
+            buf, pos = buf[pos:], 0
+        else:
+            raise ValueError('Invalid JSON array')
+
+
+def _iter_changelog(context, data_dict):
+    '''Requests audit entries to the EC API Changelog API as a stream
+
+    Accepts the same parameters as `changelog_show`, but returns an
+    iterator over the audits, which are parsed as the response is read.
+    Errors returned by the API are raised straight away.
+    '''
     p.toolkit.check_access('changelog_show', context, data_dict)
 
     audit_id = data_dict.get('audit_id')
@@ -1346,15 +2117,14 @@ def changelog_show(context, data_dict):
         config.get('ckanext.glasgow.verify_ssl_certs', True)
     )
     response = requests.request(method, url, headers=headers, params=params,
-                                verify=verify_ssl)
-
-    content = response.json()
+                                verify=verify_ssl, stream=True)
 
     # Check status codes
 
     status_code = response.status_code
 
     if status_code != 200:
+        content = response.json()
         error_dict = {
             'message': ['The CTPEC API returned an error code'],
             'status': [status_code],
@@ -1365,7 +2135,31 @@ def changelog_show(context, data_dict):
         else:
             raise p.toolkit.ValidationError(error_dict)
 
-    return content
+    return _iter_json_array(_iter_response_content(response, 64 * 1024))
+
+
+@p.toolkit.side_effect_free
+def changelog_show(context, data_dict):
+    '''
+    Requests audit entries to the EC API Changelog API
+
+    :param audit_id: The starting audit_id to return a set of changelog
+                     records for. All records created since this audit_id
+                     are returned (up until `top`)
+                     If omitted then the single most recent changelog
+                     record is returned.
+    :type audit_id: string
+    :param top: Number of records to return (defaults to 20)
+    :type top: int
+    :param object_type: Limit records to this particular type (valid values
+                        are `Dataset`, `File` or `Organisation`)
+    :type object_type: string
+
+    :returns: a list with the returned audit objects
+    :rtype: list
+    '''
+
+    return list(_iter_changelog(context, data_dict))
 
 
 def organization_create(context, data_dict):
@@ -1375,7 +2169,10 @@ def organization_create(context, data_dict):
 
     if (context.get('local_action', False) or
             data_dict.get('type') == 'harvest'):
-        return core_actions.create.organization_create(context, data_dict)
+        org_dict = core_actions.create.organization_create(context, data_dict)
+        _clear_organization_id_cache()
+        _clear_organization_list_cache()
+        return org_dict
     else:
         return p.toolkit.get_action('organization_request_create')(context,
                                                                    data_dict)
@@ -1442,7 +2239,10 @@ def organization_update(context, data_dict):
             data_dict.get('type') == 'harvest' or
             data_dict.get('source_type')):
 
-        return core_actions.update.organization_update(context, data_dict)
+        org_dict = core_actions.update.organization_update(context, data_dict)
+        _clear_organization_id_cache()
+        _clear_organization_list_cache()
+        return org_dict
 
     else:
 
@@ -1513,6 +2313,13 @@ def organization_request_update(context, data_dict):
     }
 
 
+def _get_loggable_data(data):
+    '''Streamed bodies can't be stored, just keep their form fields'''
+    if isinstance(data, MultipartStream):
+        return dict(data.fields)
+    return data
+
+
 def send_request_to_ec_platform(method, url, data=None, headers=None,
                                 authorize=True, **kwargs):
 
@@ -1548,7 +2355,7 @@ def send_request_to_ec_platform(method, url, data=None, headers=None,
         }
         if task_dict:
             task_dict = _update_task_status_error(context, task_dict, {
-                'data_dict': data,
+                'data_dict': _get_loggable_data(data),
                 'error': error_dict
             })
 
@@ -1567,7 +2374,7 @@ def send_request_to_ec_platform(method, url, data=None, headers=None,
 
         if task_dict:
             task_dict = _update_task_status_error(context, task_dict, {
-                'data_dict': data,
+                'data_dict': _get_loggable_data(data),
                 'error': error_dict
             })
         raise p.toolkit.ValidationError(error_dict)
@@ -1592,7 +2399,10 @@ def organization_member_create(context, data_dict):
     if (context.get('local_action', False) or
             data_dict.get('type') == 'harvest' or
             data_dict.get('source_type')):
-        return core_actions.create.organization_member_create(context, data_dict)
+        member_dict = core_actions.create.organization_member_create(
+            context, data_dict)
+        _clear_organization_list_cache()
+        return member_dict
     else:
         check_access('organization_member_create', context, data_dict)
         create_schema = core_schema.member_schema()
@@ -1614,8 +2424,10 @@ def organization_member_create(context, data_dict):
         # editors/admins. If it's a ckan member assignment, use the core
         # action, if it's a CTPEC user send it to CTPEC
         if validated_data_dict.get('role') == 'member' and not ec_user:
-                return core_actions.create.organization_member_create(context,
-                                                                      data_dict)
+                member_dict = core_actions.create.organization_member_create(
+                    context, data_dict)
+                _clear_organization_list_cache()
+                return member_dict
 
         elif validated_data_dict.get('role') != 'member' and ec_user:
             if ec_user.get('OrganisationId'):
@@ -1760,7 +2572,10 @@ def organization_member_delete(context, data_dict):
     if (context.get('local_action', False) or
             data_dict.get('type') == 'harvest' or
             data_dict.get('source_type')):
-        return core_actions.delete.organization_member_delete(context, data_dict)
+        result = core_actions.delete.organization_member_delete(context,
+                                                                data_dict)
+        _clear_organization_list_cache()
+        return result
     else:
         check_access('organization_member_delete', context, data_dict)
 
@@ -1782,10 +2597,12 @@ def organization_member_delete(context, data_dict):
             ec_user = None
 
         if not ec_user:
-            return core_actions.delete.organization_member_delete(
+            result = core_actions.delete.organization_member_delete(
                 context,
                 data_dict,
             )
+            _clear_organization_list_cache()
+            return result
         else:
             return user_role_delete(context, ckan_user['id'], group_id)
 
@@ -2063,12 +2880,60 @@ def approval_act(context, data_dict):
     return True
 
 
+def _iter_response_content(response, chunk_size):
+    '''Yields the body of a streamed response in chunks
+
+    The connection is released once the body has been consumed or the
+    iterator is closed.
+    '''
+    try:
+        for chunk in response.iter_content(chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        response.close()
+
+
+def _iter_raw_response_content(response, chunk_size):
+    '''Yields the body of a streamed response as sent by the server
+
+    Unlike `_iter_response_content`, compressed bodies are not decoded, so
+    the content matches the Content-Length, Content-Range and
+    Content-Encoding headers of the response.
+    '''
+    try:
+        while True:
+            chunk = response.raw.read(chunk_size, decode_content=False)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        response.close()
+
+
 def approval_download(context, data_dict):
     '''
     Download a file pending approval
 
+    The file is not loaded in memory, the returned `content` is an iterator
+    over the response body, in chunks of `ckanext.glasgow.download_chunk_size`
+    bytes (default 64Kb).
+
+    The body is returned as sent by the platform, without decoding any
+    Content-Encoding, so byte ranges and the response headers can be
+    passed on to the client as they are.
+
     :param request_id: Request id to act upon
     :type top: string
+    :param range: Value of an HTTP Range header to forward to the platform,
+                  eg to resume a download (optional)
+    :type range: string
+    :param if_range: Value of an HTTP If-Range header to forward to the
+                     platform (optional)
+    :type if_range: string
+
+    :returns: a dict with the response `status`, `headers` and `content`
+    :rtype: dict
 
     '''
 
@@ -2087,21 +2952,28 @@ def approval_download(context, data_dict):
     headers = {
         'Authorization': _get_api_auth_token(),
     }
+    if data_dict.get('range'):
+        headers['Range'] = data_dict['range']
+        if data_dict.get('if_range'):
+            headers['If-Range'] = data_dict['if_range']
 
     verify_ssl = p.toolkit.asbool(
         config.get('ckanext.glasgow.verify_ssl_certs', True)
     )
 
     response = requests.request(method, url, headers=headers,
-                                verify=verify_ssl)
+                                verify=verify_ssl, stream=True)
 
     # Check status codes
 
     status_code = response.status_code
 
-    if status_code != 200:
+    if status_code not in (200, 206):
 
-        content = response.json()
+        try:
+            content = response.json()
+        except ValueError:
+            content = response.content
         error_dict = {
             'message': ['The CTPEC API returned an error code'],
             'status': [status_code],
@@ -2112,9 +2984,13 @@ def approval_download(context, data_dict):
         else:
             raise p.toolkit.ValidationError(error_dict)
 
+    chunk_size = int(config.get('ckanext.glasgow.download_chunk_size',
+                                64 * 1024))
+
     return {
+        'status': status_code,
         'headers': response.headers,
-        'content': response.content,
+        'content': _iter_raw_response_content(response, chunk_size),
     }
 
 
@@ -2128,6 +3004,11 @@ def organization_list_for_user(context, data_dict):
     :param user: the id or username of the user.
       (optional, default: current logged in user)
 
+    :param lightweight: only return the id, name, title and the user
+      capacity of each organization, which is much cheaper (optional,
+      default: ``False``)
+    :type lightweight: bool
+
     :returns: list of dictized organizations that the user is authorized to edit
     :rtype: list of dicts
 
@@ -2138,38 +3019,18 @@ def organization_list_for_user(context, data_dict):
         user = context['user']
 
     p.toolkit.check_access('organization_list_for_user',context, data_dict)
-    sysadmin = new_authz.is_sysadmin(user)
-
-    orgs_q = model.Session.query(model.Group) \
-        .filter(model.Group.is_organization == True) \
-        .filter(model.Group.state == 'active')
-
-    if not sysadmin:
-        # for non-Sysadmins check they have the required permission
 
-        permission = data_dict.get('permission', 'edit_group')
-
-        roles = new_authz.get_roles_with_permission(permission)
-
-        if not roles:
-            return []
-        user_id = new_authz.get_user_id_for_username(user, allow_none=True)
-        if not user_id:
-            return []
-
-        q = model.Session.query(model.Member.group_id) \
-            .filter(model.Member.table_name == 'user') \
-            .filter(model.Member.capacity.in_(roles)) \
-            .filter(model.Member.table_id == user_id)
+    permission = data_dict.get('permission', 'edit_group')
+    orgs = _get_organizations_for_user(user, permission)
 
-        group_ids = []
-        for row in q.all():
-            group_ids.append(row.group_id)
+    if p.toolkit.asbool(data_dict.get('lightweight', False)):
+        return orgs
 
-        if not group_ids:
-            return []
+    if not orgs:
+        return []
 
-        orgs_q = orgs_q.filter(model.Group.id.in_(group_ids))
+    orgs_q = model.Session.query(model.Group) \
+        .filter(model.Group.id.in_([org['id'] for org in orgs]))
 
     orgs_list = model_dictize.group_list_dictize(orgs_q.all(), context)
     return orgs_list
@@ -2395,23 +3256,6 @@ def file_version_request_create(context, data_dict):
 
     uploaded_file = data_dict.pop('upload', None)
 
-    if isinstance(uploaded_file, cgi.FieldStorage):
-        files = {
-            'file': (uploaded_file.filename,
-                     uploaded_file.file)
-        }
-        data = {
-            'metadata': json.dumps(ec_dict)
-        }
-    else:
-        headers['Content-Type'] = 'application/json'
-        files = None
-
-        # Use ExternalUrl instead of FileExternalUrl
-        ec_dict['ExternalUrl'] = ec_dict.pop('FileExternalUrl', None)
-
-        data = json.dumps(ec_dict)
-
     key = '{0}@{1}'.format(validated_data_dict.get('package_id', 'file'),
                            datetime.datetime.now().isoformat())
 
@@ -2424,6 +3268,20 @@ def file_version_request_create(context, data_dict):
                                         {'data_dict': data_dict})
                                     )
 
+    if isinstance(uploaded_file, cgi.FieldStorage):
+        files = None
+        data = _get_file_upload_body(uploaded_file.filename,
+                                     uploaded_file.file, ec_dict, task_dict)
+        headers['Content-Type'] = data.content_type
+    else:
+        headers['Content-Type'] = 'application/json'
+        files = None
+
+        # Use ExternalUrl instead of FileExternalUrl
+        ec_dict['ExternalUrl'] = ec_dict.pop('FileExternalUrl', None)
+
+        data = json.dumps(ec_dict)
+
     request = send_request_to_ec_platform(method, url, headers=headers,
                                           data=data, files=files)
 
@@ -2549,6 +3407,14 @@ def user_list(context, data_dict):
     :param order_by: which field to sort the list by (optional, default:
       ``'name'``)
     :type order_by: string
+    :param limit: maximum number of users to return (optional)
+    :type limit: int
+    :param offset: number of users to skip (optional)
+    :type offset: int
+
+    The number of edits and administered datasets of each user come from
+    the counts table refreshed by `glasgow_db users counts`, so they can be
+    slightly out of date.
 
     :rtype: list of dictionaries
 
@@ -2560,6 +3426,9 @@ def user_list(context, data_dict):
     q = data_dict.get('q','')
     order_by = data_dict.get('order_by','name')
 
+    number_of_edits = func.coalesce(user_counts_table.c.number_of_edits, 0)
+    number_administered_packages = func.coalesce(
+        user_counts_table.c.number_administered_packages, 0)
 
     query = model.Session.query(
         model.User,
@@ -2568,29 +3437,16 @@ def user_list(context, data_dict):
         model.User.about.label('about'),
         model.User.about.label('email'),
         model.User.created.label('created'),
-        select([func.count(model.Revision.id)], or_(
-                model.Revision.author==model.User.name,
-                model.Revision.author==model.User.openid
-                )
-        ).label('number_of_edits'),
-        select([func.count(model.UserObjectRole.id)], and_(
-            model.UserObjectRole.user_id==model.User.id,
-            model.UserObjectRole.context=='Package',
-            model.UserObjectRole.role=='admin'
-            )
-        ).label('number_administered_packages')
-    )
+        number_of_edits.label('number_of_edits'),
+        number_administered_packages.label('number_administered_packages'),
+    ).outerjoin(user_counts_table,
+                user_counts_table.c.user_id == model.User.id)
 
     if q:
         query = model.User.search(q, query, user_name=context.get('user'))
 
     if order_by == 'edits':
-        query = query.order_by(desc(
-            select([func.count(model.Revision.id)], or_(
-                model.Revision.author==model.User.name,
-                model.Revision.author==model.User.openid
-                ))
-        ))
+        query = query.order_by(desc(number_of_edits), model.User.name)
     else:
         query = query.order_by(
             case([(or_(model.User.fullname == None, model.User.fullname == ''),
@@ -2611,10 +3467,37 @@ def user_list(context, data_dict):
     if context.get('return_query'):
         return query
 
-    users_list = []
+    limit = _get_int_param(data_dict, 'limit')
+    if limit is not None:
+        query = query.limit(limit)
+    offset = _get_int_param(data_dict, 'offset')
+    if offset:
+        query = query.offset(offset)
+
+    return [_user_list_dictize(row, context, sysadmin) for row in query]
 
-    for user in query.all():
-        result_dict = model_dictize.user_dictize(user[0], context)
-        users_list.append(result_dict)
 
-    return users_list
+def _user_list_dictize(row, context, sysadmin):
+    '''Dictizes a row of the `user_list` query
+
+    Works like `user_dictize`, but takes the counts from the row instead of
+    querying them for each user.
+    '''
+    user = row[0]
+    result_dict = table_dictize(user, context)
+    del result_dict['password']
+
+    result_dict['display_name'] = user.display_name
+    result_dict['email_hash'] = user.email_hash
+    result_dict['number_of_edits'] = row.number_of_edits
+    result_dict['number_administered_packages'] = \
+        row.number_administered_packages
+
+    if not (sysadmin or context.get('user') == user.name
+            or context.get('keep_sensitive_data', False)):
+        # If not sysadmin or the same user, strip sensible info
+        result_dict.pop('apikey', None)
+        result_dict.pop('reset_key', None)
+        result_dict.pop('email', None)
+
+    return result_dict
@@ -84,6 +84,12 @@ def pending_user_tasks(context, data_dict):
     return approvals_list(context, data_dict)
 
 
+def task_status_archive_list(context, data_dict):
+    if data_dict.get('entity_type') == 'dataset':
+        return pending_task_for_dataset(context, data_dict)
+    return approvals_list(context, data_dict)
+
+
 def changelog_show(context, data_dict):
     return {'success': False,
             'msg': 'Only sysadmins can see the change log'}
@@ -1,3 +1,5 @@
+import functools
+
 from ckan.logic.schema import (
     default_create_package_schema,
     default_update_package_schema,
@@ -43,6 +45,39 @@ get_converter = p.toolkit.get_converter
 not_empty = get_validator('not_empty')
 ignore_missing = get_validator('ignore_missing')
 
+
+def _copy_schema(schema):
+    '''Copies the dicts and lists of a schema, sharing the validators'''
+    if isinstance(schema, dict):
+        return dict((key, _copy_schema(value))
+                    for key, value in schema.iteritems())
+    elif isinstance(schema, list):
+        return [_copy_schema(value) for value in schema]
+    return schema
+
+
+def cached_schema(func):
+    '''Builds a schema only once and returns copies of it
+
+    Building the schemas involves lots of `get_validator` calls and new
+    validator closures, which adds up when validating many datasets. The
+    schema is built on the first call and kept as a template that is never
+    handed out. Callers get a copy of its dicts and lists (the validators are
+    shared), so they can modify it safely.
+
+    The undecorated function is available as `build`.
+    '''
+    template = []
+
+    @functools.wraps(func)
+    def wrapper():
+        if not template:
+            template.append(func())
+        return _copy_schema(template[0])
+
+    wrapper.build = func
+    return wrapper
+
 # CKAN to EC API mappings
 
 ckan_to_ec_organization_mapping = {
@@ -98,6 +133,20 @@ ckan_to_ec_user_mapping = {
     'email': 'Email',
 }
 
+# EC API to CKAN field maps, as (ec_name, ckan_name) tuples
+
+_ec_to_ckan_dataset_fields = tuple(
+    (ec_name, ckan_name)
+    for ckan_name, ec_name in ckan_to_ec_dataset_mapping.iteritems()
+    if ec_name != 'Tags')
+
+_ec_to_ckan_resource_fields = tuple(
+    (ec_name, ckan_name)
+    for ckan_name, ec_name in ckan_to_ec_resource_mapping.iteritems())
+
+# Other platform keys not in the mappings
+_ec_other_keys = frozenset(['CreatedBy'])
+
 
 def convert_ckan_organization_to_ec_organization(ckan_dict):
 
@@ -154,9 +203,9 @@ def convert_ec_dataset_to_ckan_dataset(ec_dict):
 
     ckan_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_dataset_mapping.iteritems():
-        if ec_name != 'Tags' and ec_name in ec_dict:
-            ckan_dict[ckan_name] = ec_dict.get(ec_name)
+    for ec_name, ckan_name in _ec_to_ckan_dataset_fields:
+        if ec_name in ec_dict:
+            ckan_dict[ckan_name] = ec_dict[ec_name]
 
     if ec_dict.get('Tags'):
         ckan_dict['tags'] = [{'name': tag}
@@ -168,20 +217,9 @@ def convert_ec_dataset_to_ckan_dataset(ec_dict):
 
     # Arbitrary stuff stored as extras
 
-    keys_to_avoid = []
-
-    # Platform keys
-    keys_to_avoid.extend([v for k, v in ckan_to_ec_dataset_mapping.iteritems()])
-
-    # Other platform keys not in the mapping
-    keys_to_avoid.extend(['CreatedBy'])
-
-    # CKAN keys
-    keys_to_avoid.extend(create_package_schema().keys())
-
     ckan_dict['extras'] = []
     for key, value in ec_dict.iteritems():
-        if key not in keys_to_avoid:
+        if key not in _ec_dataset_keys_to_avoid:
             ckan_dict['extras'].append({'key': key, 'value': value})
 
     return ckan_dict
@@ -211,27 +249,22 @@ def convert_ec_file_to_ckan_resource(ec_dict):
 
     ckan_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_resource_mapping.iteritems():
+    for ec_name, ckan_name in _ec_to_ckan_resource_fields:
         ckan_dict[ckan_name] = ec_dict.get(ec_name)
 
-    keys_to_avoid = []
-
-    # Platform keys
-    keys_to_avoid.extend([v for k, v in ckan_to_ec_resource_mapping.iteritems()])
-
-    # Other platform keys not in the mapping
-    keys_to_avoid.extend(['CreatedBy'])
-
-    # CKAN keys
-    keys_to_avoid.extend(resource_schema().keys())
-
     for key, value in ec_dict.iteritems():
-        if key not in keys_to_avoid:
+        if key not in _ec_resource_keys_to_avoid:
             ckan_dict[key] = value
 
     return ckan_dict
 
 
+def convert_ec_files_to_ckan_resources(ec_dicts):
+    '''Converts a list of EC API file metadata dicts to CKAN resource dicts'''
+    return [convert_ec_file_to_ckan_resource(ec_dict)
+            for ec_dict in ec_dicts]
+
+
 def convert_ckan_member_to_ec_member(ckan_dict):
     role_dict = {
         'admin': 'OrganisationAdmin',
@@ -287,6 +320,7 @@ def convert_ckan_user_to_ec_user(ckan_dict):
     return ec_dict
 
 
+@cached_schema
 def create_package_schema():
     schema = default_create_package_schema()
 
@@ -308,6 +342,7 @@ def custom_extras_schema():
     return schema
 
 
+@cached_schema
 def ec_create_package_schema():
     '''Schema for validated data dicts
 
@@ -339,6 +374,7 @@ def ec_create_user_schema():
     }
 
 
+@cached_schema
 def update_package_schema():
     schema = default_update_package_schema()
 
@@ -419,6 +455,7 @@ def _modify_schema(schema):
                               tag_length_validator]
 
 
+@cached_schema
 def show_package_schema():
 
     schema = default_show_package_schema()
@@ -451,6 +488,7 @@ def show_package_schema():
     return schema
 
 
+@cached_schema
 def resource_schema():
     schema = _modify_resource_schema()
 
@@ -522,6 +560,7 @@ def _modify_resource_schema():
     return schema
 
 
+@cached_schema
 def create_group_schema():
     boolean_validator = get_validator('boolean_validator')
     not_missing = get_validator('not_missing')
@@ -579,3 +618,17 @@ def user_update_schema():
     schema = default_update_user_schema()
     schema['name'] = [ignore_missing, url_name_validator, user_name_validator, unicode]
     return schema
+
+
+# Keys that are not stored as extras when converting EC API objects: the
+# platform keys plus the CKAN schema keys. The schemas are only built once
+# here rather than on every conversion.
+
+package_schema_keys = frozenset(create_package_schema().keys())
+resource_schema_keys = frozenset(resource_schema().keys())
+
+_ec_dataset_keys_to_avoid = (frozenset(ckan_to_ec_dataset_mapping.values())
+                             | _ec_other_keys | package_schema_keys)
+
+_ec_resource_keys_to_avoid = (frozenset(ckan_to_ec_resource_mapping.values())
+                              | _ec_other_keys | resource_schema_keys)
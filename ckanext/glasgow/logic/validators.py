@@ -15,6 +15,8 @@ from ckan.model import (
     PACKAGE_NAME_MAX_LENGTH,
 )
 
+from ckanext.glasgow.model import get_datasets_with_title
+
 # Reference some stuff from the toolkit
 _ = p.toolkit._
 Invalid = p.toolkit.Invalid
@@ -38,25 +40,12 @@ def unique_title_within_organization(key, data, errors, context):
         raise Invalid(
             _('Please provide an organization for the dataset')
         )
-    # We need to use title_string rather the title otherwise we cannot query
-    # by exact match. This syntax to cover most common cases is horrible, but
-    # it saves us from having a custom Solr schema
-    search_dict = {
-        'q': 'title_string:"%s" OR title_string:"%s" OR title_string:"%s" OR title_string:"%s" OR title_string:"%s"' % (value, value.upper(), value.lower(), value.title(), value.capitalize()),
-        'fq': 'owner_org:{0}'.format(org_id),
-    }
-
-    query = p.toolkit.get_action('package_search')({
-        'ignore_auth': True}, search_dict)
-
-    if query['count'] > 0:
-        if (query['count'] == 1
-                and len(query['results'])
-                and (query['results'][0]['id'] == data.get(('id', ))
-                     or query['results'][0]['name'] == data.get(('id', )))):
-            # If we are updating the dataset then having the same title is ok!
-            pass
-        else:
+
+    # Titles are compared ignoring case and extra whitespace
+    current_id = data.get(('id', ))
+    for dataset_id, dataset_name in get_datasets_with_title(org_id, value):
+        # If we are updating the dataset then having the same title is ok!
+        if current_id not in (dataset_id, dataset_name):
             raise Invalid(
                 _('There is a dataset with the same title in this organization')
             )
@@ -1,10 +1,16 @@
+import json
 import datetime
+import logging
 
 import sqlalchemy
+import sqlalchemy.orm
 
 import ckan
 
 
+log = logging.getLogger(__name__)
+
+
 harvest_last_audit_table = sqlalchemy.Table(
     'harvest_last_audit', ckan.model.meta.metadata,
     sqlalchemy.Column('id',
@@ -18,20 +24,691 @@ harvest_last_audit_table = sqlalchemy.Table(
     sqlalchemy.Column('created',
                       sqlalchemy.types.DateTime,
                       default=datetime.datetime.utcnow),
+    # Number of new audits read by the job, used to schedule the next one
+    sqlalchemy.Column('audit_count',
+                      sqlalchemy.types.Integer),
+    # Object type of the changelog lane, or None for the default one
+    sqlalchemy.Column('object_type',
+                      sqlalchemy.types.UnicodeText),
     )
 
 
 class HarvestLastAudit(ckan.model.DomainObject):
-    def __init__(self, audit_id, harvest_job_id, created=None):
+    def __init__(self, audit_id, harvest_job_id, created=None,
+                 audit_count=None, object_type=None):
         self.audit_id = audit_id
         self.harvest_job_id = harvest_job_id
-        self.created = created
+        # Setting it to None would skip the column default
+        if created:
+            self.created = created
+        self.audit_count = audit_count
+        self.object_type = object_type
 
 
 ckan.model.meta.mapper(HarvestLastAudit,
                        harvest_last_audit_table)
 
 
+# Audits successfully imported by the changelog harvester, so audits
+# gathered again (eg after resetting the audit cursor or by overlapping
+# jobs) are not imported twice. Rows older than the retention period are
+# removed by the `db_clean audits` command.
+processed_audit_table = sqlalchemy.Table(
+    'glasgow_processed_audit', ckan.model.meta.metadata,
+    sqlalchemy.Column('audit_id',
+                      sqlalchemy.types.UnicodeText,
+                      primary_key=True),
+    sqlalchemy.Column('processed',
+                      sqlalchemy.types.DateTime,
+                      default=datetime.datetime.utcnow),
+    )
+
+sqlalchemy.Index('idx_glasgow_processed_audit_processed',
+                 processed_audit_table.c.processed)
+
+
+def mark_audit_processed(audit_id):
+    '''Records an audit as imported, in the current transaction
+
+    Audits already recorded are ignored.
+    '''
+    audit_id = unicode(audit_id)
+    savepoint = ckan.model.Session.begin_nested()
+    try:
+        ckan.model.Session.execute(
+            '''INSERT INTO glasgow_processed_audit (audit_id, processed)
+               SELECT :audit_id, :processed WHERE NOT EXISTS (
+                   SELECT 1 FROM glasgow_processed_audit
+                   WHERE audit_id = :audit_id)''',
+            {'audit_id': audit_id,
+             'processed': datetime.datetime.utcnow()})
+        savepoint.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # Recorded at the same time by another process
+        savepoint.rollback()
+
+
+def get_processed_audit_ids(audit_ids):
+    '''Returns the ids (as strings) of the audits already imported'''
+    audit_ids = [unicode(audit_id) for audit_id in audit_ids]
+    if not audit_ids:
+        return set()
+
+    query = sqlalchemy.select([processed_audit_table.c.audit_id]) \
+        .where(processed_audit_table.c.audit_id.in_(audit_ids))
+
+    return set(row[0] for row in ckan.model.Session.execute(query))
+
+
+# Audits of a changelog lane waiting for an object harvested by another lane
+# (eg a file whose dataset has not been created yet). They are queued again
+# by the next job of the lane.
+deferred_audit_table = sqlalchemy.Table(
+    'glasgow_deferred_audit', ckan.model.meta.metadata,
+    sqlalchemy.Column('audit_id',
+                      sqlalchemy.types.UnicodeText,
+                      primary_key=True),
+    sqlalchemy.Column('object_type',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('content',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('reason',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('attempts',
+                      sqlalchemy.types.Integer,
+                      default=1),
+    sqlalchemy.Column('deferred',
+                      sqlalchemy.types.DateTime,
+                      default=datetime.datetime.utcnow),
+    )
+
+sqlalchemy.Index('idx_glasgow_deferred_audit_type_deferred',
+                 deferred_audit_table.c.object_type,
+                 deferred_audit_table.c.deferred)
+
+
+def defer_audit(audit, object_type, reason, attempts=1):
+    '''Stores an audit to be retried, in the current transaction
+
+    :param object_type: the lane of the audit (None for the default one)
+    :param attempts: the number of times the audit has been deferred
+    '''
+    audit_id = unicode(audit['AuditId'])
+    ckan.model.Session.execute(deferred_audit_table.delete().where(
+        deferred_audit_table.c.audit_id == audit_id))
+    ckan.model.Session.execute(deferred_audit_table.insert().values(
+        audit_id=audit_id,
+        object_type=object_type,
+        content=json.dumps(audit),
+        reason=reason,
+        attempts=attempts,
+        deferred=datetime.datetime.utcnow()))
+
+
+def pop_deferred_audits(object_type):
+    '''Removes the deferred audits of a lane and returns them
+
+    Changes are not committed, so the audits are only removed once they are
+    queued again.
+
+    :returns: a list of (audit, attempts) tuples, oldest first
+    '''
+    table = deferred_audit_table
+    if object_type is None:
+        condition = table.c.object_type == None
+    else:
+        condition = table.c.object_type == object_type
+
+    rows = ckan.model.Session.execute(
+        sqlalchemy.select([table.c.audit_id, table.c.content,
+                           table.c.attempts])
+        .where(condition)
+        .order_by(table.c.deferred, table.c.audit_id)).fetchall()
+    if not rows:
+        return []
+
+    ckan.model.Session.execute(table.delete().where(
+        table.c.audit_id.in_([row.audit_id for row in rows])))
+
+    return [(json.loads(row.content), row.attempts) for row in rows]
+
+
+# Normalized title of each dataset, used to check that titles are unique
+# within an organization without querying Solr
+dataset_title_table = sqlalchemy.Table(
+    'glasgow_dataset_title', ckan.model.meta.metadata,
+    sqlalchemy.Column('package_id',
+                      sqlalchemy.types.UnicodeText,
+                      primary_key=True),
+    sqlalchemy.Column('owner_org',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('title_key',
+                      sqlalchemy.types.UnicodeText),
+    )
+
+sqlalchemy.Index('idx_glasgow_dataset_title_org_title',
+                 dataset_title_table.c.owner_org,
+                 dataset_title_table.c.title_key)
+
+
+def normalize_title(title):
+    '''Returns the key used to compare dataset titles'''
+    if not title:
+        return u''
+    if isinstance(title, str):
+        title = title.decode('utf8')
+    return u' '.join(title.lower().split())
+
+
+def save_dataset_title(package):
+    '''Stores the normalized title of a Package object
+
+    Changes are not committed, so they are saved along with the dataset.
+    '''
+    delete_dataset_title(package.id)
+    if package.state == 'deleted':
+        return
+    ckan.model.Session.execute(dataset_title_table.insert().values(
+        package_id=package.id,
+        owner_org=package.owner_org,
+        title_key=normalize_title(package.title)))
+
+
+def delete_dataset_title(package_id):
+    ckan.model.Session.execute(dataset_title_table.delete().where(
+        dataset_title_table.c.package_id == package_id))
+
+
+def get_datasets_with_title(owner_org, title):
+    '''Returns the active datasets with the same title in an organization
+
+    Titles are compared with `normalize_title`. `owner_org` can be the
+    organization id or name.
+
+    :returns: a list of (id, name) tuples
+    '''
+    package = ckan.model.package_table
+    group = ckan.model.group_table
+
+    query = sqlalchemy.select(
+        [package.c.id, package.c.name],
+        sqlalchemy.and_(
+            dataset_title_table.c.title_key == normalize_title(title),
+            dataset_title_table.c.owner_org == group.c.id,
+            sqlalchemy.or_(group.c.id == owner_org,
+                           group.c.name == owner_org),
+            package.c.id == dataset_title_table.c.package_id,
+            package.c.state == 'active',
+        ))
+
+    return [tuple(row) for row in ckan.model.Session.execute(query)]
+
+
+def _populate_dataset_title_table():
+    package = ckan.model.package_table
+    query = sqlalchemy.select(
+        [package.c.id, package.c.owner_org, package.c.title],
+        package.c.state != 'deleted')
+
+    rows = [{'package_id': row.id,
+             'owner_org': row.owner_org,
+             'title_key': normalize_title(row.title)}
+            for row in ckan.model.Session.execute(query)]
+    if rows:
+        ckan.model.Session.execute(dataset_title_table.insert(), rows)
+    ckan.model.Session.commit()
+
+
+# Number of edits and administered datasets of each user, shown on the user
+# list. Counting them for each user on every request means scanning the
+# revision table, so they are refreshed periodically with
+# `refresh_user_counts`
+user_counts_table = sqlalchemy.Table(
+    'glasgow_user_counts', ckan.model.meta.metadata,
+    sqlalchemy.Column('user_id',
+                      sqlalchemy.types.UnicodeText,
+                      primary_key=True),
+    sqlalchemy.Column('number_of_edits',
+                      sqlalchemy.types.Integer,
+                      default=0),
+    sqlalchemy.Column('number_administered_packages',
+                      sqlalchemy.types.Integer,
+                      default=0),
+    sqlalchemy.Column('updated',
+                      sqlalchemy.types.DateTime,
+                      default=datetime.datetime.utcnow),
+    )
+
+sqlalchemy.Index('idx_glasgow_user_counts_edits',
+                 user_counts_table.c.number_of_edits)
+
+
+def refresh_user_counts():
+    '''Recomputes the counts of all users in a single transaction
+
+    Revisions are counted once per author rather than once per user, and
+    readers keep seeing the previous counts until the new ones are committed.
+
+    :returns: the number of users updated
+    '''
+    ckan.model.Session.execute(user_counts_table.delete())
+    result = ckan.model.Session.execute(
+        '''INSERT INTO glasgow_user_counts
+               (user_id, number_of_edits, number_administered_packages,
+                updated)
+           SELECT u.id,
+                  COALESCE(by_name.edits, 0) + COALESCE(by_openid.edits, 0),
+                  COALESCE(admins.packages, 0),
+                  NOW() AT TIME ZONE 'UTC'
+           FROM "user" u
+           LEFT JOIN (SELECT author, COUNT(*) AS edits FROM revision
+                      GROUP BY author) by_name
+               ON by_name.author = u.name
+           LEFT JOIN (SELECT author, COUNT(*) AS edits FROM revision
+                      GROUP BY author) by_openid
+               ON by_openid.author = u.openid AND u.openid != u.name
+           LEFT JOIN (SELECT user_id, COUNT(*) AS packages
+                      FROM user_object_role
+                      WHERE context = 'Package' AND role = 'admin'
+                      GROUP BY user_id) admins
+               ON admins.user_id = u.id''')
+    ckan.model.Session.commit()
+
+    return result.rowcount
+
+
+# Finished and expired task statuses are moved here from the task_status table
+# (see `archive_task_statuses`), so the queries for pending tasks only deal
+# with active rows
+task_status_archive_table = sqlalchemy.Table(
+    'glasgow_task_status_archive', ckan.model.meta.metadata,
+    sqlalchemy.Column('id',
+                      sqlalchemy.types.UnicodeText,
+                      primary_key=True),
+    sqlalchemy.Column('entity_id',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('entity_type',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('task_type',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('key',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('value',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('state',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('error',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('last_updated',
+                      sqlalchemy.types.DateTime),
+    sqlalchemy.Column('request_id',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('expired',
+                      sqlalchemy.types.Boolean,
+                      default=False),
+    sqlalchemy.Column('archived',
+                      sqlalchemy.types.DateTime,
+                      default=datetime.datetime.now),
+    )
+
+sqlalchemy.Index('idx_glasgow_task_status_archive_request_id',
+                 task_status_archive_table.c.request_id)
+sqlalchemy.Index('idx_glasgow_task_status_archive_type_entity',
+                 task_status_archive_table.c.entity_type,
+                 task_status_archive_table.c.entity_id)
+sqlalchemy.Index('idx_glasgow_task_status_archive_type_key',
+                 task_status_archive_table.c.entity_type,
+                 task_status_archive_table.c.key)
+
+
+class ArchivedTaskStatus(ckan.model.DomainObject):
+    pass
+
+
+ckan.model.meta.mapper(ArchivedTaskStatus,
+                       task_status_archive_table)
+
+
+# Types of the task statuses created by the extension. The task_status table
+# is shared with core and other extensions (eg DataPusher), their tasks are
+# never archived or deleted.
+extension_task_types = (
+    'dataset_request_create',
+    'dataset_request_update',
+    'file_request_create',
+    'file_request_update',
+    'file_request_delete',
+    'file_version_request_update',
+    'organization_request_create',
+    'organization_request_update',
+    'member_update',
+    'user_update',
+    'user_request_create',
+    'user_request_update',
+)
+
+# Tasks in these states are archived once they have not been updated for a
+# while
+completed_task_states = ('finished', 'succeeded', 'error')
+# Tasks waiting for the platform that are this old are archived as expired.
+# Queued uploads are left alone, the upload_queue worker handles them
+expirable_task_states = ('new', 'sent', 'in_progress', 'processing')
+
+
+def _get_request_id(value):
+    try:
+        request_id = json.loads(value).get('request_id')
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return unicode(request_id) if request_id else None
+
+
+def archive_task_statuses(completed_age='1 day', expired_age='30 days',
+                          limit=1000):
+    '''Moves a batch of task statuses to the archive table
+
+    Tasks in one of the `completed_task_states` not updated in
+    `completed_age` and tasks in one of the `expirable_task_states` not
+    updated in `expired_age` (both PostgreSQL intervals) are moved. Only
+    tasks of the `extension_task_types` are considered. The batch is
+    committed in a single transaction.
+
+    :returns: the number of tasks archived
+    '''
+    rows = ckan.model.Session.execute(
+        '''SELECT id, entity_id, entity_type, task_type, key, value, state,
+                  error, last_updated
+           FROM task_status
+           WHERE task_type IN :task_types
+             AND ((state IN :completed_states
+                   AND last_updated < NOW() - CAST(:completed_age AS INTERVAL))
+               OR (state IN :expirable_states
+                   AND last_updated < NOW() - CAST(:expired_age AS INTERVAL)))
+           LIMIT :limit''',
+        {'task_types': extension_task_types,
+         'completed_states': completed_task_states,
+         'completed_age': completed_age,
+         'expirable_states': expirable_task_states,
+         'expired_age': expired_age,
+         'limit': limit}).fetchall()
+
+    if not rows:
+        return 0
+
+    now = datetime.datetime.now()
+    archived = []
+    for row in rows:
+        task = dict(row.items())
+        task['request_id'] = _get_request_id(row.value)
+        task['expired'] = row.state in expirable_task_states
+        task['archived'] = now
+        archived.append(task)
+
+    ckan.model.Session.execute(task_status_archive_table.insert(), archived)
+    ckan.model.Session.execute(task_request_table.delete().where(
+        task_request_table.c.task_id.in_([task['id'] for task in archived])))
+    ckan.model.Session.execute(
+        ckan.model.task_status_table.delete().where(sqlalchemy.and_(
+            ckan.model.task_status_table.c.id.in_(
+                [task['id'] for task in archived]),
+            ckan.model.task_status_table.c.task_type.in_(
+                extension_task_types))))
+    ckan.model.Session.commit()
+
+    return len(archived)
+
+
+def get_archived_tasks(entity_type=None, ids=None, request_ids=None,
+                       limit=None):
+    '''Returns archived tasks, most recent first
+
+    :param entity_type: only return tasks for this type of object
+    :param ids: only return tasks with one of these entity ids or keys
+    :param request_ids: only return tasks for these platform requests
+    :returns: a list of ArchivedTaskStatus objects
+    '''
+    query = ckan.model.Session.query(ArchivedTaskStatus)
+    if entity_type:
+        query = query.filter(ArchivedTaskStatus.entity_type == entity_type)
+    if ids:
+        query = query.filter(sqlalchemy.or_(
+            ArchivedTaskStatus.entity_id.in_(ids),
+            ArchivedTaskStatus.key.in_(ids)))
+    if request_ids:
+        query = query.filter(ArchivedTaskStatus.request_id.in_(request_ids))
+    query = query.order_by(ArchivedTaskStatus.last_updated.desc())
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+# Platform request id of the task statuses that have one, so tasks can be
+# looked up by request id without scanning their JSON values. Rows are
+# saved along with the tasks, and deleted with them.
+task_request_table = sqlalchemy.Table(
+    'glasgow_task_request', ckan.model.meta.metadata,
+    sqlalchemy.Column('task_id',
+                      sqlalchemy.types.UnicodeText,
+                      sqlalchemy.ForeignKey('task_status.id',
+                                            ondelete='CASCADE'),
+                      primary_key=True),
+    sqlalchemy.Column('request_id',
+                      sqlalchemy.types.UnicodeText,
+                      nullable=False),
+    )
+
+sqlalchemy.Index('idx_glasgow_task_request_request_id',
+                 task_request_table.c.request_id)
+
+
+def _save_task_request(mapper, connection, task):
+    if not sqlalchemy.orm.attributes.get_history(task, 'value').has_changes():
+        return
+    connection.execute(task_request_table.delete().where(
+        task_request_table.c.task_id == task.id))
+    request_id = _get_request_id(task.value)
+    if request_id:
+        connection.execute(task_request_table.insert().values(
+            task_id=task.id, request_id=request_id))
+
+
+def _delete_task_request(mapper, connection, task):
+    connection.execute(task_request_table.delete().where(
+        task_request_table.c.task_id == task.id))
+
+
+sqlalchemy.event.listen(ckan.model.TaskStatus, 'after_insert',
+                        _save_task_request)
+sqlalchemy.event.listen(ckan.model.TaskStatus, 'after_update',
+                        _save_task_request)
+sqlalchemy.event.listen(ckan.model.TaskStatus, 'before_delete',
+                        _delete_task_request)
+
+
+def get_tasks_for_request_ids(request_ids):
+    '''Returns the task statuses of some platform requests
+
+    :returns: a list of (request_id, TaskStatus) tuples
+    '''
+    request_ids = [unicode(request_id) for request_id in request_ids]
+    if not request_ids:
+        return []
+
+    return ckan.model.Session.query(task_request_table.c.request_id,
+                                    ckan.model.TaskStatus) \
+        .join(ckan.model.TaskStatus,
+              ckan.model.TaskStatus.id == task_request_table.c.task_id) \
+        .filter(task_request_table.c.request_id.in_(request_ids)) \
+        .all()
+
+
+def _populate_task_request_table():
+    task_status = ckan.model.task_status_table
+    query = sqlalchemy.select(
+        [task_status.c.id, task_status.c.value],
+        task_status.c.value.like('%request_id%'))
+
+    rows = []
+    for row in ckan.model.Session.execute(query):
+        request_id = _get_request_id(row.value)
+        if request_id:
+            rows.append({'task_id': row.id, 'request_id': request_id})
+    if rows:
+        ckan.model.Session.execute(task_request_table.insert(), rows)
+    ckan.model.Session.commit()
+
+
+# Indexes supporting the queries the extension runs on the core and harvest
+# tables, as (name, table, definition) tuples. They are managed with the
+# `glasgow_db indexes` command.
+extension_indexes = [
+    # Pending tasks for an object type, most recent first
+    ('idx_glasgow_task_status_type_state_updated', 'task_status',
+     '(entity_type, state, last_updated DESC)'),
+    # Tasks not yet finished, checked by the changelog_update command
+    ('idx_glasgow_task_status_pending', 'task_status',
+     "(last_updated) WHERE state IN ('new', 'sent', 'in_progress', "
+     "'uploading')"),
+    # Prefix LIKE queries on the task key (eg files of a dataset)
+    ('idx_glasgow_task_status_key_prefix', 'task_status',
+     '(key text_pattern_ops)'),
+    ('idx_glasgow_task_status_entity_id', 'task_status',
+     '(entity_id)'),
+    # Current harvest object for a dataset, used by the changelog handlers
+    ('idx_glasgow_harvest_object_guid_current', 'harvest_object',
+     '(guid) WHERE current = true'),
+    ('idx_glasgow_harvest_last_audit_created', 'harvest_last_audit',
+     '(created DESC)'),
+    # Cursor of each changelog lane
+    ('idx_glasgow_harvest_last_audit_type_created', 'harvest_last_audit',
+     '(object_type, created DESC)'),
+    # Audits already queued, checked for the audits pushed by the platform
+    ('idx_glasgow_harvest_object_extra_audit_id', 'harvest_object_extra',
+     "(value) WHERE key = 'audit_id'"),
+]
+
+
+def get_index_status():
+    '''
+    Returns the status of each of the `extension_indexes`
+
+    :returns: a list of (name, table, definition, status) tuples, where
+        status is one of 'ok', 'missing', 'invalid' (eg a failed
+        concurrent build) or 'no table'
+    '''
+    tables = set(row[0] for row in ckan.model.Session.execute(
+        'SELECT tablename FROM pg_tables WHERE schemaname = current_schema()'))
+
+    indexes = dict(row for row in ckan.model.Session.execute(
+        '''SELECT c.relname, i.indisvalid
+           FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+           WHERE c.relname LIKE 'idx_glasgow_%' '''))
+
+    status = []
+    for name, table, definition in extension_indexes:
+        if table not in tables:
+            index_status = 'no table'
+        elif name not in indexes:
+            index_status = 'missing'
+        elif not indexes[name]:
+            index_status = 'invalid'
+        else:
+            index_status = 'ok'
+        status.append((name, table, definition, index_status))
+
+    return status
+
+
+def create_index(name, table, definition):
+    '''
+    Creates one of the `extension_indexes` without locking the table
+
+    CREATE INDEX CONCURRENTLY can not run inside a transaction, so it is
+    sent on a DB connection of its own in autocommit mode. If the build is
+    interrupted the index is left behind as 'invalid' (see
+    `get_index_status`), and it needs to be dropped before creating it again.
+    '''
+    # Do not keep a transaction open, the build waits for all of them
+    ckan.model.Session.commit()
+
+    connection = ckan.model.meta.engine.raw_connection()
+    try:
+        connection.connection.autocommit = True
+        cursor = connection.cursor()
+        try:
+            cursor.execute('CREATE INDEX CONCURRENTLY {0} ON "{1}" {2}'.format(
+                name, table, definition))
+        finally:
+            cursor.close()
+            connection.connection.autocommit = False
+    finally:
+        connection.close()
+
+
+def drop_index(name):
+    ckan.model.Session.execute('DROP INDEX IF EXISTS {0}'.format(name))
+    ckan.model.Session.commit()
+
+
+def check_indexes():
+    '''Logs a warning if any of the extension indexes is not there'''
+    try:
+        missing = [name for name, table, definition, status
+                   in get_index_status() if status in ('missing', 'invalid')]
+    except sqlalchemy.exc.SQLAlchemyError, e:
+        log.warning('Could not check the extension indexes: {0}'.format(e))
+        ckan.model.Session.rollback()
+        return
+
+    if missing:
+        log.warning('Missing DB indexes: {0}. Run `paster --plugin='
+                    'ckanext-glasgow glasgow_db indexes create` to create '
+                    'them'.format(', '.join(missing)))
+
+
+def _add_missing_columns(table):
+    '''Adds the columns added to the definition of an existing table'''
+    existing = set(row[0] for row in ckan.model.Session.execute(
+        '''SELECT column_name FROM information_schema.columns
+           WHERE table_schema = current_schema() AND table_name = :table''',
+        {'table': table.name}))
+
+    for column in table.columns:
+        if column.name not in existing:
+            log.info('Adding column {0} to table {1}'.format(column.name,
+                                                             table.name))
+            ckan.model.Session.execute(
+                'ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(
+                    table.name, column.name,
+                    column.type.compile(dialect=ckan.model.meta.engine.dialect)))
+    ckan.model.Session.commit()
+
+
 def setup():
     if not harvest_last_audit_table.exists():
         harvest_last_audit_table.create()
+    else:
+        _add_missing_columns(harvest_last_audit_table)
+
+    if not dataset_title_table.exists():
+        dataset_title_table.create()
+        _populate_dataset_title_table()
+
+    if not processed_audit_table.exists():
+        processed_audit_table.create()
+
+    if not deferred_audit_table.exists():
+        deferred_audit_table.create()
+
+    if not task_status_archive_table.exists():
+        task_status_archive_table.create()
+
+    if not task_request_table.exists():
+        task_request_table.create()
+        _populate_task_request_table()
+
+    if not user_counts_table.exists():
+        user_counts_table.create()
+        refresh_user_counts()
+
+    check_indexes()
@@ -19,6 +19,7 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
     p.implements(p.IActions, inherit=True)
     p.implements(p.IAuthFunctions, inherit=True)
     p.implements(p.ITemplateHelpers, inherit=True)
+    p.implements(p.IPackageController, inherit=True)
 
     # IRoutes
 
@@ -70,6 +71,10 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
         map.connect('/request/{request_id}', controller=status_ctl,
                     action='get_status')
 
+        map.connect('changelog_notify', '/changelog/notify',
+                    controller='ckanext.glasgow.controllers.changelog:ChangelogController',
+                    action='notify', conditions=dict(method=['POST']))
+
 
         org_controller = 'ckanext.glasgow.controllers.organization:OrgController'
         map.connect('/organization/new',
@@ -113,6 +118,17 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
         # Create the extension DB tables if not there
         custom_model.setup()
 
+    # IPackageController
+
+    def create(self, entity):
+        custom_model.save_dataset_title(entity)
+
+    def edit(self, entity):
+        custom_model.save_dataset_title(entity)
+
+    def delete(self, entity):
+        custom_model.delete_dataset_title(entity.id)
+
     # IDatasetForm
 
     def package_types(self):
@@ -168,9 +184,11 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
             'pending_task_for_organization',
             'pending_tasks_for_membership',
             'pending_user_tasks',
+            'task_status_archive_list',
             'resource_versions_show',
             'check_for_task_status_update',
             'get_change_request',
+            'request_status_batch',
             'changelog_show',
             'approvals_list',
             'approval_act',
@@ -195,6 +213,7 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
             'pending_task_for_dataset',
             'pending_task_for_organization',
             'pending_user_tasks',
+            'task_status_archive_list',
             'organization_create',
             'organization_request_create',
             'task_status_show',
@@ -0,0 +1,116 @@
+import datetime
+
+import mock
+from nose.tools import assert_equals, assert_almost_equals
+
+import ckan.new_tests.helpers as helpers
+
+from ckanext.glasgow.model import HarvestLastAudit
+from ckanext.glasgow.commands.changelog_scheduler import (
+    get_next_interval,
+    get_arrival_rate,
+    get_job_audit_count,
+    ChangelogScheduler,
+)
+
+
+class TestGetNextInterval(object):
+
+    def test_full_page_starts_next_job_straight_away(self):
+        assert_equals(get_next_interval(300, 999, 5, 60, 1800), 0)
+
+    def test_no_audits_doubles_interval(self):
+        assert_equals(get_next_interval(300, 0, None, 60, 1800), 600)
+
+    def test_interval_from_arrival_rate(self):
+        # 100 audits at 0.5 audits/s
+        assert_equals(get_next_interval(300, 20, 0.5, 60, 1800), 200)
+
+    def test_interval_within_bounds(self):
+        assert_equals(get_next_interval(1200, 0, None, 60, 1800), 1800)
+        assert_equals(get_next_interval(300, 500, 100, 60, 1800), 60)
+
+
+class TestArrivalRate(object):
+
+    def setup(self):
+        helpers.reset_db()
+
+    def _save(self, job_id, seconds_ago, audit_count, object_type=None):
+        HarvestLastAudit(
+            audit_id=job_id, harvest_job_id=job_id,
+            created=(datetime.datetime.utcnow() -
+                     datetime.timedelta(seconds=seconds_ago)),
+            audit_count=audit_count, object_type=object_type).save()
+
+    def test_not_enough_jobs(self):
+        self._save('1', 100, 10)
+
+        assert_equals(get_arrival_rate(), None)
+
+    def test_arrival_rate(self):
+        self._save('1', 300, 50)
+        self._save('2', 200, 20)
+        self._save('3', 100, 40)
+        # Too old
+        self._save('0', 4000, 1000)
+
+        assert_almost_equals(get_arrival_rate(), 0.3, places=3)
+
+    def test_arrival_rate_of_lane(self):
+        self._save('1', 300, 50, 'File')
+        self._save('2', 200, 20)
+        self._save('3', 100, 40, 'File')
+
+        assert_almost_equals(get_arrival_rate(object_type='File'), 0.2,
+                             places=3)
+        assert_equals(get_arrival_rate(), None)
+
+    def test_job_audit_count(self):
+        self._save('1', 300, 50)
+
+        assert_equals(get_job_audit_count('1'), 50)
+        assert_equals(get_job_audit_count('2'), None)
+
+
+class TestRunJob(object):
+
+    def setup(self):
+        helpers.reset_db()
+
+    def _get_scheduler(self):
+        scheduler = ChangelogScheduler('changelog_scheduler')
+        scheduler.source_id = 'test-source'
+        scheduler.object_type = None
+        scheduler.min_interval = 60
+        scheduler.max_interval = 1800
+        scheduler.poll_interval = 0
+        scheduler.max_wait = 0
+        return scheduler
+
+    def test_jobs_not_started_by_the_scheduler_are_ignored(self):
+        scheduler = self._get_scheduler()
+        job = mock.Mock(id='webhook-job')
+
+        with mock.patch.object(scheduler, '_get_current_job',
+                               return_value=job), \
+                mock.patch.object(scheduler, '_wait_for_job',
+                                  return_value=True):
+            # Without a result the interval would be doubled
+            assert_equals(scheduler._run_job(300), 300)
+
+    def test_stuck_job_is_given_up_on(self):
+        scheduler = self._get_scheduler()
+        job = mock.Mock(id='stuck-job', status=u'Running')
+
+        with mock.patch.object(scheduler, '_get_current_job',
+                               return_value=job), \
+                mock.patch.object(scheduler, '_run_jobs'), \
+                mock.patch.object(scheduler, '_get_pending_objects',
+                                  return_value=5), \
+                mock.patch('ckanext.glasgow.commands.changelog_scheduler'
+                           '.model.Session') as mock_session:
+            mock_session.query.return_value.get.return_value = job
+
+            assert_equals(scheduler._wait_for_job(job.id), False)
+            assert_equals(scheduler._run_job(300), 300)
@@ -0,0 +1,120 @@
+import datetime
+
+import mock
+from nose.tools import assert_equals
+
+from ckan import model
+import ckan.new_tests.helpers as helpers
+
+from ckanext.glasgow.model import setup, ArchivedTaskStatus
+from ckanext.glasgow.locks import AdvisoryLocks
+from ckanext.glasgow.commands.changelog_update import (
+    Cleanup,
+    UpdateFromEcApiChangeLog,
+)
+
+
+class TestCleanupTasks(object):
+
+    def setup(self):
+        helpers.reset_db()
+        setup()
+        self.command = Cleanup('db_clean')
+        self.command.chunk_size = 1000
+
+    def _archive_task(self, task_id, days_old):
+        task = ArchivedTaskStatus()
+        task.id = task_id
+        task.entity_type = 'dataset'
+        task.task_type = 'dataset_request_create'
+        task.state = 'finished'
+        task.archived = (datetime.datetime.now()
+                         - datetime.timedelta(days=days_old))
+        model.Session.add(task)
+        model.Session.commit()
+
+    def _create_task(self, task_id, task_type, days_old):
+        task = model.TaskStatus(
+            id=task_id,
+            entity_id=task_id,
+            entity_type='dataset',
+            task_type=task_type,
+            key=task_id,
+            value='{}',
+            state='error',
+            last_updated=(datetime.datetime.now()
+                          - datetime.timedelta(days=days_old)))
+        model.Session.add(task)
+        model.Session.commit()
+
+    def test_only_extension_tasks_are_deleted(self):
+        self._create_task('old', 'dataset_request_create', 40)
+        self._create_task('recent', 'dataset_request_create', 10)
+        self._create_task('datapusher', 'datapusher_submit', 40)
+
+        self.command._clear_tasks()
+
+        assert_equals(sorted(task.id for task in
+                             model.Session.query(model.TaskStatus)),
+                      ['datapusher', 'recent'])
+
+    def test_old_archived_tasks_are_deleted(self):
+        self._archive_task('old', 100)
+        self._archive_task('recent', 10)
+
+        self.command._clear_tasks()
+
+        assert_equals([task.id for task in
+                       model.Session.query(ArchivedTaskStatus)], ['recent'])
+
+
+class RecordingLocks(AdvisoryLocks):
+    '''Keeps the most locks held at once'''
+
+    max_held = 0
+
+    def acquire(self, name, wait=False):
+        acquired = super(RecordingLocks, self).acquire(name, wait)
+        RecordingLocks.max_held = max(RecordingLocks.max_held,
+                                      len(self.held))
+        return acquired
+
+
+class TestUpdateTasks(object):
+
+    def setup(self):
+        helpers.reset_db()
+        RecordingLocks.max_held = 0
+
+    def _create_task(self, task_id):
+        task = model.TaskStatus(
+            id=task_id,
+            entity_id=task_id,
+            entity_type='dataset',
+            task_type='dataset_request_create',
+            key=task_id,
+            value='{{"request_id": "request_{0}"}}'.format(task_id),
+            state='sent',
+            last_updated=datetime.datetime.now())
+        model.Session.add(task)
+        model.Session.commit()
+
+    @mock.patch('ckanext.glasgow.commands.changelog_update.AdvisoryLocks',
+                RecordingLocks)
+    @mock.patch('ckanext.glasgow.commands.changelog_update.toolkit')
+    def test_tasks_are_locked_in_batches(self, mock_toolkit):
+        for task_id in ('task_1', 'task_2', 'task_3'):
+            self._create_task(task_id)
+        mock_toolkit.get_action.return_value.return_value = {}
+
+        command = UpdateFromEcApiChangeLog('changelog_update')
+        with mock.patch.object(command, '_load_config'), \
+                mock.patch.dict('pylons.config', {
+                    'ckanext.glasgow.changelog_update.batch_size': 2}):
+            command.command()
+
+        assert_equals(RecordingLocks.max_held, 2)
+        updated = sorted(call[0][1]['task_id'] for call
+                         in mock_toolkit.get_action.return_value.call_args_list
+                         if 'task_id' in call[0][1])
+        assert_equals(updated, ['task_1', 'task_2', 'task_3'])
@@ -1,4 +1,6 @@
 import json
+from multiprocessing.pool import ThreadPool
+
 import mock
 from nose.tools import (
     assert_dict_contains_subset,
@@ -8,7 +10,11 @@ from nose.tools import (
 
 import ckan.new_tests.helpers as helpers
 
-from ckanext.glasgow.commands.get_users import create_user
+from ckanext.glasgow.commands.get_users import (
+    create_user,
+    _create_user_isolated,
+    _init_worker,
+)
 
 class TestOrganizationUpdate(object):
     def setup(self):
@@ -465,3 +471,66 @@ class TestCreateOrgAdmin(object):
 
         members = helpers.call_action('member_list', id=self.test_org['id'])
         assert_equals('Admin', members[1][2])
+
+
+class TestCreateUserIsolated(object):
+    def setup(self):
+        self.ec_dict = {
+            "UserName": "isolated@GCCCTPECADINT.onmicrosoft.com",
+            "About": "",
+            "DisplayName": "",
+            "Roles": [
+                "OrganisationEditor"
+                ],
+            "FirstName": "",
+            "LastName": "",
+            "UserId": "a6f3a5c2-3b8b-4c0e-9d0e-0e8f4e8f4b11",
+            "IsRegistered": False,
+            "OrganisationId": None,
+            "Email": ""
+            }
+
+    def teardown(self):
+        helpers.reset_db()
+
+    def test_created(self):
+        ec_dict, result, error = _create_user_isolated((self.ec_dict, None))
+
+        assert_equals(result, 'created')
+        assert_equals(error, None)
+        user = helpers.call_action('user_show', id=self.ec_dict['UserId'])
+        assert_equals(user['name'], 'isolated@gccctpecadint.onmicrosoft.com')
+
+    @mock.patch('ckanext.glasgow.commands.get_users.create_user')
+    def test_errors_are_returned(self, mock_create_user):
+        mock_create_user.side_effect = Exception('Unexpected error')
+
+        ec_dict, result, error = _create_user_isolated((self.ec_dict, None))
+
+        assert_equals(ec_dict, self.ec_dict)
+        assert_equals(result, 'failed')
+        assert_equals(error, 'Unexpected error')
+
+    @mock.patch('ckanext.glasgow.commands.get_users.create_orgs')
+    def test_missing_orgs_not_created(self, mock_create_orgs):
+        self.ec_dict['OrganisationId'] = 'unknown_org'
+
+        ec_dict, result, error = _create_user_isolated((self.ec_dict, None))
+
+        assert_equals(result, 'created')
+        assert not mock_create_orgs.called
+
+    def test_validation_errors_in_worker_threads(self):
+        # Too short to be a valid user name
+        self.ec_dict['UserName'] = 'a'
+
+        pool = ThreadPool(1, initializer=_init_worker)
+        try:
+            ec_dict, result, error = pool.apply(_create_user_isolated,
+                                                ((self.ec_dict, None),))
+        finally:
+            pool.close()
+            pool.join()
+
+        assert_equals(result, 'failed')
+        assert 'name' in error, error
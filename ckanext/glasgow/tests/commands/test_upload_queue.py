@@ -0,0 +1,76 @@
+import json
+
+import mock
+from nose.tools import assert_equals
+
+from ckan import model
+import ckan.new_tests.helpers as helpers
+
+from ckanext.glasgow.commands.upload_queue import UploadQueue
+
+
+class TestUploadQueue(object):
+
+    def setup(self):
+        helpers.reset_db()
+
+    def _create_task(self, key):
+        task = model.TaskStatus(
+            entity_id=key,
+            entity_type='file',
+            task_type='file_request_create',
+            key=key,
+            value=json.dumps({'upload': {'filename': 'test.csv',
+                                         'attempts': 0}}),
+            state='uploading')
+        model.Session.add(task)
+        model.Session.commit()
+        return task.id
+
+    @mock.patch('ckanext.glasgow.commands.upload_queue.send_queued_upload')
+    def test_error_on_one_upload_does_not_stop_the_rest(self, mock_send):
+        first_id = self._create_task('file_1')
+        second_id = self._create_task('file_2')
+
+        def send(context, task_id):
+            if task_id == first_id:
+                raise Exception('Unexpected error')
+            return {'state': 'sent'}
+        mock_send.side_effect = send
+
+        UploadQueue('upload_queue')._process()
+
+        assert_equals(sorted(call[0][1] for call in mock_send.call_args_list),
+                      sorted([first_id, second_id]))
+
+    @mock.patch('ckanext.glasgow.commands.upload_queue.send_queued_upload')
+    def test_unexpected_error_counts_as_a_failed_attempt(self, mock_send):
+        task_id = self._create_task('file_1')
+
+        mock_send.side_effect = Exception('Unexpected error')
+
+        UploadQueue('upload_queue')._process()
+
+        task = model.Session.query(model.TaskStatus).get(task_id)
+        upload = json.loads(task.value)['upload']
+        assert_equals(task.state, 'uploading')
+        assert_equals(upload['attempts'], 1)
+        assert upload['next_attempt']
+
+        # Not due yet, so it is not sent again
+        UploadQueue('upload_queue')._process()
+
+        assert_equals(mock_send.call_count, 1)
+
+    @mock.patch('ckanext.glasgow.commands.upload_queue.send_queued_upload')
+    def test_unexpected_errors_give_up_after_max_attempts(self, mock_send):
+        task_id = self._create_task('file_1')
+
+        mock_send.side_effect = Exception('Unexpected error')
+
+        with mock.patch.dict('pylons.config', {
+                'ckanext.glasgow.upload_queue_max_attempts': 1}):
+            UploadQueue('upload_queue')._process()
+
+        task = model.Session.query(model.TaskStatus).get(task_id)
+        assert_equals(task.state, 'error')
@@ -0,0 +1,123 @@
+import json
+import time
+
+import nose
+import mock
+from pylons import config
+
+import ckan.new_tests.helpers as helpers
+
+import ckanext.harvest.model as harvest_model
+
+from ckanext.glasgow.tests.functional import get_test_app
+from ckanext.glasgow.tests.mock_ec import (
+    get_changelog_notification,
+    changelog_audits,
+)
+
+eq_ = nose.tools.eq_
+
+
+class TestChangelogNotify(object):
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    def setup(self):
+        helpers.reset_db()
+        self.app = get_test_app()
+        config['ckanext.glasgow.changelog_webhook_secret'] = 'secret'
+
+        self.source = harvest_model.HarvestSource(
+            url='http://changelog', type='ec_changelog_harvester')
+        self.source.save()
+
+    def teardown(self):
+        config.pop('ckanext.glasgow.changelog_webhook_secret', None)
+
+    def _notify(self, secret='secret', audits=None, status=202,
+                timestamp=None):
+        body, headers = get_changelog_notification(secret, audits, timestamp)
+        return self.app.post('/changelog/notify', body, headers=headers,
+                             status=status)
+
+    def _get_objects(self):
+        return harvest_model.Session.query(harvest_model.HarvestObject).all()
+
+    @mock.patch('ckanext.glasgow.harvesters.changelog.get_fetch_publisher')
+    def test_audits_are_queued(self, mock_publisher):
+        response = self._notify()
+
+        eq_(json.loads(response.body),
+            {'queued': len(changelog_audits), 'skipped': 0})
+
+        objects = self._get_objects()
+        eq_(sorted(json.loads(obj.content)['AuditId'] for obj in objects),
+            sorted(audit['AuditId'] for audit in changelog_audits))
+        eq_(objects[0].job.source.id, self.source.id)
+        eq_(mock_publisher.return_value.send.call_count,
+            len(changelog_audits))
+
+    @mock.patch('ckanext.glasgow.harvesters.changelog.get_fetch_publisher')
+    def test_audits_are_deduplicated(self, mock_publisher):
+        self._notify(audits=changelog_audits[:1])
+
+        response = self._notify(audits=changelog_audits[:2] +
+                                changelog_audits[1:2])
+
+        eq_(json.loads(response.body), {'queued': 1, 'skipped': 2})
+        eq_(len(self._get_objects()), 2)
+
+    @mock.patch('ckanext.glasgow.harvesters.changelog.get_fetch_publisher')
+    def test_audits_are_queued_on_their_lane(self, mock_publisher):
+        file_source = harvest_model.HarvestSource(
+            url='http://changelog/files', type='ec_changelog_harvester',
+            config=json.dumps({'object_type': 'File'}))
+        file_source.save()
+
+        self._notify(audits=changelog_audits[:1])
+
+        response = self._notify(audits=changelog_audits +
+                                changelog_audits[1:2])
+
+        eq_(json.loads(response.body), {'queued': 2, 'skipped': 2})
+        sources = dict((json.loads(obj.content)['AuditId'],
+                        obj.job.source.id) for obj in self._get_objects())
+        eq_(sources, {1005: file_source.id,
+                      1010: self.source.id,
+                      1012: self.source.id})
+
+    def test_invalid_signature(self):
+        self._notify(secret='wrong', status=403)
+
+        eq_(self._get_objects(), [])
+
+    def test_expired_request(self):
+        self._notify(timestamp=int(time.time()) - 600, status=403)
+
+        eq_(self._get_objects(), [])
+
+    def test_timestamp_is_signed(self):
+        body, headers = get_changelog_notification('secret')
+        headers['X-CTPEC-Timestamp'] = str(int(time.time()) + 1)
+
+        self.app.post('/changelog/notify', body, headers=headers,
+                      status=403)
+
+        eq_(self._get_objects(), [])
+
+    def test_missing_timestamp(self):
+        body, headers = get_changelog_notification('secret')
+        del headers['X-CTPEC-Timestamp']
+
+        self.app.post('/changelog/notify', body, headers=headers,
+                      status=403)
+
+    def test_disabled_without_secret(self):
+        config.pop('ckanext.glasgow.changelog_webhook_secret')
+
+        self._notify(status=404)
+
+    def test_invalid_audits(self):
+        self._notify(audits=[{'Message': 'No id'}], status=400)
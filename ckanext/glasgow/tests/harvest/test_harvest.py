@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import json
+import datetime
 import mock
 
 import nose.tools as nt
@@ -17,10 +18,29 @@ from ckan.plugins import toolkit
 from ckanext.glasgow.harvesters.ec_harvester import (
     EcInitialHarvester, EcApiException)
 from ckanext.glasgow.harvesters.changelog import (
+    EcChangelogHarvester,
     handle_user_create,
     handle_user_update,
     handle_role_change,
     handle_organization_update,
+    handle_dataset_update,
+    changelog_gather_lock,
+    get_audit_lock_name,
+    get_changelog_sources,
+)
+from ckanext.glasgow.locks import advisory_lock
+from ckanext.glasgow.commands.changelog_scheduler import (
+    get_next_interval,
+    get_arrival_rate,
+    get_job_audit_count,
+)
+from ckanext.glasgow.harvesters import DatasetNameAllocator, JobLookupCache
+from ckanext.glasgow.model import (
+    HarvestLastAudit,
+    mark_audit_processed,
+    get_processed_audit_ids,
+    defer_audit,
+    pop_deferred_audits,
 )
 from ckanext.glasgow.tests import run_mock_ec
 
@@ -606,3 +626,589 @@ class TestOrgUpdate(object):
             audit={'CustomProperties':{'OrganisationId': 'does not exist'}},
             harvest_object=None,
         )
+
+
+class TestDatasetNameAllocator(object):
+
+    def setup(self):
+        helpers.reset_db()
+        self.dataset = factories.Dataset(name='test-dataset')
+
+    def test_allocate_free_name(self):
+        allocator = DatasetNameAllocator()
+
+        nt.assert_equals(allocator.allocate({'title': 'Another dataset'}),
+                         'another-dataset')
+
+    def test_allocate_existing_name(self):
+        allocator = DatasetNameAllocator()
+
+        name = allocator.allocate({'title': 'Test dataset',
+                                   'owner_org': 'abcdefgh'})
+
+        nt.assert_equals(name, 'test-dataset-abcd')
+
+    def test_allocated_names_are_reserved(self):
+        allocator = DatasetNameAllocator()
+
+        names = [allocator.allocate({'title': 'Test dataset',
+                                     'owner_org': 'abcdefgh'})
+                 for i in range(3)]
+
+        nt.assert_equals(names, ['test-dataset-abcd',
+                                 'test-dataset-abcd-2',
+                                 'test-dataset-abcd-3'])
+
+    def test_existing_names_loaded_once(self):
+        allocator = DatasetNameAllocator()
+        allocator.allocate({'title': 'Test dataset'})
+
+        with mock.patch.object(model.Session, 'query') as mock_query:
+            allocator.allocate({'title': 'Test dataset'})
+            allocator.get_existing_name(self.dataset['id'])
+
+            assert not mock_query.called
+
+    def test_only_names_that_could_clash_are_loaded(self):
+        factories.Dataset(name='another-dataset')
+        allocator = DatasetNameAllocator()
+
+        allocator.allocate({'title': 'Test dataset'})
+
+        nt.assert_true('test-dataset' in allocator._names)
+        nt.assert_false('another-dataset' in allocator._names)
+        nt.assert_equals(allocator.allocate({'title': 'Another dataset'}),
+                         'another-dataset-2')
+
+    def test_get_existing_name(self):
+        allocator = DatasetNameAllocator()
+
+        nt.assert_equals(allocator.get_existing_name(self.dataset['id']),
+                         'test-dataset')
+        nt.assert_equals(allocator.get_existing_name('unknown'), None)
+
+
+class TestJobObjects(object):
+
+    def test_objects_of_interleaved_jobs_are_kept(self):
+        harvester = EcChangelogHarvester()
+
+        job_objects = harvester._get_job_objects('job-1')
+        harvester._get_job_objects('job-2')
+
+        nt.assert_true(harvester._get_job_objects('job-1') is job_objects)
+
+    @mock.patch('ckanext.glasgow.harvesters.job_objects_cache_size', 2)
+    def test_least_recently_used_job_is_dropped(self):
+        harvester = EcChangelogHarvester()
+
+        job_objects = harvester._get_job_objects('job-1')
+        harvester._get_job_objects('job-2')
+        harvester._get_job_objects('job-1')
+        harvester._get_job_objects('job-3')
+
+        nt.assert_true(harvester._get_job_objects('job-1') is job_objects)
+        nt.assert_equals(harvester._job_objects.keys(), ['job-3', 'job-1'])
+
+
+class TestJobLookupCache(object):
+
+    def setup(self):
+        helpers.reset_db()
+        self.user = factories.User(name='test-user')
+        self.dataset = factories.Dataset(name='test-dataset')
+
+    def test_get_user_name(self):
+        cache = JobLookupCache()
+
+        nt.assert_equals(cache.get_user_name(self.user['id']), 'test-user')
+        nt.assert_equals(cache.get_user_name('unknown'), None)
+
+    def test_user_names_are_cached_until_forgotten(self):
+        cache = JobLookupCache()
+        cache.get_user_name('test-user')
+
+        with mock.patch('ckan.model.User.get') as mock_get:
+            nt.assert_equals(cache.get_user_name('test-user'), 'test-user')
+            assert not mock_get.called
+
+            cache.forget_user('test-user')
+            cache.get_user_name('test-user')
+            assert mock_get.called
+
+    def test_datasets_are_cached_until_forgotten(self):
+        cache = JobLookupCache()
+        dataset = cache.get_dataset(self.dataset['id'])
+        dataset['title'] = 'Changed'
+
+        package = model.Package.get(self.dataset['id'])
+        package.notes = 'Updated notes'
+        model.repo.commit()
+
+        cached = cache.get_dataset(self.dataset['id'])
+        nt.assert_equals(cached['title'], self.dataset['title'])
+        nt.assert_equals(cached['notes'], self.dataset['notes'])
+
+        cache.forget_dataset(self.dataset['id'])
+        nt.assert_equals(cache.get_dataset(self.dataset['id'])['notes'],
+                         'Updated notes')
+
+    def test_updated_dataset_is_not_requested_again(self):
+        site_user = helpers.call_action('get_site_user')
+        cache = JobLookupCache()
+        context = {
+            'model': model,
+            'ignore_auth': True,
+            'local_action': True,
+            'user': site_user['name'],
+            'lookup_cache': cache,
+        }
+        audit = {'CustomProperties': {'DataSetId': self.dataset['id']}}
+
+        get_action = toolkit.get_action
+        called = []
+
+        def spy(name):
+            called.append(name)
+            return get_action(name)
+
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        '_get_latest_dataset_version') as mock_version, \
+                mock.patch.object(toolkit, 'get_action', side_effect=spy):
+            for notes in ('First update', 'Second update'):
+                mock_version.return_value = {'id': self.dataset['id'],
+                                             'title': 'Test dataset',
+                                             'notes': notes}
+                handle_dataset_update(context, audit, mock.Mock())
+
+        nt.assert_equals(called.count('package_show'), 1)
+        nt.assert_equals(called.count('package_update'), 2)
+        nt.assert_equals(cache.get_dataset(self.dataset['id'])['notes'],
+                         'Second update')
+        nt.assert_equals(model.Package.get(self.dataset['id']).notes,
+                         'Second update')
+
+    def test_unknown_dataset(self):
+        cache = JobLookupCache()
+
+        nt.assert_raises(toolkit.ObjectNotFound, cache.get_dataset, 'unknown')
+
+
+class TestChangelogBatches(object):
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    def setup(self):
+        helpers.reset_db()
+
+    def _audit(self, audit_id, command):
+        return {'AuditId': audit_id, 'Command': command,
+                'CustomProperties': {'Id': audit_id}}
+
+    def _gather(self, audits, batch_size=1, webhook_secret=''):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        '_iter_changelog') as mock_changelog, \
+                mock.patch.dict('pylons.config', {
+                    'ckanext.glasgow.changelog_batch_size': batch_size,
+                    'ckanext.glasgow.changelog_gather_chunk_size': 2,
+                    'ckanext.glasgow.changelog_webhook_secret':
+                    webhook_secret}):
+            mock_changelog.return_value = iter(audits)
+            ids = harvester.gather_stage(job)
+        return harvester, ids
+
+    def _get_audits(self, ids):
+        return [json.loads(harvest_model.HarvestObject.get(i).content)
+                for i in ids]
+
+    def test_no_batches_by_default(self):
+        audits = [self._audit(str(i), 'CreateDataSet') for i in range(3)]
+
+        harvester, ids = self._gather(audits)
+
+        nt.assert_equals(len(ids), 3)
+
+    def test_no_new_audits(self):
+        harvester, ids = self._gather([])
+
+        nt.assert_equals(ids, [])
+        last_audit = model.Session.query(HarvestLastAudit).one()
+        nt.assert_equals(last_audit.audit_id, '0')
+        nt.assert_equals(last_audit.audit_count, 0)
+
+    def test_idle_platform_lengthens_the_scheduler_interval(self):
+        self._gather([self._audit('1', 'CreateDataSet'),
+                      self._audit('2', 'CreateDataSet')])
+
+        # Only the audit the job started from
+        harvester, ids = self._gather([self._audit('2', 'CreateDataSet')])
+
+        nt.assert_equals(ids, [])
+        last_audit = model.Session.query(HarvestLastAudit) \
+            .filter(HarvestLastAudit.audit_count == 0).one()
+        # The cursor is kept
+        nt.assert_equals(last_audit.audit_id, '2')
+
+        audit_count = get_job_audit_count(last_audit.harvest_job_id)
+        nt.assert_equals(audit_count, 0)
+        nt.assert_equals(get_next_interval(300, audit_count,
+                                           get_arrival_rate(), 60, 1800),
+                         600)
+
+    def test_only_latest_update_is_imported(self):
+        audits = [
+            self._audit('1', 'UpdateDataSet'),
+            self._audit('2', 'CreateDataSet'),
+            self._audit('3', 'UpdateDataSet'),
+            self._audit('4', 'CreateFile'),
+        ]
+        audits[2]['CustomProperties'] = audits[0]['CustomProperties']
+
+        harvester, ids = self._gather(audits)
+
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['2', '4', '3'])
+        last_audit = model.Session.query(HarvestLastAudit).first()
+        nt.assert_equals(last_audit.audit_id, '4')
+
+    def test_nothing_is_saved_if_the_stream_fails(self):
+        def audits():
+            for i in range(3):
+                yield self._audit(str(i), 'CreateDataSet')
+            raise ValueError('Truncated response')
+
+        nt.assert_raises(ValueError, self._gather, audits())
+
+        nt.assert_equals(
+            model.Session.query(harvest_model.HarvestObject).count(), 0)
+        nt.assert_equals(model.Session.query(HarvestLastAudit).count(), 0)
+
+    def test_processed_audits_are_skipped(self):
+        mark_audit_processed('2')
+        model.Session.commit()
+
+        harvester, ids = self._gather([self._audit('1', 'CreateDataSet'),
+                                       self._audit('2', 'CreateDataSet'),
+                                       self._audit('3', 'UpdateDataSet')])
+
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['1', '3'])
+        last_audit = model.Session.query(HarvestLastAudit).first()
+        nt.assert_equals(last_audit.audit_id, '3')
+
+    def test_gather_is_skipped_if_another_job_is_gathering(self):
+        with advisory_lock(changelog_gather_lock) as acquired:
+            nt.assert_true(acquired)
+            harvester, ids = self._gather([self._audit('1', 'CreateDataSet')])
+
+        nt.assert_equals(ids, [])
+        nt.assert_equals(model.Session.query(HarvestLastAudit).count(), 0)
+
+    def test_audit_lock_name(self):
+        dataset_audit = {'AuditId': '1', 'Command': 'CreateDataSet',
+                         'CustomProperties': {'DataSetId': 'ABC',
+                                              'OrganisationId': 'DEF'}}
+        file_audit = {'AuditId': '2', 'Command': 'CreateFile',
+                      'CustomProperties': {'DataSetId': 'abc',
+                                           'FileId': 'GHI',
+                                           'OrganisationId': 'DEF'}}
+        org_audit = {'AuditId': '3', 'Command': 'UpdateOrganisation',
+                     'CustomProperties': {'OrganisationId': 'DEF'}}
+
+        nt.assert_equals(get_audit_lock_name(dataset_audit),
+                         get_audit_lock_name(file_audit))
+        nt.assert_not_equals(get_audit_lock_name(dataset_audit),
+                             get_audit_lock_name(org_audit))
+
+    def test_queued_audits_are_skipped_if_webhook_enabled(self):
+        self._gather([self._audit('1', 'CreateDataSet'),
+                      self._audit('2', 'CreateDataSet')])
+
+        # The first audit is the one the job started from
+        harvester, ids = self._gather([self._audit('2', 'CreateDataSet'),
+                                       self._audit('1', 'CreateDataSet'),
+                                       self._audit('3', 'CreateDataSet')],
+                                      webhook_secret='secret')
+
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['3'])
+
+    def _set_audit_object(self, audit_id, **values):
+        harvest_object = model.Session.query(harvest_model.HarvestObject) \
+            .join(harvest_model.HarvestObjectExtra) \
+            .filter(harvest_model.HarvestObjectExtra.key == 'audit_id') \
+            .filter(harvest_model.HarvestObjectExtra.value == audit_id) \
+            .one()
+        for key, value in values.iteritems():
+            setattr(harvest_object, key, value)
+        model.Session.commit()
+
+    def test_failed_audits_are_gathered_again(self):
+        self._gather([self._audit('1', 'CreateDataSet'),
+                      self._audit('2', 'CreateDataSet')])
+        self._set_audit_object('1', state=u'ERROR')
+
+        harvester, ids = self._gather([self._audit('2', 'CreateDataSet'),
+                                       self._audit('1', 'CreateDataSet'),
+                                       self._audit('3', 'CreateDataSet')],
+                                      webhook_secret='secret')
+
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['1', '3'])
+
+    def test_lost_audits_are_gathered_again(self):
+        self._gather([self._audit('1', 'CreateDataSet'),
+                      self._audit('2', 'CreateDataSet')])
+        self._set_audit_object(
+            '1', gathered=(datetime.datetime.utcnow() -
+                           datetime.timedelta(hours=2)))
+
+        harvester, ids = self._gather([self._audit('2', 'CreateDataSet'),
+                                       self._audit('1', 'CreateDataSet'),
+                                       self._audit('3', 'CreateDataSet')],
+                                      webhook_secret='secret')
+
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['1', '3'])
+
+    def test_batchable_audits_are_grouped(self):
+        audits = [self._audit(str(i), 'CreateDataSet') for i in range(5)]
+        audits.append(self._audit('5', 'CreateUser'))
+
+        harvester, ids = self._gather(audits, 2)
+
+        contents = self._get_audits(ids)
+        nt.assert_equals([len(c) for c in contents
+                          if isinstance(c, list)], [2, 2, 1])
+        nt.assert_equals([c['AuditId'] for c in contents
+                          if isinstance(c, dict)], ['5'])
+
+    def test_failed_audit_is_rolled_back_on_its_own(self):
+        audits = [self._audit(str(i), 'CreateDataSet') for i in range(3)]
+        harvester, ids = self._gather(audits, 3)
+        batch_object = harvest_model.HarvestObject.get(ids[0])
+
+        def handler(context, audit, harvest_object):
+            model.Session.add(model.Tag(name='tag-' + audit['AuditId']))
+            harvest_object.package_id = audit['AuditId']
+            model.Session.flush()
+            if audit['AuditId'] == '1':
+                raise toolkit.ObjectNotFound('Not found')
+
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_audit_command_handler') as mock_handler:
+            mock_handler.return_value = handler
+            nt.assert_true(harvester.import_stage(batch_object))
+
+        model.Session.remove()
+        nt.assert_true(model.Tag.get('tag-0'))
+        nt.assert_equals(model.Tag.get('tag-1'), None)
+        nt.assert_true(model.Tag.get('tag-2'))
+
+        objects = dict((obj.guid, obj) for obj in
+                       model.Session.query(harvest_model.HarvestObject)
+                       .filter(harvest_model.HarvestObject.id.in_(
+                           json.loads(batch_object.content))))
+        nt.assert_equals(objects['0'].state, 'COMPLETE')
+        nt.assert_equals(objects['1'].state, 'ERROR')
+        nt.assert_equals(objects['1'].package_id, None)
+        nt.assert_equals(objects['1'].errors[0].message, 'Not found')
+        nt.assert_equals(objects['2'].state, 'COMPLETE')
+
+        nt.assert_equals(get_processed_audit_ids(['0', '1', '2']),
+                         set(['0', '2']))
+
+    def test_failed_last_audit_does_not_affect_the_rest(self):
+        audits = [self._audit(str(i), 'CreateDataSet') for i in range(3)]
+        harvester, ids = self._gather(audits, 3)
+        batch_object = harvest_model.HarvestObject.get(ids[0])
+
+        def handler(context, audit, harvest_object):
+            model.repo.new_revision()
+            model.Session.add(model.Package(name='dataset-' +
+                                            audit['AuditId']))
+            model.Session.flush()
+            if audit['AuditId'] == '2':
+                raise toolkit.ValidationError({'name': ['Invalid']})
+
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_audit_command_handler') as mock_handler:
+            mock_handler.return_value = handler
+            nt.assert_true(harvester.import_stage(batch_object))
+
+        # The rolled back revision is not kept on the Session
+        nt.assert_false(hasattr(model.Session(), 'revision'))
+
+        model.Session.remove()
+        for name in ('dataset-0', 'dataset-1'):
+            package = model.Package.get(name)
+            nt.assert_true(package)
+            nt.assert_true(model.Session.query(model.Revision)
+                           .get(package.revision_id))
+        nt.assert_equals(model.Package.get('dataset-2'), None)
+
+        nt.assert_equals(get_processed_audit_ids(['0', '1', '2']),
+                         set(['0', '1']))
+
+    def test_processed_audits_are_not_imported_again(self):
+        audits = [self._audit(str(i), 'CreateDataSet') for i in range(3)]
+        harvester, ids = self._gather(audits, 3)
+        batch_object = harvest_model.HarvestObject.get(ids[0])
+
+        # Imported by another worker after the job was gathered
+        mark_audit_processed('1')
+        model.Session.commit()
+
+        handler = mock.Mock()
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_audit_command_handler') as mock_handler:
+            mock_handler.return_value = handler
+            nt.assert_true(harvester.import_stage(batch_object))
+
+        nt.assert_equals([call[0][1]['AuditId']
+                          for call in handler.call_args_list], ['0', '2'])
+        nt.assert_equals(
+            set(obj.state for obj in
+                model.Session.query(harvest_model.HarvestObject)
+                .filter(harvest_model.HarvestObject.id.in_(
+                    json.loads(batch_object.content)))),
+            set(['COMPLETE']))
+
+
+class TestChangelogLanes(object):
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    def setup(self):
+        helpers.reset_db()
+        self.sources = {}
+        for object_type in (None, 'File'):
+            source = harvest_model.HarvestSource(
+                url='http://changelog/{0}'.format(object_type),
+                type='ec_changelog_harvester',
+                config=json.dumps({'object_type': object_type}))
+            source.save()
+            self.sources[object_type] = source
+
+    def _audit(self, audit_id, command, object_type, **properties):
+        return {'AuditId': audit_id, 'Command': command,
+                'ObjectType': object_type,
+                'CustomProperties': properties or {'Id': audit_id}}
+
+    def _gather(self, audits, object_type=None):
+        harvester = EcChangelogHarvester()
+        job = harvest_model.HarvestJob(source=self.sources[object_type])
+        job.save()
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        '_iter_changelog') as mock_changelog:
+            mock_changelog.return_value = iter(audits)
+            ids = harvester.gather_stage(job)
+        return harvester, ids, mock_changelog.call_args[0][1]
+
+    def _get_audits(self, ids):
+        return [json.loads(harvest_model.HarvestObject.get(i).content)
+                for i in ids]
+
+    def test_changelog_sources(self):
+        nt.assert_equals(get_changelog_sources(), self.sources)
+
+    def test_validate_config(self):
+        harvester = EcChangelogHarvester()
+
+        harvester.validate_config('{"object_type": "File"}')
+        nt.assert_raises(ValueError, harvester.validate_config,
+                         '{"object_type": "User"}')
+        nt.assert_raises(ValueError, harvester.validate_config, '[]')
+
+    def test_lane_has_its_own_cursor(self):
+        self._gather([self._audit('1', 'CreateDataSet', 'Dataset')])
+
+        harvester, ids, data_dict = self._gather(
+            [self._audit('2', 'CreateFile', 'File')], 'File')
+
+        nt.assert_equals(data_dict['object_type'], 'File')
+        nt.assert_equals(data_dict['audit_id'], '0')
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['2'])
+
+        harvester, ids, data_dict = self._gather([], 'File')
+        nt.assert_equals(data_dict['audit_id'], '2')
+
+        harvester, ids, data_dict = self._gather([])
+        nt.assert_equals(data_dict['audit_id'], '1')
+        nt.assert_false('object_type' in data_dict)
+
+    def test_new_lane_starts_from_default_lane_cursor(self):
+        source_created = self.sources['File'].created
+        for audit_id, seconds in (('4', -20), ('5', -10), ('6', 10)):
+            HarvestLastAudit(
+                audit_id=audit_id, harvest_job_id=None,
+                created=(source_created +
+                         datetime.timedelta(seconds=seconds))).save()
+
+        harvester, ids, data_dict = self._gather([], 'File')
+
+        nt.assert_equals(data_dict['audit_id'], '5')
+
+    def test_default_lane_skips_lane_types(self):
+        harvester, ids, data_dict = self._gather([
+            self._audit('1', 'CreateDataSet', 'Dataset'),
+            self._audit('2', 'CreateFile', 'File'),
+            self._audit('3', 'UpdateOrganisation', 'Organisation'),
+        ])
+
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['1', '3'])
+        last_audit = model.Session.query(HarvestLastAudit).first()
+        nt.assert_equals(last_audit.audit_id, '3')
+        nt.assert_equals(last_audit.object_type, None)
+
+    def test_file_waiting_for_its_dataset_is_deferred(self):
+        harvester, ids, data_dict = self._gather(
+            [self._audit('1', 'CreateFile', 'File', DataSetId='missing',
+                         FileId='file-1')], 'File')
+        harvest_object = harvest_model.HarvestObject.get(ids[0])
+
+        handler = mock.Mock()
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_audit_command_handler') as mock_handler:
+            mock_handler.return_value = handler
+            nt.assert_true(harvester.import_stage(harvest_object))
+
+        nt.assert_false(handler.called)
+        nt.assert_equals(get_processed_audit_ids(['1']), set())
+
+        # Retried by the next job of the lane
+        harvester, ids, data_dict = self._gather([], 'File')
+
+        nt.assert_equals([a['AuditId'] for a in self._get_audits(ids)],
+                         ['1'])
+        harvest_object = harvest_model.HarvestObject.get(ids[0])
+        nt.assert_equals(
+            harvester._get_object_extra(harvest_object, 'deferred_attempts'),
+            '1')
+        nt.assert_equals(pop_deferred_audits('File'), [])
+
+    def test_audit_is_imported_after_max_deferrals(self):
+        audit = self._audit('1', 'CreateFile', 'File', DataSetId='missing',
+                            FileId='file-1')
+        defer_audit(audit, 'File', 'Dataset not harvested yet', 10)
+        model.Session.commit()
+
+        harvester, ids, data_dict = self._gather([], 'File')
+        harvest_object = harvest_model.HarvestObject.get(ids[0])
+
+        handler = mock.Mock()
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_audit_command_handler') as mock_handler:
+            mock_handler.return_value = handler
+            nt.assert_true(harvester.import_stage(harvest_object))
+
+        nt.assert_true(handler.called)
+        nt.assert_equals(pop_deferred_audits('File'), [])
@@ -1,6 +1,8 @@
 import cgi
 import datetime
 import os
+import shutil
+import tempfile
 import StringIO
 import json
 
@@ -21,10 +23,21 @@ from ckanext.glasgow.logic.action import (
     _create_task_status,
     _update_task_status_success,
     _update_task_status_error,
+    _get_upload_progress_callback,
     ECAPINotAuthorized,
     ECAPIError,
+    send_queued_upload,
+    _get_organization_id,
+    _organization_id_cache,
+    _organization_list_cache,
+    _iter_json_array,
     )
 
+from ckanext.glasgow.model import (
+    archive_task_statuses,
+    refresh_user_counts,
+    setup as setup_model,
+)
 from ckanext.glasgow.tests import run_mock_ec
 
 
@@ -180,6 +193,30 @@ class TestTaskStatusHelpers(object):
         eq_(task.value, 'test_value_updated')
         eq_(task.state, 'error')
 
+    def test_upload_progress_does_not_commit_the_session(self):
+
+        task_dict = _create_task_status({'user': 'test'},
+                                        task_type='test_task_type',
+                                        entity_id='test_entity_id',
+                                        entity_type='test_entity_type',
+                                        key='test_key',
+                                        value='{}'
+                                        )
+
+        # Pending change of the action sending the upload
+        model.Session.add(model.Package(name='not-committed'))
+
+        callback = _get_upload_progress_callback(task_dict)
+        callback(100, 100)
+
+        model.Session.rollback()
+
+        assert not model.Package.get('not-committed')
+
+        task = model.Session.query(model.TaskStatus).get(task_dict['id'])
+        eq_(json.loads(task.value)['upload_progress'],
+            {'sent': 100, 'total': 100})
+
 
 class TestTaskStatus(object):
 
@@ -278,6 +315,95 @@ class TestTaskStatus(object):
 
         eq_(pending_task, None)
 
+    def test_task_status_archive_list(self):
+
+        task_dict = _create_task_status({'user': 'test'},
+                                        task_type='test_task_type',
+                                        entity_id='archived_dataset_id',
+                                        entity_type='dataset',
+                                        key='archived_dataset_name',
+                                        value='{"request_id": "test_request"}'
+                                        )
+        task = model.Session.query(model.TaskStatus).get(task_dict['id'])
+        task.state = 'finished'
+        task.last_updated = datetime.datetime(2014, 1, 1)
+        model.Session.commit()
+
+        archive_task_statuses()
+
+        eq_(helpers.call_action('pending_task_for_dataset',
+                                id='archived_dataset_id'), None)
+
+        archived_tasks = helpers.call_action('task_status_archive_list',
+                                             entity_type='dataset',
+                                             name='archived_dataset_name')
+
+        eq_(len(archived_tasks), 1)
+        eq_(archived_tasks[0]['id'], task_dict['id'])
+        eq_(archived_tasks[0]['state'], 'finished')
+        eq_(archived_tasks[0]['value'], {'request_id': 'test_request'})
+
+    def _create_user_tasks(self, user_id, states):
+        task_ids = []
+        for i, state in enumerate(states):
+            task_dict = _create_task_status({'user': 'test'},
+                                            task_type='test_task_type',
+                                            entity_id=user_id,
+                                            entity_type='user',
+                                            key='{0}_{1}'.format(user_id, i),
+                                            value='{}'
+                                            )
+            task = model.Session.query(model.TaskStatus).get(task_dict['id'])
+            task.state = state
+            task.last_updated = datetime.datetime(2014, 1, i + 1)
+            task_ids.append(task.id)
+        model.Session.commit()
+        # Most recent first
+        return list(reversed(task_ids))
+
+    def test_pending_user_tasks_paged(self):
+        task_ids = self._create_user_tasks('paged_user',
+                                           ['new', 'sent', 'error', 'sent'])
+
+        tasks = helpers.call_action('pending_user_tasks', id='paged_user',
+                                    limit=2)
+        eq_([task['id'] for task in tasks], task_ids[:2])
+
+        tasks = helpers.call_action('pending_user_tasks', id='paged_user',
+                                    limit=2, offset=2)
+        eq_([task['id'] for task in tasks], task_ids[2:])
+
+    def test_pending_user_tasks_filters(self):
+        task_ids = self._create_user_tasks('filtered_user',
+                                           ['new', 'sent', 'error', 'sent'])
+
+        tasks = helpers.call_action('pending_user_tasks', id='filtered_user',
+                                    state='sent')
+        eq_([task['id'] for task in tasks], [task_ids[0], task_ids[2]])
+
+        tasks = helpers.call_action('pending_user_tasks', id='filtered_user',
+                                    state='new,error')
+        eq_([task['id'] for task in tasks], [task_ids[1], task_ids[3]])
+
+        tasks = helpers.call_action('pending_user_tasks', id='filtered_user',
+                                    since='2014-01-02', until='2014-01-04')
+        eq_([task['id'] for task in tasks], [task_ids[1], task_ids[2]])
+
+    def test_pending_user_tasks_invalid_params(self):
+
+        for params in ({'state': 'finished'}, {'limit': 'a'},
+                       {'offset': -1}, {'since': 'not a date'}):
+            nose.tools.assert_raises(p.toolkit.ValidationError,
+                                     helpers.call_action,
+                                     'pending_user_tasks', **params)
+
+    def test_task_status_archive_list_requires_id(self):
+
+        nose.tools.assert_raises(p.toolkit.ValidationError,
+                                 helpers.call_action,
+                                 'task_status_archive_list',
+                                 entity_type='dataset')
+
 
 class TestDatasetCreate(object):
 
@@ -1120,6 +1246,154 @@ class TestGetChangeRequest(object):
         )
 
 
+class TestRequestStatusBatch(object):
+
+    def setup(self):
+        helpers.reset_db()
+        from ckanext.glasgow.logic import action
+        action._request_status_cache.clear()
+
+    def _mock_result(self, operation_state):
+        mock_result = mock.Mock()
+        mock_result.status_code = 200
+        mock_result.json.return_value = [
+            {
+                'AuditId': 1005,
+                'RequestId': 'REQUEST-ID',
+                'Timestamp': '2014-05-21T00:00:10',
+                'OperationState': operation_state,
+                'Message': 'Operation message',
+            }
+        ]
+        return mock_result
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_batch(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_result('Succeeded')
+
+        result = helpers.call_action('request_status_batch',
+                                     request_ids=['id-1', 'id-2', 'id-1'])
+
+        eq_(sorted(result.keys()), ['id-1', 'id-2'])
+        eq_(result['id-1'][-1]['operation_state'], 'Succeeded')
+        eq_(mock_request.call_count, 2)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_batch_comma_separated(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_result('Succeeded')
+
+        result = helpers.call_action('request_status_batch',
+                                     request_ids='id-1,id-2')
+
+        eq_(sorted(result.keys()), ['id-1', 'id-2'])
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_final_statuses_are_cached(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_result('Succeeded')
+
+        helpers.call_action('request_status_batch', request_ids=['id-1'])
+        result = helpers.call_action('request_status_batch',
+                                     request_ids=['id-1'])
+
+        eq_(result['id-1'][-1]['operation_state'], 'Succeeded')
+        eq_(mock_request.call_count, 1)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_in_progress_statuses_are_cached_until_ttl(self, mock_request,
+                                                       mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_result('InProgress')
+
+        helpers.call_action('request_status_batch', request_ids=['id-1'])
+        helpers.call_action('request_status_batch', request_ids=['id-1'])
+        eq_(mock_request.call_count, 1)
+
+        config['ckanext.glasgow.request_status_cache_ttl'] = 0
+        try:
+            helpers.call_action('request_status_batch', request_ids=['id-1'])
+        finally:
+            config.pop('ckanext.glasgow.request_status_cache_ttl', None)
+        eq_(mock_request.call_count, 2)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_cache_size_is_bounded(self, mock_request, mock_token):
+        from ckanext.glasgow.logic import action
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_result('Succeeded')
+
+        config['ckanext.glasgow.request_status_cache_size'] = 2
+        try:
+            helpers.call_action('request_status_batch',
+                                request_ids=['id-1', 'id-2', 'id-3'])
+        finally:
+            config.pop('ckanext.glasgow.request_status_cache_size', None)
+
+        eq_(len(action._request_status_cache), 2)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_final_statuses_expire(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_result('Succeeded')
+
+        helpers.call_action('request_status_batch', request_ids=['id-1'])
+
+        config['ckanext.glasgow.request_status_final_cache_ttl'] = 0
+        try:
+            helpers.call_action('request_status_batch', request_ids=['id-1'])
+        finally:
+            config.pop('ckanext.glasgow.request_status_final_cache_ttl', None)
+        eq_(mock_request.call_count, 2)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_local_final_task_is_not_requested(self, mock_request,
+                                               mock_token):
+        mock_token.return_value = 'mock_token'
+        task = model.TaskStatus(
+            entity_id='dataset-1', entity_type='dataset',
+            task_type='dataset_request_create', key='dataset-1',
+            value=json.dumps({'request_id': 'id-1'}), state='finished',
+            last_updated=datetime.datetime.now())
+        model.Session.add(task)
+        model.Session.commit()
+
+        result = helpers.call_action('request_status_batch',
+                                     request_ids=['id-1'])
+
+        eq_(result['id-1'][-1]['operation_state'], 'Succeeded')
+        assert not mock_request.called
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('requests.request')
+    def test_errors_are_isolated(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+
+        error_result = mock.Mock()
+        error_result.status_code = 500
+        error_result.content = 'Error'
+
+        def side_effect(method, url, **kwargs):
+            if url.endswith('id-2'):
+                return error_result
+            return self._mock_result('Succeeded')
+        mock_request.side_effect = side_effect
+
+        result = helpers.call_action('request_status_batch',
+                                     request_ids=['id-1', 'id-2'])
+
+        eq_(result['id-1'][-1]['operation_state'], 'Succeeded')
+        eq_(result['id-2'], None)
+
+
 class TestChangelog(object):
 
     @classmethod
@@ -1847,7 +2121,7 @@ class TestFileVersionCreate(object):
         )
         nose.tools.assert_equals(
             {'metadata': '{"Metadata": {}, "Type": "application/csv", "Description": "Some longer description", "Title": "Test File name"}'},
-            mock_request.call_args[1]['data']
+            dict(mock_request.call_args[1]['data'].fields)
         )
 
         task_dict = helpers.call_action('task_status_show',
@@ -1974,3 +2248,435 @@ class TestUserUpdate(object):
             ('PUT', '/Users/Organisation/{}/User/{}'.format('some_org', self.normal_user['id'])),
             mock_request.call_args[0]
         )
+
+
+class TestIterJsonArray(object):
+
+    def _parse(self, data, chunk_size):
+        text = json.dumps(data)
+        return list(_iter_json_array(
+            text[i:i + chunk_size] for i in range(0, len(text), chunk_size)))
+
+    def test_items_split_across_chunks(self):
+        data = [
+            {'AuditId': 1, 'CustomProperties': [{'Name': 'a "quoted" ]}'}]},
+            {'AuditId': 2, 'CustomProperties': [{'Name': u'\u00e9, [x'}]},
+            3,
+            None,
+        ]
+
+        for chunk_size in (1, 3, 1000):
+            eq_(self._parse(data, chunk_size), data)
+
+    def test_empty_array(self):
+        eq_(self._parse([], 1), [])
+
+    def test_not_an_array(self):
+        for content in ('{"AuditId": 1}', '[{"AuditId": 1}', '[,]'):
+            nose.tools.assert_raises(
+                ValueError, list,
+                _iter_json_array([content]))
+
+
+class TestApprovalDownload(object):
+
+    @mock.patch('requests.request')
+    def test_download_is_streamed(self, mock_request):
+        mock_response = mock.Mock(
+            status_code=200,
+            headers={'Content-Type': 'text/csv', 'Content-Length': '6'},
+        )
+        mock_response.raw.read.side_effect = ['abc', 'def', '']
+        mock_request.return_value = mock_response
+
+        config['ckanext.glasgow.download_chunk_size'] = 3
+        try:
+            download = helpers.call_action('approval_download',
+                                           request_id='request-id')
+        finally:
+            config.pop('ckanext.glasgow.download_chunk_size', None)
+
+        eq_(mock_request.call_args[1]['stream'], True)
+        eq_(download['status'], 200)
+        eq_(download['headers']['Content-Length'], '6')
+
+        # Nothing read until the content is consumed
+        assert not mock_response.raw.read.called
+        eq_(list(download['content']), ['abc', 'def'])
+        mock_response.raw.read.assert_called_with(3, decode_content=False)
+        assert mock_response.close.called
+
+    @mock.patch('requests.request')
+    def test_download_range(self, mock_request):
+        mock_response = mock.Mock(
+            status_code=206,
+            headers={'Content-Range': 'bytes 3-5/6'},
+        )
+        mock_response.raw.read.side_effect = ['def', '']
+        mock_request.return_value = mock_response
+
+        download = helpers.call_action('approval_download',
+                                       request_id='request-id',
+                                       range='bytes=3-')
+
+        eq_(mock_request.call_args[1]['headers']['Range'], 'bytes=3-')
+        eq_(download['status'], 206)
+        eq_(list(download['content']), ['def'])
+
+    @mock.patch('requests.request')
+    def test_compressed_download_range_is_not_decoded(self, mock_request):
+        compressed = 'x\x9c' + 'compressed bytes'
+        mock_response = mock.Mock(
+            status_code=206,
+            headers={'Content-Range': 'bytes 2-17/18',
+                     'Content-Encoding': 'gzip',
+                     'Content-Length': '16'},
+        )
+        mock_response.raw.read.side_effect = [compressed[2:], '']
+        mock_request.return_value = mock_response
+
+        download = helpers.call_action('approval_download',
+                                       request_id='request-id',
+                                       range='bytes=2-')
+
+        # The bytes of the range are passed on as sent by the platform
+        eq_(list(download['content']), ['compressed bytes'])
+        eq_(download['headers']['Content-Encoding'], 'gzip')
+        for call in mock_response.raw.read.call_args_list:
+            eq_(call[1]['decode_content'], False)
+        assert not mock_response.iter_content.called
+
+    @mock.patch('requests.request')
+    def test_download_error(self, mock_request):
+        mock_request.return_value = mock.Mock(
+            status_code=500,
+            **{'json.return_value': {'Message': 'Error'}}
+        )
+
+        nose.tools.assert_raises(
+            p.toolkit.ValidationError,
+            helpers.call_action,
+            'approval_download',
+            request_id='request-id',
+        )
+
+
+class TestUploadQueue(object):
+
+    def setup(self):
+        self.normal_user = helpers.call_action('user_create',
+                                               name='normal_user',
+                                               email='test@test.com',
+                                               password='test')
+
+        helpers.call_action('organization_create',
+                            context={
+                                'user': 'normal_user',
+                                'local_action': True,
+                            },
+                            name='test_org')
+
+        context = {'local_action': True, 'user': 'normal_user'}
+        self.dataset = helpers.call_action('package_create', context=context,
+                                           name='test_dataset',
+                                           owner_org='test_org',
+                                           title='Test Dataset',
+                                           notes='Some longer description',
+                                           maintainer='Test maintainer',
+                                           license_id='OGL-UK-2.0')
+
+        self.staging_dir = tempfile.mkdtemp()
+        config['ckanext.glasgow.upload_staging_dir'] = self.staging_dir
+        config['ckanext.glasgow.upload_queue_threshold'] = 5
+
+    def teardown(self):
+        config.pop('ckanext.glasgow.upload_staging_dir', None)
+        config.pop('ckanext.glasgow.upload_queue_threshold', None)
+        shutil.rmtree(self.staging_dir)
+        helpers.reset_db()
+        search.clear()
+
+    def _queue_upload(self):
+        data_dict = {
+            'package_id': self.dataset['id'],
+            'name': 'Test File name',
+            'description': 'Some longer description',
+            'format': 'application/csv',
+            'license_id': 'uk-ogl',
+            'openness_rating': 3,
+            'quality': 5,
+            'upload': _get_mock_file_upload(),
+        }
+
+        context = {'user': self.normal_user['name']}
+        with mock.patch('requests.request') as mock_request:
+            request_dict = helpers.call_action('file_request_create',
+                                               context=context,
+                                               **data_dict)
+            assert not mock_request.called
+
+        return request_dict
+
+    def test_upload_is_queued(self):
+        request_dict = self._queue_upload()
+
+        eq_(request_dict['request_id'], None)
+
+        task_dict = helpers.call_action('task_status_show',
+                                        id=request_dict['task_id'])
+        eq_(task_dict['state'], 'uploading')
+
+        upload = json.loads(task_dict['value'])['upload']
+        eq_(upload['filename'], 'test.csv')
+        eq_(upload['attempts'], 0)
+        eq_(open(upload['path']).read(), 'File contents')
+        assert 'Authorization' not in task_dict['value']
+
+    @mock.patch('requests.request')
+    def test_send_queued_upload(self, mock_request):
+        mock_request.return_value = mock.Mock(
+            status_code=200,
+            **{
+                'raise_for_status.return_value': None,
+                'json.return_value': {'RequestId': 'req-id'},
+            }
+        )
+
+        request_dict = self._queue_upload()
+        task_dict = helpers.call_action('task_status_show',
+                                        id=request_dict['task_id'])
+        path = json.loads(task_dict['value'])['upload']['path']
+
+        context = {'model': model, 'session': model.Session}
+        task_dict = send_queued_upload(context, request_dict['task_id'])
+
+        eq_(task_dict['state'], 'sent')
+        eq_(json.loads(task_dict['value'])['request_id'], 'req-id')
+        assert not os.path.exists(path)
+
+        eq_(mock_request.call_args[0][0], 'POST')
+        eq_(dict(mock_request.call_args[1]['data'].fields).keys(),
+            ['metadata'])
+
+    @mock.patch('requests.request')
+    def test_send_queued_upload_error_is_retried(self, mock_request):
+        mock_request.return_value = mock.Mock(
+            status_code=500,
+            content='Error',
+            **{
+                'raise_for_status.side_effect':
+                    requests.exceptions.HTTPError(),
+            }
+        )
+
+        request_dict = self._queue_upload()
+
+        context = {'model': model, 'session': model.Session}
+        task_dict = send_queued_upload(context, request_dict['task_id'])
+
+        eq_(task_dict['state'], 'uploading')
+        upload = json.loads(task_dict['value'])['upload']
+        eq_(upload['attempts'], 1)
+        assert upload['next_attempt']
+        assert os.path.exists(upload['path'])
+
+    @mock.patch('requests.request')
+    def test_send_queued_upload_gives_up(self, mock_request):
+        mock_request.return_value = mock.Mock(
+            status_code=500,
+            content='Error',
+            **{
+                'raise_for_status.side_effect':
+                    requests.exceptions.HTTPError(),
+            }
+        )
+
+        request_dict = self._queue_upload()
+
+        config['ckanext.glasgow.upload_queue_max_attempts'] = 1
+        try:
+            context = {'model': model, 'session': model.Session}
+            task_dict = send_queued_upload(context, request_dict['task_id'])
+        finally:
+            config.pop('ckanext.glasgow.upload_queue_max_attempts', None)
+
+        eq_(task_dict['state'], 'error')
+        eq_(os.listdir(self.staging_dir), [])
+
+    @mock.patch('requests.request')
+    def test_send_queued_upload_not_found(self, mock_request):
+        mock_request.return_value = mock.Mock(
+            status_code=404,
+            content='Not found',
+            **{
+                'raise_for_status.side_effect':
+                    requests.exceptions.HTTPError(),
+            }
+        )
+
+        request_dict = self._queue_upload()
+
+        context = {'model': model, 'session': model.Session}
+        task_dict = send_queued_upload(context, request_dict['task_id'])
+
+        eq_(task_dict['state'], 'error')
+        eq_(os.listdir(self.staging_dir), [])
+
+
+class TestGetOrganizationId(object):
+
+    def setup(self):
+        self.org = helpers.call_action('organization_create',
+                                       context={'local_action': True},
+                                       name='test_org')
+
+    def teardown(self):
+        _organization_id_cache.clear()
+        helpers.reset_db()
+
+    def test_by_name_and_id(self):
+        eq_(_get_organization_id('test_org'), self.org['id'])
+        eq_(_get_organization_id(self.org['id']), self.org['id'])
+
+    def test_not_found(self):
+        eq_(_get_organization_id('unknown_org'), None)
+        eq_(_get_organization_id(None), None)
+
+    def test_is_cached(self):
+        _get_organization_id('test_org')
+
+        assert 'test_org' in _organization_id_cache
+        assert self.org['id'] in _organization_id_cache
+
+    def test_cache_cleared_on_update(self):
+        _get_organization_id('test_org')
+
+        helpers.call_action('organization_update',
+                            context={'local_action': True},
+                            id=self.org['id'],
+                            name='test_org_renamed')
+
+        assert 'test_org' not in _organization_id_cache
+        eq_(_get_organization_id('test_org_renamed'), self.org['id'])
+
+
+class TestOrganizationListForUser(object):
+
+    def setup(self):
+        self.user = helpers.call_action('user_create', name='test_user',
+                                        email='test@test.com',
+                                        password='test')
+        self.org = helpers.call_action('organization_create',
+                                       context={'local_action': True},
+                                       name='test_org', title='Test Org')
+        helpers.call_action('organization_member_create',
+                            context={'local_action': True},
+                            id=self.org['id'], username='test_user',
+                            role='editor')
+
+    def teardown(self):
+        _organization_list_cache.clear()
+        helpers.reset_db()
+
+    def _get_orgs(self, **kwargs):
+        return helpers.call_action('organization_list_for_user',
+                                   context={'user': 'test_user'},
+                                   **kwargs)
+
+    def test_lightweight(self):
+        orgs = self._get_orgs(lightweight=True)
+
+        eq_(orgs, [{'id': self.org['id'], 'name': 'test_org',
+                    'title': 'Test Org', 'capacity': 'editor'}])
+
+    def test_full(self):
+        orgs = self._get_orgs()
+
+        eq_(len(orgs), 1)
+        eq_(orgs[0]['name'], 'test_org')
+        assert 'display_name' in orgs[0]
+
+    def test_permission(self):
+        eq_(len(self._get_orgs(permission='create_dataset')), 1)
+        eq_(self._get_orgs(permission='delete_member'), [])
+
+    def test_cache_cleared_on_member_delete(self):
+        eq_(len(self._get_orgs(lightweight=True)), 1)
+        assert _organization_list_cache
+
+        helpers.call_action('organization_member_delete',
+                            context={'local_action': True},
+                            id=self.org['id'], username='test_user')
+
+        eq_(self._get_orgs(lightweight=True), [])
+
+    def test_cache_cleared_on_core_member_changes(self):
+        eq_(len(self._get_orgs(lightweight=True)), 1)
+
+        member = model.Session.query(model.Member) \
+            .filter(model.Member.group_id == self.org['id']) \
+            .filter(model.Member.table_name == 'user') \
+            .filter(model.Member.capacity == 'editor') \
+            .one()
+        model.repo.new_revision()
+        member.state = 'deleted'
+        model.repo.commit()
+
+        eq_(self._get_orgs(lightweight=True), [])
+
+    def test_cache_cleared_on_sysadmin_changes(self):
+        eq_(self._get_orgs(permission='delete_member'), [])
+
+        user = model.User.get('test_user')
+        user.sysadmin = True
+        model.repo.commit()
+
+        eq_(len(self._get_orgs(permission='delete_member')), 1)
+
+    def test_cache_size_is_bounded(self):
+        with mock.patch.dict(config, {
+                'ckanext.glasgow.organization_list_cache_size': 2}):
+            for permission in ('read', 'create_dataset', 'delete_member'):
+                self._get_orgs(permission=permission, lightweight=True)
+
+        eq_(_organization_list_cache.keys(),
+            [('test_user', 'create_dataset'), ('test_user', 'delete_member')])
+
+
+class TestUserList(object):
+
+    def setup(self):
+        helpers.reset_db()
+        setup_model()
+
+        for name in ('user_a', 'user_b', 'user_c'):
+            helpers.call_action('user_create', name=name,
+                                email='{0}@test.com'.format(name),
+                                password='test')
+
+    def test_limit_and_offset(self):
+        users = helpers.call_action('user_list', limit=2)
+        eq_([user['name'] for user in users], ['user_a', 'user_b'])
+
+        users = helpers.call_action('user_list', limit=2, offset=2)
+        eq_([user['name'] for user in users], ['user_c'])
+
+    def test_counts_default_to_zero(self):
+        users = helpers.call_action('user_list')
+
+        for user in users:
+            eq_(user['number_of_edits'], 0)
+            eq_(user['number_administered_packages'], 0)
+            assert 'password' not in user
+
+    def test_counts_refreshed(self):
+        helpers.call_action('organization_create',
+                            context={'user': 'user_b', 'local_action': True},
+                            name='test_org')
+
+        refresh_user_counts()
+
+        users = helpers.call_action('user_list', order_by='edits')
+        eq_(users[0]['name'], 'user_b')
+        assert users[0]['number_of_edits'] > 0
+        eq_(users[1]['number_of_edits'], 0)
@@ -0,0 +1,47 @@
+import nose
+
+import ckanext.glasgow.logic.schema as custom_schema
+
+eq_ = nose.tools.eq_
+
+
+class TestCachedSchemas(object):
+
+    def test_same_schema_as_uncached(self):
+
+        cached = custom_schema.create_package_schema()
+        uncached = custom_schema.create_package_schema.build()
+
+        eq_(sorted(cached.keys()), sorted(uncached.keys()))
+        eq_(sorted(cached['resources'].keys()),
+            sorted(uncached['resources'].keys()))
+
+    def test_validators_are_shared(self):
+
+        schema_1 = custom_schema.resource_schema()
+        schema_2 = custom_schema.resource_schema()
+
+        eq_(schema_1['name'], schema_2['name'])
+        assert schema_1['name'] is not schema_2['name']
+
+    def test_copies_can_be_modified(self):
+
+        schema = custom_schema.create_package_schema()
+        schema['name'] = []
+        schema['tags']['name'].append(unicode)
+        schema['extras'].pop('key')
+
+        other_schema = custom_schema.create_package_schema()
+
+        assert other_schema['name']
+        assert unicode not in other_schema['tags']['name']
+        assert 'key' in other_schema['extras']
+
+    def test_ec_create_package_schema(self):
+
+        schema = custom_schema.ec_create_package_schema()
+
+        assert (custom_schema.no_pending_dataset_with_same_name
+                not in schema['name'])
+        assert (custom_schema.no_pending_dataset_with_same_name
+                in custom_schema.create_package_schema()['name'])
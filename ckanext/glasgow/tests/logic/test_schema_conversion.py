@@ -395,3 +395,34 @@ class TestSchemaConversion(object):
         eq_(ckan_dict['id'], 'org-id')
         eq_(ckan_dict['title'], 'Test Org')
         eq_(ckan_dict['description'], 'Some longer description')
+
+    def test_convert_ec_dataset_to_ckan_dataset_extras(self):
+
+        ec_dict = {
+            'Id': 1,
+            'Title': 'Test Dataset',
+            'CreatedBy': 'Test user',
+            'name': 'test-dataset',
+            'SomeCustomField': 'Some value',
+        }
+
+        ckan_dict = custom_schema.convert_ec_dataset_to_ckan_dataset(ec_dict)
+
+        eq_(ckan_dict['extras'], [{'key': 'SomeCustomField',
+                                   'value': 'Some value'}])
+
+    def test_convert_ec_files_to_ckan_resources(self):
+
+        ec_dicts = [
+            {'FileId': 1, 'Title': 'Test File 1', 'CreatedBy': 'Test user'},
+            {'FileId': 2, 'Title': 'Test File 2', 'SomeCustomField': 'a'},
+        ]
+
+        ckan_dicts = custom_schema.convert_ec_files_to_ckan_resources(
+            ec_dicts)
+
+        eq_([ckan_dict['id'] for ckan_dict in ckan_dicts], [1, 2])
+        eq_([ckan_dict['name'] for ckan_dict in ckan_dicts],
+            ['Test File 1', 'Test File 2'])
+        assert 'CreatedBy' not in ckan_dicts[0]
+        eq_(ckan_dicts[1]['SomeCustomField'], 'a')
@@ -464,3 +464,46 @@ class TestUniqueTitleValidators(object):
                                                                 errors,
                                                                 context)
         eq_(new_value, 'Another Title')
+
+    def test_create_same_title_different_case_same_org(self):
+
+        key = ('title',)
+        data = {
+            ('title',): 'tEST  dataSET',
+            ('owner_org',): self.test_org['id'],
+        }
+        errors = {}
+        context = {}
+        nose.tools.assert_raises(p.toolkit.Invalid,
+                                 validators.unique_title_within_organization,
+                                 key, data, errors, context)
+
+    def test_create_same_title_same_org_by_name(self):
+
+        key = ('title',)
+        data = {
+            ('title',): self.existing_dataset['title'],
+            ('owner_org',): self.test_org['name'],
+        }
+        errors = {}
+        context = {}
+        nose.tools.assert_raises(p.toolkit.Invalid,
+                                 validators.unique_title_within_organization,
+                                 key, data, errors, context)
+
+    def test_update_same_title_same_dataset(self):
+
+        key = ('title',)
+        data = {
+            ('id',): self.existing_dataset['id'],
+            ('title',): self.existing_dataset['title'].upper(),
+            ('owner_org',): self.test_org['id'],
+        }
+        errors = {}
+        context = {}
+
+        new_value = validators.unique_title_within_organization(key,
+                                                                data,
+                                                                errors,
+                                                                context)
+        eq_(new_value, self.existing_dataset['title'].upper())
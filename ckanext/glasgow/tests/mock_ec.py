@@ -1,6 +1,9 @@
 import logging
 import uuid
 import json
+import hmac
+import time
+import hashlib
 
 import flask
 from werkzeug.exceptions import default_exceptions
@@ -465,6 +468,66 @@ def request_change_status(request_id):
     return flask.Response(response_string, mimetype='application/json')
 
 
+changelog_audits = [
+    {
+        "AuditId": 1005,
+        "AuditType": "FileCreated",
+        "Command": "CreateFile",
+        "Component": "DataPublication",
+        "CustomProperties": [
+            {
+                "DatasetId": "691E26D0-BACA-4082-AB2D-59AA0027AAF3",
+                "FileId": "AB1E26D0-BACA-4082-AB2D-59AA0027AA90",
+                "OrganisationId": "73612F17-0A19-431F-A86C-F3FE59F86E4A",
+                "Versionid": "781E26D0-BACA-4082-AB2D-59AA0027AA67"
+            }
+        ],
+        "Message": "File Create Operation completed",
+        "ObjectType": "File",
+        "OperationState": "Succeeded",
+        "Owner": "Widget Admin",
+        "RequestId": "D3C86B10-90F8-4CA6-A943-1404FB6C06BF",
+        "Timestamp": "2014-05-21T00:00:10"
+    },
+    {
+        "AuditId": 1010,
+        "AuditType": "DatasetCreated",
+        "Command": "CreateDataset",
+        "Component": "DataPublication",
+        "CustomProperties": [
+            {
+                "DatasetId": "691E26D0-BACA-4082-AB2D-59AA0027AAF3",
+                "OrganisationId": "73612F17-0A19-431F-A86C-F3FE59F86E4A"
+            }
+        ],
+        "Message": "Dataset Create Operation completed",
+        "ObjectType": "Dataset",
+        "OperationState": "Succeeded",
+        "Owner": "Joe",
+        "RequestId": "90C86B10-90F8-4CA6-A943-1404FB6C0645",
+        "Timestamp": "2014-05-21T00:00:10"
+    },
+    {
+        "AuditId": 1012,
+        "AuditType": "DatasetCreated",
+        "Command": "CreateDataset",
+        "Component": "DataPublication",
+        "CustomProperties": [
+            {
+                "DatasetId": "691E26D0-BACA-4082-AB2D-XXXXXXXXXXXX",
+                "OrganisationId": "73612F17-0A19-431F-A86C-F3FE59F86E4A"
+            }
+        ],
+        "Message": "Dataset Create Operation completed",
+        "ObjectType": "Dataset",
+        "OperationState": "Succeeded",
+        "Owner": "Joe",
+        "RequestId": "90C86B10-90F8-4CA6-A943-YYYYYYYYYYY",
+        "Timestamp": "2014-05-22T13:54:10"
+    }
+]
+
+
 @app.route('/ChangeLog/RequestChanges')
 @app.route('/ChangeLog/RequestChanges/<audit_id>')
 def request_changelog(audit_id=None):
@@ -479,65 +542,7 @@ def request_changelog(audit_id=None):
         response.status_code = 401
         return response
 
-    response = [
-            {
-                "AuditId": 1005,
-                "AuditType": "FileCreated",
-                "Command": "CreateFile",
-                "Component": "DataPublication",
-                "CustomProperties": [
-                    {
-                        "DatasetId": "691E26D0-BACA-4082-AB2D-59AA0027AAF3",
-                        "FileId": "AB1E26D0-BACA-4082-AB2D-59AA0027AA90",
-                        "OrganisationId": "73612F17-0A19-431F-A86C-F3FE59F86E4A",
-                        "Versionid": "781E26D0-BACA-4082-AB2D-59AA0027AA67"
-                    }
-                ],
-                "Message": "File Create Operation completed",
-                "ObjectType": "File",
-                "OperationState": "Succeeded",
-                "Owner": "Widget Admin",
-                "RequestId": "D3C86B10-90F8-4CA6-A943-1404FB6C06BF",
-                "Timestamp": "2014-05-21T00:00:10"
-            },
-            {
-                "AuditId": 1010,
-                "AuditType": "DatasetCreated",
-                "Command": "CreateDataset",
-                "Component": "DataPublication",
-                "CustomProperties": [
-                    {
-                        "DatasetId": "691E26D0-BACA-4082-AB2D-59AA0027AAF3",
-                        "OrganisationId": "73612F17-0A19-431F-A86C-F3FE59F86E4A"
-                    }
-                ],
-                "Message": "Dataset Create Operation completed",
-                "ObjectType": "Dataset",
-                "OperationState": "Succeeded",
-                "Owner": "Joe",
-                "RequestId": "90C86B10-90F8-4CA6-A943-1404FB6C0645",
-                "Timestamp": "2014-05-21T00:00:10"
-            },
-            {
-                "AuditId": 1012,
-                "AuditType": "DatasetCreated",
-                "Command": "CreateDataset",
-                "Component": "DataPublication",
-                "CustomProperties": [
-                    {
-                        "DatasetId": "691E26D0-BACA-4082-AB2D-XXXXXXXXXXXX",
-                        "OrganisationId": "73612F17-0A19-431F-A86C-F3FE59F86E4A"
-                    }
-                ],
-                "Message": "Dataset Create Operation completed",
-                "ObjectType": "Dataset",
-                "OperationState": "Succeeded",
-                "Owner": "Joe",
-                "RequestId": "90C86B10-90F8-4CA6-A943-YYYYYYYYYYY",
-                "Timestamp": "2014-05-22T13:54:10"
-            }
-
-        ]
+    response = list(changelog_audits)
 
     top = int(flask.request.args.get('$top', 1000))
     object_type = flask.request.args.get('$ObjectType')
@@ -766,6 +771,27 @@ def api_description():
     return flask.jsonify(**api_desc)
 
 
+def get_changelog_notification(secret, audits=None, timestamp=None):
+    '''
+    Returns the body and headers of a changelog notification
+
+    The platform pushes the audits (by default all the `changelog_audits`)
+    to the `/changelog/notify` CKAN endpoint, signed with the shared
+    secret together with the time they were sent (by default now).
+    '''
+    body = json.dumps(changelog_audits if audits is None else audits)
+    if timestamp is None:
+        timestamp = int(time.time())
+    signature = hmac.new(secret, '{0}.{1}'.format(timestamp, body),
+                         hashlib.sha256).hexdigest()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-CTPEC-Timestamp': str(timestamp),
+        'X-CTPEC-Signature': 'sha256=' + signature,
+    }
+    return body, headers
+
+
 def run(**kwargs):
     app.run(**kwargs)
 
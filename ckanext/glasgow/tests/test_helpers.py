@@ -0,0 +1,63 @@
+import nose
+import mock
+
+import ckanext.glasgow.helpers as custom_helpers
+
+
+eq_ = nose.tools.eq_
+
+
+class FakeContext(object):
+    pass
+
+
+class TestRequestMemoize(object):
+
+    def setup(self):
+        self.calls = []
+
+        @custom_helpers.request_memoize()
+        def helper(value):
+            self.calls.append(value)
+            return [value]
+
+        self.helper = helper
+
+    def test_cached_within_request(self):
+        with mock.patch('ckan.plugins.toolkit.c', FakeContext()):
+            eq_(self.helper('a'), ['a'])
+            eq_(self.helper('a'), ['a'])
+            eq_(self.helper('b'), ['b'])
+
+        eq_(self.calls, ['a', 'b'])
+
+    def test_not_shared_between_requests(self):
+        with mock.patch('ckan.plugins.toolkit.c', FakeContext()):
+            self.helper('a')
+        with mock.patch('ckan.plugins.toolkit.c', FakeContext()):
+            self.helper('a')
+
+        eq_(self.calls, ['a', 'a'])
+
+    def test_custom_key(self):
+
+        @custom_helpers.request_memoize(key=lambda pkg_dict: pkg_dict['id'])
+        def helper(pkg_dict):
+            self.calls.append(pkg_dict['id'])
+            return pkg_dict['id']
+
+        with mock.patch('ckan.plugins.toolkit.c', FakeContext()):
+            helper({'id': 'a', 'extras': []})
+            helper({'id': 'a', 'extras': []})
+
+        eq_(self.calls, ['a'])
+
+
+class TestGetLicenses(object):
+
+    def test_returned_lists_are_copies(self):
+        licenses = custom_helpers.get_licenses()
+        licenses.append(('test', 'test'))
+
+        eq_(custom_helpers.get_licenses()[0], ('', ''))
+        assert ('test', 'test') not in custom_helpers.get_licenses()
@@ -0,0 +1,55 @@
+import mock
+import nose
+
+from ckanext.glasgow.locks import AdvisoryLocks, advisory_lock, get_lock_key
+
+
+eq_ = nose.tools.eq_
+
+
+class TestAdvisoryLocks(object):
+
+    backend = 'postgres'
+
+    def setup(self):
+        self.patcher = mock.patch.dict(
+            'pylons.config', {'ckanext.glasgow.lock_backend': self.backend})
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def test_lock_is_exclusive(self):
+        with AdvisoryLocks() as locks, AdvisoryLocks() as other_locks:
+            assert locks.acquire('test-lock')
+            assert not other_locks.acquire('test-lock')
+            assert other_locks.acquire('other-test-lock')
+
+    def test_acquire_held_lock(self):
+        with AdvisoryLocks() as locks:
+            assert locks.acquire('test-lock')
+            assert locks.acquire('test-lock')
+
+            locks.release('test-lock')
+
+            with advisory_lock('test-lock') as acquired:
+                assert acquired
+
+    def test_locks_are_released(self):
+        with AdvisoryLocks() as locks:
+            locks.acquire_all(['test-lock', 'other-test-lock'])
+
+        with advisory_lock('test-lock') as acquired:
+            assert acquired
+        with advisory_lock('other-test-lock') as acquired:
+            assert acquired
+
+    def test_lock_key(self):
+        eq_(get_lock_key('test-lock'), get_lock_key(u'test-lock'))
+        assert get_lock_key('test-lock') != get_lock_key('other-test-lock')
+        assert -2 ** 63 <= get_lock_key('test-lock') < 2 ** 63
+
+
+class TestLocalAdvisoryLocks(TestAdvisoryLocks):
+
+    backend = 'local'
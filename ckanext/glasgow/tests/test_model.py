@@ -0,0 +1,270 @@
+import json
+import datetime
+
+import nose
+import mock
+
+import ckan.model as model
+import ckan.new_tests.helpers as helpers
+
+from ckanext.glasgow.model import (
+    extension_indexes,
+    get_index_status,
+    create_index,
+    drop_index,
+    setup,
+    archive_task_statuses,
+    get_archived_tasks,
+    get_tasks_for_request_ids,
+    task_request_table,
+    mark_audit_processed,
+    get_processed_audit_ids,
+    defer_audit,
+    pop_deferred_audits,
+)
+from ckanext.glasgow.commands.db import GlasgowDB
+
+
+eq_ = nose.tools.eq_
+
+
+class TestIndexes(object):
+
+    def _get_status(self, index_name):
+        for name, table, definition, status in get_index_status():
+            if name == index_name:
+                return status
+
+    def test_all_indexes_listed(self):
+
+        eq_([status[0] for status in get_index_status()],
+            [index[0] for index in extension_indexes])
+
+    def test_create_index(self):
+        name, table, definition = extension_indexes[0]
+        drop_index(name)
+
+        eq_(self._get_status(name), 'missing')
+
+        create_index(name, table, definition)
+
+        eq_(self._get_status(name), 'ok')
+
+    @mock.patch('ckanext.glasgow.commands.db.get_index_status')
+    def test_invalid_index_is_reported(self, mock_status):
+        # What an interrupted concurrent build leaves behind
+        name, table, definition = extension_indexes[0]
+        mock_status.return_value = [(name, table, definition, 'invalid')]
+
+        nose.tools.assert_raises(SystemExit,
+                                 GlasgowDB('glasgow_db')._verify_indexes)
+
+    @mock.patch('ckanext.glasgow.commands.db.create_index')
+    @mock.patch('ckanext.glasgow.commands.db.drop_index')
+    @mock.patch('ckanext.glasgow.commands.db.get_index_status')
+    def test_invalid_index_is_rebuilt(self, mock_status, mock_drop,
+                                      mock_create):
+        name, table, definition = extension_indexes[0]
+        mock_status.return_value = [(name, table, definition, 'invalid')]
+
+        GlasgowDB('glasgow_db')._create_indexes()
+
+        mock_drop.assert_called_once_with(name)
+        mock_create.assert_called_once_with(name, table, definition)
+
+
+class TestTaskArchive(object):
+
+    def setup(self):
+        helpers.reset_db()
+        setup()
+
+    def _create_task(self, state, days_old, request_id,
+                     task_type='dataset_request_create'):
+        task = model.TaskStatus(
+            entity_id='dataset_{0}'.format(request_id),
+            entity_type='dataset',
+            task_type=task_type,
+            key='name_{0}'.format(request_id),
+            value=json.dumps({'request_id': request_id}),
+            state=state,
+            last_updated=(datetime.datetime.now()
+                          - datetime.timedelta(days=days_old)))
+        model.Session.add(task)
+        model.Session.commit()
+        return task.id
+
+    def _live_task_ids(self):
+        return [task.id for task in model.Session.query(model.TaskStatus)]
+
+    def test_archive_completed_and_expired(self):
+        finished_id = self._create_task('finished', 2, 'request_1')
+        recent_id = self._create_task('finished', 0, 'request_2')
+        expired_id = self._create_task('sent', 40, 'request_3')
+        pending_id = self._create_task('sent', 2, 'request_4')
+        uploading_id = self._create_task('uploading', 40, 'request_5')
+
+        eq_(archive_task_statuses(), 2)
+
+        eq_(sorted(self._live_task_ids()),
+            sorted([recent_id, pending_id, uploading_id]))
+
+        archived = dict((task.id, task) for task in get_archived_tasks())
+        eq_(sorted(archived.keys()), sorted([finished_id, expired_id]))
+        eq_(archived[finished_id].request_id, 'request_1')
+        eq_(archived[finished_id].expired, False)
+        eq_(archived[expired_id].state, 'sent')
+        eq_(archived[expired_id].expired, True)
+
+    def test_other_task_types_are_not_archived(self):
+        datapusher_id = self._create_task('error', 40, 'request_1',
+                                          task_type='datapusher')
+        finished_id = self._create_task('finished', 2, 'request_2')
+
+        eq_(archive_task_statuses(), 1)
+
+        eq_(self._live_task_ids(), [datapusher_id])
+        eq_([task.id for task in get_archived_tasks()], [finished_id])
+
+    def test_archive_in_batches(self):
+        for i in range(5):
+            self._create_task('error', 2, 'request_{0}'.format(i))
+
+        eq_(archive_task_statuses(limit=2), 2)
+        eq_(archive_task_statuses(limit=2), 2)
+        eq_(archive_task_statuses(limit=2), 1)
+        eq_(archive_task_statuses(limit=2), 0)
+
+        eq_(self._live_task_ids(), [])
+
+    def test_get_archived_tasks_filters(self):
+        self._create_task('finished', 2, 'request_1')
+        archive_task_statuses()
+
+        eq_(len(get_archived_tasks(entity_type='dataset',
+                                   ids=['name_request_1'])), 1)
+        eq_(len(get_archived_tasks(entity_type='dataset',
+                                   ids=['dataset_request_1'])), 1)
+        eq_(len(get_archived_tasks(entity_type='organization',
+                                   ids=['dataset_request_1'])), 0)
+        eq_(len(get_archived_tasks(request_ids=['request_1'])), 1)
+        eq_(len(get_archived_tasks(request_ids=['request_2'])), 0)
+
+    def test_archived_tasks_are_not_found_by_request_id(self):
+        self._create_task('finished', 2, 'request_1')
+
+        archive_task_statuses()
+
+        eq_(get_tasks_for_request_ids(['request_1']), [])
+        eq_(model.Session.query(task_request_table).count(), 0)
+
+
+class TestTaskRequests(object):
+
+    def setup(self):
+        helpers.reset_db()
+        setup()
+
+    def _create_task(self, value):
+        task = model.TaskStatus(
+            entity_id='dataset_1',
+            entity_type='dataset',
+            task_type='dataset_request_create',
+            key='name_1',
+            value=json.dumps(value),
+            state='sent',
+            last_updated=datetime.datetime.now())
+        model.Session.add(task)
+        model.Session.commit()
+        return task
+
+    def _get_task_ids(self, request_ids):
+        return [(request_id, task.id) for request_id, task
+                in get_tasks_for_request_ids(request_ids)]
+
+    def test_tasks_by_request_id(self):
+        task = self._create_task({'request_id': 'request_1'})
+        self._create_task({'request_id': 'request_2'})
+        self._create_task({})
+
+        eq_(self._get_task_ids(['request_1', 'unknown']),
+            [('request_1', task.id)])
+
+    def test_request_id_is_matched_exactly(self):
+        self._create_task({'request_id': 'request_1'})
+        self._create_task({'request_id': 'request_10'})
+
+        eq_(self._get_task_ids(['request_%', 'request_']), [])
+        eq_(len(self._get_task_ids(['request_1'])), 1)
+
+    def test_request_id_is_updated_with_the_task(self):
+        task = self._create_task({})
+        eq_(self._get_task_ids(['request_1']), [])
+
+        task.value = json.dumps({'request_id': 'request_1'})
+        model.Session.commit()
+        eq_(self._get_task_ids(['request_1']), [('request_1', task.id)])
+
+        task.state = 'finished'
+        model.Session.commit()
+        eq_(self._get_task_ids(['request_1']), [('request_1', task.id)])
+
+        model.Session.delete(task)
+        model.Session.commit()
+        eq_(self._get_task_ids(['request_1']), [])
+
+
+class TestProcessedAudits(object):
+
+    def setup(self):
+        helpers.reset_db()
+        setup()
+
+    def test_mark_audit_processed(self):
+        mark_audit_processed(1005)
+        mark_audit_processed('1010')
+        model.Session.commit()
+
+        eq_(get_processed_audit_ids([1005, 1010, 1012]),
+            set(['1005', '1010']))
+
+    def test_mark_audit_processed_twice(self):
+        mark_audit_processed(1005)
+        mark_audit_processed(1005)
+        model.Session.commit()
+
+        eq_(get_processed_audit_ids(['1005']), set(['1005']))
+
+    def test_no_audit_ids(self):
+        eq_(get_processed_audit_ids([]), set())
+
+
+class TestDeferredAudits(object):
+
+    def setup(self):
+        helpers.reset_db()
+        setup()
+
+    def _audit(self, audit_id):
+        return {'AuditId': audit_id, 'Command': 'CreateFile',
+                'CustomProperties': {'DataSetId': 'dataset-1'}}
+
+    def test_pop_deferred_audits(self):
+        defer_audit(self._audit('1'), 'File', 'Dataset not harvested yet')
+        defer_audit(self._audit('2'), 'File', 'Dataset not harvested yet', 3)
+        defer_audit(self._audit('3'), None, 'Dataset not harvested yet')
+        model.Session.commit()
+
+        eq_(pop_deferred_audits('File'),
+            [(self._audit('1'), 1), (self._audit('2'), 3)])
+        model.Session.commit()
+
+        eq_(pop_deferred_audits('File'), [])
+        eq_(pop_deferred_audits(None), [(self._audit('3'), 1)])
+
+    def test_defer_audit_again(self):
+        defer_audit(self._audit('1'), 'File', 'Dataset not harvested yet')
+        defer_audit(self._audit('1'), 'File', 'Dataset not harvested yet', 2)
+        model.Session.commit()
+
+        eq_(pop_deferred_audits('File'), [(self._audit('1'), 2)])
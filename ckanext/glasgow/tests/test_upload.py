@@ -0,0 +1,75 @@
+import StringIO
+
+import nose
+
+from ckanext.glasgow.upload import MultipartStream, get_file_length
+
+
+eq_ = nose.tools.eq_
+
+
+class TestMultipartStream(object):
+
+    def _get_stream(self, contents='File contents', **kwargs):
+        return MultipartStream(
+            fields=[('metadata', '{"Title": "Test"}')],
+            files=[('file', 'test.csv', StringIO.StringIO(contents))],
+            **kwargs)
+
+    def test_length(self):
+        stream = self._get_stream()
+
+        eq_(stream.len, len(stream.read()))
+
+    def test_body(self):
+        stream = self._get_stream()
+        body = stream.read()
+
+        assert stream.content_type.endswith(stream.boundary)
+        assert body.startswith('--{0}\r\n'.format(stream.boundary))
+        assert body.endswith('--{0}--\r\n'.format(stream.boundary))
+        assert 'name="metadata"\r\n\r\n{"Title": "Test"}\r\n' in body
+        assert 'name="file"; filename="test.csv"' in body
+        assert 'Content-Type: text/csv\r\n\r\nFile contents\r\n' in body
+
+    def test_read_in_chunks_and_iter_are_equal(self):
+        contents = 'x' * 1000
+
+        chunks = []
+        stream = self._get_stream(contents, chunk_size=100)
+        while True:
+            chunk = stream.read(64)
+            if not chunk:
+                break
+            assert len(chunk) <= 64
+            chunks.append(chunk)
+
+        other_stream = self._get_stream(contents, chunk_size=100)
+        other_body = ''.join(other_stream).replace(other_stream.boundary,
+                                                   stream.boundary)
+
+        eq_(''.join(chunks), other_body)
+
+    def test_chunked_has_no_length(self):
+        stream = self._get_stream(chunked=True)
+
+        eq_(stream.len, None)
+
+    def test_progress_callback(self):
+        calls = []
+
+        def callback(sent, total):
+            calls.append((sent, total))
+
+        stream = self._get_stream('x' * 1000, chunk_size=100,
+                                  callback=callback)
+        list(stream)
+
+        assert len(calls) > 10
+        eq_(calls[-1], (stream.len, stream.len))
+
+    def test_file_length_from_current_position(self):
+        file_obj = StringIO.StringIO('File contents')
+        file_obj.read(5)
+
+        eq_(get_file_length(file_obj), 8)
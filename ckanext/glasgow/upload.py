@@ -0,0 +1,227 @@
+import os
+import json
+import uuid
+import shutil
+import tempfile
+import mimetypes
+
+from pylons import config
+
+
+CRLF = '\r\n'
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def get_file_length(file_obj):
+    '''
+    Returns the number of bytes left to read on a file-like object
+
+    Returns None if the length can not be worked out (eg non seekable
+    streams)
+    '''
+    try:
+        position = file_obj.tell()
+    except (AttributeError, IOError, OSError):
+        position = 0
+
+    try:
+        return os.fstat(file_obj.fileno()).st_size - position
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+
+    try:
+        file_obj.seek(0, os.SEEK_END)
+        length = file_obj.tell() - position
+        file_obj.seek(position)
+        return length
+    except (AttributeError, IOError, OSError):
+        return None
+
+
+class MultipartStream(object):
+    '''
+    A multipart/form-data body that is generated while it is being sent
+
+    Files are read in chunks of `chunk_size` bytes as the body is consumed,
+    so they are never fully loaded in memory. Instances can be passed
+    directly as the `data` parameter of `requests`. If the total length can
+    be worked out it is exposed as `len`, and requests will send a
+    Content-Length header, otherwise (or if `chunked` is True) the body
+    is sent using chunked transfer encoding.
+
+    :param fields: list of (name, value) tuples for regular form fields
+    :param files: list of (name, filename, file object) tuples
+    :param chunk_size: size of the chunks read from the files
+    :param callback: function called with the number of bytes sent so far
+        and the total length (or None) every time a chunk is sent
+    :param chunked: do not compute the total length, forcing a chunked
+        transfer
+    '''
+
+    def __init__(self, fields=None, files=None, chunk_size=64 * 1024,
+                 callback=None, chunked=False):
+
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={0}'.format(
+            self.boundary)
+        self.fields = fields or []
+        self.files = files or []
+        self.chunk_size = chunk_size
+        self.callback = callback
+
+        self._parts = []
+        for name, value in self.fields:
+            self._parts.append(self._part_header(name) + _to_bytes(value)
+                               + CRLF)
+        for name, filename, file_obj in self.files:
+            self._parts.append(self._part_header(name, filename))
+            self._parts.append(file_obj)
+            self._parts.append(CRLF)
+        self._parts.append('--{0}--{1}'.format(self.boundary, CRLF))
+
+        self.len = None if chunked else self._get_length()
+        self.bytes_read = 0
+
+        self._iterator = None
+        self._buffer = ''
+
+    def __repr__(self):
+        return '<MultipartStream fields={0} files={1}>'.format(
+            [name for name, value in self.fields],
+            [filename for name, filename, file_obj in self.files])
+
+    def _part_header(self, name, filename=None):
+        header = '--{0}{1}'.format(self.boundary, CRLF)
+        if filename is None:
+            header += 'Content-Disposition: form-data; name="{0}"{1}'.format(
+                _to_bytes(name), CRLF)
+        else:
+            content_type = (mimetypes.guess_type(_to_bytes(filename))[0]
+                            or 'application/octet-stream')
+            header += ('Content-Disposition: form-data; name="{0}"; '
+                       'filename="{1}"{2}').format(
+                _to_bytes(name), _to_bytes(filename), CRLF)
+            header += 'Content-Type: {0}{1}'.format(content_type, CRLF)
+        return header + CRLF
+
+    def _get_length(self):
+        length = 0
+        for part in self._parts:
+            if isinstance(part, basestring):
+                length += len(part)
+            else:
+                part_length = get_file_length(part)
+                if part_length is None:
+                    return None
+                length += part_length
+        return length
+
+    def _generate(self):
+        for part in self._parts:
+            if isinstance(part, basestring):
+                yield part
+            else:
+                while True:
+                    chunk = part.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def _progress(self, length):
+        self.bytes_read += length
+        if self.callback and length:
+            self.callback(self.bytes_read, self.len)
+
+    def __iter__(self):
+        # Used by requests when sending a chunked body
+        for chunk in self._generate():
+            self._progress(len(chunk))
+            yield chunk
+
+    def read(self, size=-1):
+        # Used by httplib when sending a body with a known length
+        if self._iterator is None:
+            self._iterator = self._generate()
+
+        if size is None or size < 0:
+            # Read everything left, only meant for small bodies
+            data, self._buffer = self._buffer + ''.join(self._iterator), ''
+            self._progress(len(data))
+            return data
+
+        while len(self._buffer) < size:
+            try:
+                self._buffer += next(self._iterator)
+            except StopIteration:
+                break
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._progress(len(data))
+        return data
+
+
+def get_staging_dir():
+    '''
+    Returns the directory where queued uploads are stored until they are sent
+
+    Defaults to a `glasgow_uploads` folder inside `ckan.storage_path`, and
+    can be changed with `ckanext.glasgow.upload_staging_dir`.
+    '''
+    staging_dir = config.get('ckanext.glasgow.upload_staging_dir')
+    if not staging_dir:
+        storage_path = (config.get('ckan.storage_path')
+                        or tempfile.gettempdir())
+        staging_dir = os.path.join(storage_path, 'glasgow_uploads')
+
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+
+    return staging_dir
+
+
+def stage_file(file_obj, name, extras=None, chunk_size=64 * 1024):
+    '''
+    Copies a file-like object to the staging directory
+
+    The file is written under a temporary name and renamed once complete, so
+    the worker never picks up partial files. `extras` is stored in a JSON
+    file next to it, readable only by the current user, and can be retrieved
+    with `get_staged_file_extras`.
+
+    :returns: the path of the staged file
+    '''
+    path = os.path.join(get_staging_dir(), name)
+    tmp_path = path + '.part'
+
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(file_obj, f, chunk_size)
+    os.rename(tmp_path, path)
+
+    if extras is not None:
+        fd = os.open(path + '.json', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(extras, f)
+
+    return path
+
+
+def get_staged_file_extras(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def remove_staged_file(path):
+    for file_path in (path, path + '.json', path + '.part'):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
@@ -35,5 +35,8 @@ setup(
     changelog_audit=ckanext.glasgow.commands.changelog_update:ChangelogAudit
     db_clean=ckanext.glasgow.commands.changelog_update:Cleanup
     get_initial_users=ckanext.glasgow.commands.get_users:GetInitialUsers
+    upload_queue=ckanext.glasgow.commands.upload_queue:UploadQueue
+    glasgow_db=ckanext.glasgow.commands.db:GlasgowDB
+    changelog_scheduler=ckanext.glasgow.commands.changelog_scheduler:ChangelogScheduler
     ''',
 )